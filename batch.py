@@ -0,0 +1,253 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+
+@author: Martin
+
+Description:
+    Run one operation, or a recipe of operations (see pipeline.py), on all the files of a session/study in parallel
+
+    The input is a directory (all the files matching --pattern, recursively) or one or more glob patterns.
+    The output file name is built from a template with the fields:
+        {dir}     directory of the input file
+        {reldir}  directory of the input file relative to the input directory (or to the glob base)
+        {name}    input file name (with extension)
+        {stem}    input file name without extension
+        {ext}     input file extension (with the dot)
+    e.g. "processed/{reldir}/{stem}_processed{ext}" (the output directories are created)
+
+    Each file is processed in its own worker process: an error on one file is reported in the summary and does not stop the others.
+
+Usage:
+    python batch.py -i "study/" --pattern "*.c3d" -r recipe.json -t "processed/{reldir}/{stem}{ext}" --workers 16
+    python batch.py -i "study/*/*.c3d" --operation create_midpoint_marker --params '{"marker1": "M1", "marker2": "M2", "newMarkerName": "MID"}' -t "{dir}/{stem}_mid{ext}"
+    # can specify --skipUpToDate to skip the files whose output is newer than the input and the recipe
+    # and --cacheDir cache/ to only recompute the markers whose inputs changed since the last run (see marker_cache.py)
+    # select the inputs from a catalog (see catalog.py) instead of opening the files, e.g. the trials with gaps in a cluster:
+    python batch.py --catalog catalog.sqlite -i "study/" --gapMarkers "HUM_CL-1,HUM_CL-2,HUM_CL-3" --minGap 1 -r recipe.json -t "processed/{reldir}/{stem}{ext}"
+    or import as module
+
+Requirements:
+    btk
+    numpy
+
+"""
+
+text="batch module"
+
+import glob
+import os
+import time
+import traceback
+
+# Calibration models of the worker process, kept between the files it processes
+_calibrations = {}
+# Marker caches of the worker process (one per cache directory)
+_caches = {}
+
+def find_input_files(inputs, pattern="*.c3d"):
+    """
+    List of (input file, base directory) from directories (searched recursively for pattern) and glob patterns
+    """
+
+    files = []
+    for inputPath in inputs:
+        if os.path.isdir(inputPath):
+            base = inputPath
+            matches = glob.glob(os.path.join(inputPath, "**", pattern), recursive=True)
+        else:
+            # base directory: the part of the pattern before the first wildcard
+            baseParts = []
+            for part in inputPath.split(os.sep):
+                if any([ c in part for c in "*?[" ]):
+                    break
+                baseParts.append(part)
+            base = os.sep.join(baseParts) if len(baseParts) < len(inputPath.split(os.sep)) else os.path.dirname(inputPath)
+            matches = glob.glob(inputPath, recursive=True)
+        files += [ (match, base) for match in sorted(matches) if os.path.isfile(match) ]
+    return files
+
+def output_file_name(inputFile, base, template):
+    directory, name = os.path.split(inputFile)
+    stem, ext = os.path.splitext(name)
+    reldir = os.path.relpath(directory, base) if base else directory
+    outputFile = template.format(dir=directory, reldir=reldir, name=name, stem=stem, ext=ext)
+    return os.path.normpath(outputFile)
+
+def is_up_to_date(inputFile, outputFile, dependencies=()):
+    """
+    True if the output exists and is newer than the input file and all the dependencies (recipe, ...)
+    """
+
+    if not os.path.exists(outputFile):
+        return False
+    outputTime = os.path.getmtime(outputFile)
+    return all([ os.path.getmtime(f) <= outputTime for f in (inputFile,) + tuple(dependencies) if os.path.exists(f) ])
+
+def process_one_file(job):
+    """
+    Worker: run the recipe on one file, never raises
+    Returns a dict (input, output, status "ok"/"error", seconds, timings, error)
+    """
+
+    inputFile, recipe, outputFile, cacheDir, cacheBytes = job
+
+    import io
+    import contextlib
+    from pipeline import process_file
+    from marker_cache import MarkerCache
+
+    start = time.perf_counter()
+    log = io.StringIO()
+    try:
+        outputDirectory = os.path.dirname(outputFile)
+        if outputDirectory:
+            os.makedirs(outputDirectory, exist_ok=True)
+        cache = None
+        if cacheDir is not None:
+            if cacheDir not in _caches:
+                _caches[cacheDir] = MarkerCache(cacheDir, cacheBytes)
+            cache = _caches[cacheDir]
+        with contextlib.redirect_stdout(log): # keep the output of the workers from mixing in the terminal
+            timings = process_file(inputFile, recipe, outputFile, _calibrations, cache)
+        return { "input": inputFile, "output": outputFile, "status": "ok", "seconds": time.perf_counter() - start, "timings": timings, "error": None }
+    except Exception as e:
+        return { "input": inputFile, "output": outputFile, "status": "error", "seconds": time.perf_counter() - start, "timings": [],
+                 "error": "{}: {}\n{}".format(type(e).__name__, e, traceback.format_exc()) }
+
+def run_batch(files, recipe, template, workers=None, skipUpToDate=False, dependencies=(), cacheDir=None, cacheBytes=None):
+    """
+    Run the recipe on all the files (list of (input file, base directory)) with a pool of worker processes
+    With a cacheDir, the workers share the marker cache (see marker_cache.py)
+
+    Returns the list of results (see process_one_file()), with status "skipped" for the files already up to date
+    """
+
+    from concurrent.futures import ProcessPoolExecutor, as_completed
+
+    results = []
+    jobs = []
+    for inputFile, base in files:
+        outputFile = output_file_name(inputFile, base, template)
+        if os.path.abspath(outputFile) == os.path.abspath(inputFile):
+            results.append({ "input": inputFile, "output": outputFile, "status": "error", "seconds": 0.0, "timings": [], "error": "The output file would overwrite the input file" })
+        elif skipUpToDate and is_up_to_date(inputFile, outputFile, dependencies):
+            results.append({ "input": inputFile, "output": outputFile, "status": "skipped", "seconds": 0.0, "timings": [], "error": None })
+        else:
+            jobs.append((inputFile, recipe, outputFile, cacheDir, cacheBytes))
+
+    print("{} files: {} to process, {} skipped".format(len(files), len(jobs), len(results)))
+
+    if workers == 1:
+        for job in jobs:
+            result = process_one_file(job)
+            print("[{}] {} ({:.2f} s)".format(result["status"], result["input"], result["seconds"]))
+            results.append(result)
+        return results
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = { executor.submit(process_one_file, job) : job for job in jobs }
+        for future in as_completed(futures):
+            try:
+                result = future.result()
+            except Exception as e: # the worker process died (crash, out of memory...): the pool is broken for the remaining files too
+                inputFile, recipe, outputFile = futures[future][:3]
+                result = { "input": inputFile, "output": outputFile, "status": "error", "seconds": 0.0, "timings": [],
+                           "error": "The worker process failed: {}: {}".format(type(e).__name__, e) }
+            print("[{}] {} ({:.2f} s)".format(result["status"], result["input"], result["seconds"]))
+            results.append(result)
+
+    return results
+
+def print_summary(results, wallTime):
+    ok = [ r for r in results if r["status"] == "ok" ]
+    errors = [ r for r in results if r["status"] == "error" ]
+    skipped = [ r for r in results if r["status"] == "skipped" ]
+
+    # time per step, summed over all the files
+    steps = {}
+    for r in ok:
+        for name, seconds in r["timings"]:
+            name = name.split("] ")[-1]
+            steps[name] = steps.get(name, 0.0) + seconds
+
+    print("\nSummary:")
+    print("    {} processed, {} failed, {} skipped, {:.2f} s wall time, {:.2f} s processing time".format(
+        len(ok), len(errors), len(skipped), wallTime, sum([ r["seconds"] for r in results ])))
+    for name, seconds in steps.items():
+        print("    {:40s} {:10.2f} s".format(name, seconds))
+    for r in errors:
+        print("\nError processing {}:\n{}".format(r["input"], r["error"]))
+
+
+
+if __name__ == '__main__':
+
+    # If loaded as main, initialise the parser (to start the program with arguments)
+    import argparse
+    import json
+    import sys
+    from proc_log import add_arguments, setup_from_args, finish_from_args, get_profiler
+
+    parser = argparse.ArgumentParser(description='Batch processing of a session/study', formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument ('--input',        '-i', metavar = 'input',     type = str, help = 'Directories or glob patterns of the input files (with --catalog: only the files in these directories)', required=False, nargs='+', default=None)
+    parser.add_argument ('--pattern',      '-p', metavar = 'pattern',   type = str, help = 'Pattern of the files to process in the input directories (default *.c3d)', required=False, default="*.c3d")
+    parser.add_argument ('--template',     '-t', metavar = 'template',  type = str, help = 'Template of the output file names, e.g. "processed/{reldir}/{stem}{ext}"', required=True)
+    parser.add_argument ('--recipe',       '-r', metavar = 'recipe',    type = str, help = 'The recipe: list of operations (.json or .yaml)', required=False, default=None)
+    parser.add_argument ('--operation',    '-op', metavar = 'operation', type = str, help = 'A single operation instead of a recipe', required=False, default=None)
+    parser.add_argument ('--params',       '-pa', metavar = 'params',    type = str, help = 'The parameters of the single operation, as json', required=False, default="{}")
+    parser.add_argument ('--workers',      '-w', metavar = 'workers',   type = int, help = 'Number of worker processes (default: number of cores)', required=False, default=None)
+    parser.add_argument ('--skipUpToDate', '-s',                                    help = 'Skip the files whose output is newer than the input (and the recipe)', required=False, action='store_true', default=False)
+    parser.add_argument ('--cacheDir',     '-c', metavar = 'cacheDir',  type = str, help = 'Directory of the marker cache (default: no cache)', required=False, default=None)
+    parser.add_argument ('--cacheSize',    '-cs', metavar = 'cacheSize', type = float, help = 'Maximum size of the marker cache in MB (default: no limit)', required=False, default=None)
+    parser.add_argument ('--catalog',      '-cat', metavar = 'catalog', type = str, help = 'Select the input files from this catalog (see catalog.py) with the query options below', required=False, default=None)
+    from catalog import add_query_arguments
+    add_query_arguments(parser)
+    add_arguments(parser)
+    args = parser.parse_args()
+    setup_from_args(args)
+
+    from pipeline import load_recipe, recipe_input_files, OPERATIONS
+
+    if args.input is None and args.catalog is None:
+        parser.error("give the --input files or a --catalog")
+
+    dependencies = ()
+    if args.recipe is not None:
+        recipe = load_recipe(args.recipe)
+        dependencies = (args.recipe,)
+    elif args.operation is not None:
+        if args.operation not in OPERATIONS:
+            parser.error("Unknown operation {} (operations: {})".format(args.operation, ", ".join(OPERATIONS)))
+        recipe = [ dict(json.loads(args.params), operation=args.operation) ]
+    else:
+        parser.error("give a --recipe or an --operation")
+
+    # calibration models, calibration files and definitions files are inputs too
+    dependencies += tuple(recipe_input_files(recipe))
+
+    if args.catalog is not None:
+        from catalog import catalog_input_files, query_from_args
+        files = catalog_input_files(args.catalog, args.input or (), **query_from_args(args))
+    else:
+        files = find_input_files(args.input, args.pattern)
+    if not files:
+        sys.exit("No input file found")
+    # the files of the batch would overwrite the same residual file
+    if len(files) > 1 and any([ step.get("residualFile") and "{" not in step["residualFile"] for step in recipe ]):
+        parser.error("with several files, residualFile must be a template such as \"{dir}/{stem}_residuals.txt\" (fields of the output file)")
+
+    start = time.perf_counter()
+    cacheBytes = None if args.cacheSize is None else int(args.cacheSize * 1e6)
+    results = run_batch(files, recipe, args.template, args.workers, args.skipUpToDate, dependencies, args.cacheDir, cacheBytes)
+    print_summary(results, time.perf_counter() - start)
+
+    # the stages of the workers are in their timings
+    if get_profiler() is not None:
+        for r in results:
+            for name, seconds in r["timings"]:
+                get_profiler().add(name.split("] ")[-1], seconds)
+    finish_from_args(args)
+
+    if any([ r["status"] == "error" for r in results ]):
+        sys.exit(1)
@@ -0,0 +1,412 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+
+@author: Martin
+
+Description:
+    Benchmark of the marker tools on synthetic acquisitions, to measure their speed and catch regressions
+
+    The synthetic acquisition has --markers smooth random trajectories and --clusters rigid clusters (4 markers each) moving
+    with known anatomical landmarks, with --gapRatio of the frames of each marker missing (gaps of 10 frames).
+    The landmarks are only in the calibration acquisition (static pose of the first frame, no gaps): create_anatomical_marker reconstructs them in
+    the motion acquisition and the maximum distance to the true positions is reported as a check.
+
+    Each case is run --repeat times on a fresh copy of the acquisition (the copy is not timed), the best time is kept.
+    The peak memory is measured in an extra run with tracemalloc (python and numpy allocations, not the btk ones).
+
+    Cases: read/write of trc (numpy and btk) and c3d (btk, memmap), read of .columns copies (btk acquisition, memmap), setOrigin, create_midpoint_marker, create_projected_marker,
+           copy_marker, remove_marker, rename_markers, create_anatomical_marker,
+           realtime_anatomical (frame by frame, fails if it differs from the offline reconstruction by more than OFFLINE_TOLERANCE)
+
+    The results can be saved as json (--save) and compared with a saved baseline (--baseline): a case slower than
+    --threshold x the baseline is a regression (exit code 1).
+
+Usage:
+    python benchmark.py --markers 50 --frames 10000 --gapRatio 0.05 --save baseline.json
+    python benchmark.py --markers 50 --frames 10000 --gapRatio 0.05 --baseline baseline.json --threshold 1.2
+    # can specify --cases "setOrigin,create_midpoint_marker" to only run some cases
+    or import as module
+
+Requirements:
+    btk
+    numpy
+
+"""
+
+text="benchmark module"
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+
+CLUSTER_SIZE = 4 # markers per rigid cluster
+LANDMARKS_PER_CLUSTER = 2
+CALIBRATION_FRAMES = 10 # frames of the calibration acquisition
+GAP_LENGTH = 10 # frames per gap
+
+######################################################
+# Synthetic data
+######################################################
+
+def rotation_matrices(angles):
+    """
+    (frames, 3, 3) rotation matrices from (frames, 3) rotation vectors (Rodrigues)
+    """
+
+    theta = np.linalg.norm(angles, axis=1)
+    axis = angles / np.where(theta > 0, theta, 1.0)[:, np.newaxis]
+    K = np.zeros((len(angles), 3, 3))
+    K[:, 0, 1], K[:, 0, 2], K[:, 1, 2] = -axis[:, 2], axis[:, 1], -axis[:, 0]
+    K = K - K.transpose(0, 2, 1)
+    s, c = np.sin(theta)[:, np.newaxis, np.newaxis], np.cos(theta)[:, np.newaxis, np.newaxis]
+    return np.eye(3) + s * K + (1 - c) * np.einsum('fij,fjk->fik', K, K)
+
+def smooth_signal(numFrames, dimensions, rate, rng, amplitude):
+    """
+    (frames, dimensions) sum of 3 sines of random frequency (0.1 to 2 Hz) and phase
+    """
+
+    t = np.arange(numFrames)[:, np.newaxis] / rate
+    signal = np.zeros((numFrames, dimensions))
+    for i in range(3):
+        signal += amplitude / (i + 1) * np.sin(2 * np.pi * rng.uniform(0.1, 2.0, dimensions) * t + rng.uniform(0, 2 * np.pi, dimensions))
+    return signal
+
+def add_gaps(data, gapRatio, rng):
+    """
+    Set about gapRatio of the frames of each marker of (frames, markers, 3) to NaN, by gaps of GAP_LENGTH frames
+    """
+
+    numFrames, numMarkers = data.shape[0], data.shape[1]
+    numGaps = int(round(gapRatio * numFrames / GAP_LENGTH))
+    for marker in range(numMarkers):
+        for first in rng.integers(0, max(numFrames - GAP_LENGTH, 1), numGaps):
+            data[first:first + GAP_LENGTH, marker, :] = np.nan
+    return data
+
+def synthetic_dataset(numMarkers=50, numFrames=10000, gapRatio=0.05, numClusters=2, rate=100.0, seed=0):
+    """
+    Synthetic motion and calibration data
+
+    Returns a dict:
+        labels, data (frames, markers, 3) of the motion (NaN in the gaps), rate
+        clusters: list of (cluster markers, landmarks)
+        truth: {landmark : (frames, 3)} true positions of the landmarks in the motion
+        calibrationLabels, calibrationData (CALIBRATION_FRAMES, markers, 3): clusters and landmarks at the first frame, no gaps
+    """
+
+    rng = np.random.default_rng(seed)
+
+    labels = [ "M{}".format(i + 1) for i in range(numMarkers) ]
+    data = rng.uniform(-500, 500, (1, numMarkers, 3)) + smooth_signal(numFrames, numMarkers * 3, rate, rng, 100.0).reshape(numFrames, numMarkers, 3)
+
+    clusters = []
+    truth = {}
+    calibrationLabels = []
+    calibrationData = []
+    clusterData = []
+    for c in range(numClusters):
+        clusterMarkers = [ "CL{}_{}".format(c + 1, i + 1) for i in range(CLUSTER_SIZE) ]
+        landmarks = [ "LM{}_{}".format(c + 1, i + 1) for i in range(LANDMARKS_PER_CLUSTER) ]
+        localMarkers = rng.uniform(-60, 60, (CLUSTER_SIZE, 3))
+        localLandmarks = rng.uniform(-200, 200, (LANDMARKS_PER_CLUSTER, 3))
+
+        # rigid motion: rotation up to ~0.8 rad, translation of 300 mm
+        R = rotation_matrices(smooth_signal(numFrames, 3, rate, rng, 0.4))
+        t = rng.uniform(-500, 500, 3) + smooth_signal(numFrames, 3, rate, rng, 300.0)
+        world = np.einsum('fij,mj->fmi', R, np.concatenate([localMarkers, localLandmarks])) + t[:, np.newaxis, :]
+
+        clusters.append((clusterMarkers, landmarks))
+        clusterData.append(world[:, 0:CLUSTER_SIZE])
+        for i, landmark in enumerate(landmarks):
+            truth[landmark] = world[:, CLUSTER_SIZE + i]
+        calibrationLabels += clusterMarkers + landmarks
+        calibrationData.append(np.repeat(world[0:1], CALIBRATION_FRAMES, axis=0)) # static trial: the pose of the first frame
+        labels += clusterMarkers
+
+    data = np.concatenate([data] + clusterData, axis=1)
+    data = add_gaps(data, gapRatio, rng)
+
+    return { "labels": labels, "data": data, "rate": rate, "clusters": clusters, "truth": truth,
+             "calibrationLabels": calibrationLabels, "calibrationData": np.concatenate(calibrationData, axis=1) }
+
+def dataset_acquisition(dataset):
+    from read_write_trc import array_to_acquisition
+    return array_to_acquisition(dataset["data"], dataset["labels"], dataset["rate"])
+
+def calibration_acquisition(dataset):
+    from read_write_trc import array_to_acquisition
+    return array_to_acquisition(dataset["calibrationData"], dataset["calibrationLabels"], dataset["rate"])
+
+######################################################
+# Cases: name -> (setup(dataset, directory) -> state, run(state) -> check or None)
+######################################################
+
+def landmark_error(acq, dataset):
+    """
+    Maximum distance (mm) between the reconstructed landmarks and their true positions (frames reconstructed only)
+    """
+
+    errors = [0.0]
+    for landmark, truth in dataset["truth"].items():
+        point = acq.GetPoint(landmark)
+        visible = point.GetResiduals()[:, 0] >= 0
+        if visible.any():
+            errors.append(np.linalg.norm(point.GetValues()[visible] - truth[visible], axis=1).max())
+    return float(max(errors))
+
+def build_cases(dataset):
+    """
+    Dict of the benchmark cases: name -> (setup(directory) -> state, run(state) -> check value or None)
+    """
+
+    from convert_c3d_trc import read_c3dtrc, write_c3dtrc
+
+    labels = dataset["labels"]
+
+    def written(extension):
+        # write the acquisition once per directory, the file is the state of the read cases
+        def setup(directory):
+            fileName = os.path.join(directory, "synthetic" + extension)
+            if not os.path.exists(fileName):
+                write_c3dtrc(dataset_acquisition(dataset), fileName)
+            return fileName
+        return setup
+
+    def fresh(directory):
+        return dataset_acquisition(dataset)
+
+    def output(extension):
+        def setup(directory):
+            return dataset_acquisition(dataset), os.path.join(directory, "output" + extension)
+        return setup
+
+    def reader(backend):
+        def run(fileName):
+            read_c3dtrc(fileName, backend)
+        return run
+
+    def writer(backend):
+        def run(state):
+            acq, fileName = state
+            write_c3dtrc(acq, fileName, backend)
+        return run
+
+    def read_memmap(fileName):
+        from read_c3d_memmap import C3DFile
+        C3DFile(fileName).get_points()
+
+    def read_columns_memmap(fileName):
+        from read_write_columns import ColumnsFile
+        ColumnsFile(fileName).get_points()
+
+    def run_setOrigin(acq):
+        from setOrigin import setOrigin
+        setOrigin(acq, labels[0])
+
+    def run_midpoint(acq):
+        from create_midpoint_marker import create_midpoint_marker
+        create_midpoint_marker(acq, argparse.Namespace(marker1=labels[0], marker2=labels[1], newMarkerName="MID"))
+
+    def run_projected(acq):
+        from create_projected_marker import create_projected_marker
+        create_projected_marker(acq, argparse.Namespace(input=None, output=None, marker=labels[0], markerVia=labels[1], axis="y", newMarkerName="PROJ"))
+
+    def run_copy(acq):
+        from copy_marker import copy_marker
+        copy_marker(acq, argparse.Namespace(marker1=labels[0], newMarkerName="COPY"))
+
+    def run_remove(acq):
+        from remove_marker import remove_marker
+        remove_marker(acq, argparse.Namespace(marker=labels[len(labels) // 2]))
+
+    def run_rename(acq):
+        from rename import rename_markers
+        rename_markers(acq, argparse.Namespace(markerListFrom=",".join(labels[0:10]), markerListTo=",".join([ label + "_renamed" for label in labels[0:10] ])))
+
+    def setup_anatomical(directory):
+        return calibration_acquisition(dataset), dataset_acquisition(dataset)
+
+    def run_anatomical(state):
+        from create_anatomical_marker import create_anatomical_marker
+        acqCalibration, acqMotion = state
+        args = argparse.Namespace(calibrationFrame=None, calibrationFrames="0:{}".format(CALIBRATION_FRAMES - 1),
+                                  clusterMarkers=[ ",".join(markers) for markers, landmarks in dataset["clusters"] ],
+                                  clusterWeights=None, anatMarkers=[ ",".join(landmarks) for markers, landmarks in dataset["clusters"] ],
+                                  onlyMissingFrames=False)
+        return landmark_error(create_anatomical_marker(acqCalibration, acqMotion, args), dataset)
+
+    def setup_realtime(directory):
+        # model and offline reconstruction (not timed): the check is the maximum difference of the streamed landmarks
+        from create_anatomical_marker import calibrate_cluster
+        from realtime_anatomical import ModelReconstructor
+        acqCalibration = calibration_acquisition(dataset)
+        model = [ calibrate_cluster(acqCalibration, markers, landmarks, (0, CALIBRATION_FRAMES - 1)) for markers, landmarks in dataset["clusters"] ]
+        reconstructor = ModelReconstructor(model)
+        data = dataset["data"][:, [ labels.index(name) for name in reconstructor.inputMarkers ], :]
+        return reconstructor, data, model
+
+    def run_realtime(state):
+        from realtime_anatomical import measure_latency, offline_difference, OFFLINE_TOLERANCE
+        reconstructor, data, model = state
+        latencies, landmarks = measure_latency(reconstructor, data, 1)
+        difference = offline_difference(dataset_acquisition(dataset), model, landmarks)
+        if difference > OFFLINE_TOLERANCE:
+            raise CheckError("the real time landmarks differ from the offline reconstruction ({:.2e} > {:.0e})".format(difference, OFFLINE_TOLERANCE))
+        return difference
+
+    cases = {
+        "read trc":                 (written(".trc"), reader("numpy")),
+        "read trc (btk)":           (written(".trc"), reader("btk")),
+        "read c3d (btk)":           (written(".c3d"), reader("btk")),
+        "read c3d (memmap)":        (written(".c3d"), read_memmap),
+        "read columns":             (written(".columns"), reader("numpy")),
+        "read columns (memmap)":    (written(".columns"), read_columns_memmap),
+        "write trc":                (output(".trc"), writer("numpy")),
+        "write trc (btk)":          (output(".trc"), writer("btk")),
+        "write c3d (btk)":          (output(".c3d"), writer("btk")),
+        "setOrigin":                (fresh, run_setOrigin),
+        "create_midpoint_marker":   (fresh, run_midpoint),
+        "create_projected_marker":  (fresh, run_projected),
+        "copy_marker":              (fresh, run_copy),
+        "remove_marker":            (fresh, run_remove),
+        "rename_markers":           (fresh, run_rename),
+        "create_anatomical_marker": (setup_anatomical, run_anatomical),
+        "realtime_anatomical":      (setup_realtime, run_realtime),
+    }
+    return cases
+
+######################################################
+# Run and compare
+######################################################
+
+class CheckError(Exception):
+    """The result of a case is wrong (the benchmark fails), not just unavailable (e.g. no btk c3d support)"""
+
+def run_case(setup, run, directory, repeat):
+    """
+    Best time of repeat runs (each one on a new state), peak memory (MB) of one more run, and the check value of the last run
+    """
+
+    times = []
+    for i in range(repeat):
+        state = setup(directory)
+        with contextlib.redirect_stdout(io.StringIO()):
+            start = time.perf_counter()
+            check = run(state)
+            times.append(time.perf_counter() - start)
+
+    state = setup(directory)
+    tracemalloc.start()
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            run(state)
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+    return min(times), peak / 1e6, check
+
+def run_benchmark(dataset, cases=None, repeat=5):
+    """
+    Run the cases (all by default) on the dataset, returns {name : {seconds, framesPerSecond, peakMB, check, error}}
+    """
+
+    numFrames = dataset["data"].shape[0]
+    allCases = build_cases(dataset)
+    if cases is None:
+        cases = list(allCases)
+
+    results = {}
+    with tempfile.TemporaryDirectory() as directory:
+        for name in cases:
+            setup, run = allCases[name]
+            try:
+                seconds, peak, check = run_case(setup, run, directory, repeat)
+                results[name] = { "seconds": seconds, "framesPerSecond": numFrames / seconds if seconds > 0 else None,
+                                  "peakMB": peak, "check": check, "error": None, "failed": False }
+            except Exception as e: # e.g. no btk c3d support: report it and go on with the other cases
+                results[name] = { "seconds": None, "framesPerSecond": None, "peakMB": None, "check": None, "error": "{}: {}".format(type(e).__name__, e),
+                                  "failed": isinstance(e, CheckError) }
+            print_result(name, results[name])
+
+    return results
+
+def print_result(name, result, baseline=None):
+    if result["error"]:
+        print("    {:28s} error: {}".format(name, result["error"]))
+        return
+    line = "    {:28s} {:10.4f} s {:14.0f} frames/s {:10.1f} MB".format(name, result["seconds"], result["framesPerSecond"], result["peakMB"])
+    if result["check"] is not None:
+        line += "   check {:.2e}".format(result["check"])
+    print(line)
+
+def compare(results, baseline, threshold=1.2):
+    """
+    Compare the times with the baseline results, returns the list of regressions (name, seconds, baseline seconds)
+    """
+
+    regressions = []
+    print("\nComparison with the baseline (ratio of the times, > {} is a regression):".format(threshold))
+    for name, result in results.items():
+        reference = baseline.get(name)
+        if result["seconds"] is None or reference is None or not reference.get("seconds"):
+            continue
+        ratio = result["seconds"] / reference["seconds"]
+        flag = "REGRESSION" if ratio > threshold else ""
+        print("    {:28s} {:10.4f} s / {:10.4f} s = {:6.2f} {}".format(name, result["seconds"], reference["seconds"], ratio, flag))
+        if ratio > threshold:
+            regressions.append((name, result["seconds"], reference["seconds"]))
+    return regressions
+
+
+
+if __name__ == '__main__':
+
+    # If loaded as main, initialise the parser (to start the program with arguments)
+    import sys
+
+    parser = argparse.ArgumentParser(description='Benchmark of the marker tools on synthetic acquisitions', formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument ('--markers',   '-m', metavar = 'markers',   type = int,   help = 'Number of free markers (default 50)',                  required=False, default=50)
+    parser.add_argument ('--clusters',  '-c', metavar = 'clusters',  type = int,   help = 'Number of rigid clusters of 4 markers (default 2)',     required=False, default=2)
+    parser.add_argument ('--frames',    '-f', metavar = 'frames',    type = int,   help = 'Number of frames (default 10000)',                     required=False, default=10000)
+    parser.add_argument ('--gapRatio',  '-g', metavar = 'gapRatio',  type = float, help = 'Ratio of missing frames per marker (default 0.05)',     required=False, default=0.05)
+    parser.add_argument ('--repeat',    '-r', metavar = 'repeat',    type = int,   help = 'Number of runs of each case, the best is kept (default 5)', required=False, default=5)
+    parser.add_argument ('--seed',      '-s', metavar = 'seed',      type = int,   help = 'Seed of the synthetic data (default 0)',               required=False, default=0)
+    parser.add_argument ('--cases',           metavar = 'cases',     type = str,   help = 'Only run these cases "setOrigin,copy_marker" (default: all)', required=False, default=None)
+    parser.add_argument ('--save',            metavar = 'save',      type = str,   help = 'Save the results as json',                            required=False, default=None)
+    parser.add_argument ('--baseline',  '-b', metavar = 'baseline',  type = str,   help = 'Compare with the results saved in this json',          required=False, default=None)
+    parser.add_argument ('--threshold', '-t', metavar = 'threshold', type = float, help = 'Time ratio above which a case is a regression (default 1.2)', required=False, default=1.2)
+    args = parser.parse_args()
+
+    config = { "markers": args.markers, "clusters": args.clusters, "frames": args.frames, "gapRatio": args.gapRatio, "seed": args.seed }
+    cases = args.cases.split(",") if args.cases else None
+
+    print("Synthetic acquisition: {markers} markers, {clusters} clusters, {frames} frames, gap ratio {gapRatio}".format(**config))
+    dataset = synthetic_dataset(args.markers, args.frames, args.gapRatio, args.clusters, seed=args.seed)
+    results = run_benchmark(dataset, cases, args.repeat)
+    failed = [ name for name, result in results.items() if result.get("failed") ]
+
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump({ "config": config, "results": results }, f, indent=4)
+        print("Saved the results as {}".format(args.save))
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if baseline.get("config") != config:
+            print("Warning: the baseline was run with {}".format(baseline.get("config")))
+        if compare(results, baseline["results"], args.threshold):
+            sys.exit(1)
+
+    if failed:
+        sys.exit("Failed checks: {}".format(", ".join(failed)))
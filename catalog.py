@@ -0,0 +1,316 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+
+@author: Martin
+
+Description:
+    SQLite catalog of the trials of a session/study, to select files by their markers, gaps or frame rate without opening them
+
+    Scanning a directory tree reads every new or modified file (modification time and size) in parallel with the usual reader
+    (memory mapped for the c3d files) and records in the catalog:
+        files:   path, mtime, size, rate, first/last frame, number of frames, units (or the error if the file could not be read)
+        markers: path, label, number of missing frames, number of gaps, longest gap (frames)
+    The files that did not change are not read again, the files that were removed are removed from the catalog.
+
+    The query returns the files with all the given markers, a given rate, a minimum number of frames, and/or whose longest gap
+    over some markers (e.g. a cluster) is at least minGap or at most maxGap frames. batch.py uses it with --catalog.
+
+Usage:
+    python catalog.py -c catalog.sqlite --scan "study/" --pattern "*.c3d,*.trc" --workers 8
+    python catalog.py -c catalog.sqlite --markers "EPI_MED,EPI_LAT" --rate 100
+    python catalog.py -c catalog.sqlite --gapMarkers "HUM_CL-1,HUM_CL-2,HUM_CL-3" --minGap 1     # trials with gaps in the cluster
+    python catalog.py -c catalog.sqlite --gapMarkers "HUM_CL-1,HUM_CL-2,HUM_CL-3" --maxGap 10    # no gap longer than 10 frames
+    or import as module:
+
+    files = query_catalog("catalog.sqlite", markers=["EPI_MED"], rate=100, roots=["study/S01"])
+
+Requirements:
+    btk
+    numpy
+
+"""
+
+text="catalog module"
+
+import os
+import sqlite3
+import time
+
+import numpy as np
+
+from proc_log import get_logger
+
+log = get_logger("catalog")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    path TEXT PRIMARY KEY,
+    mtime INTEGER,
+    size INTEGER,
+    rate REAL,
+    firstFrame INTEGER,
+    lastFrame INTEGER,
+    numFrames INTEGER,
+    units TEXT,
+    error TEXT,
+    indexed REAL
+);
+CREATE TABLE IF NOT EXISTS markers (
+    path TEXT,
+    label TEXT,
+    position INTEGER,
+    missingFrames INTEGER,
+    gaps INTEGER,
+    longestGap INTEGER,
+    PRIMARY KEY (path, label)
+);
+CREATE INDEX IF NOT EXISTS markers_label ON markers (label);
+"""
+
+def connect(catalogFile):
+    connection = sqlite3.connect(catalogFile)
+    connection.executescript(SCHEMA)
+    return connection
+
+def longest_gap(mask):
+    """
+    Length of the longest run of consecutive True values in a boolean array
+    """
+
+    edges = np.diff(np.concatenate([[0], mask.astype(np.int8), [0]]))
+    starts = np.flatnonzero(edges == 1)
+    ends = np.flatnonzero(edges == -1)
+    return int((ends - starts).max()) if len(starts) else 0
+
+######################################################
+# Scan
+######################################################
+
+def index_file(fileName):
+    """
+    Worker: the record of one file (dict, with the list of (label, position, missing frames, gaps, longest gap)), never raises
+    """
+
+    from convert_c3d_trc import read_c3dtrc
+    from create_anatomical_marker import get_occlusion_masks
+
+    stat = os.stat(fileName)
+    record = { "path": os.path.abspath(fileName), "mtime": stat.st_mtime_ns, "size": stat.st_size, "rate": None, "firstFrame": None,
+               "lastFrame": None, "numFrames": None, "units": None, "error": None, "markers": [] }
+    try:
+        acq = read_c3dtrc(fileName, "memmap")
+        number_steps = acq.GetLastFrame() - acq.GetFirstFrame() +1
+        record.update(rate=float(acq.GetPointFrequency()), firstFrame=int(acq.GetFirstFrame()), lastFrame=int(acq.GetLastFrame()),
+                      numFrames=int(number_steps), units=acq.GetPointUnit())
+        numPoints = acq.GetPointNumber()
+        labels = [ acq.GetPoint(i).GetLabel() for i in range(numPoints) ]
+        # all the markers at once (frames, markers): one read of the point block of a memory mapped file
+        if numPoints == 0:
+            values, residuals = np.empty((number_steps, 0, 3)), np.empty((number_steps, 0))
+        elif hasattr(acq, "get_points"):
+            values, residuals = acq.get_points(missingAsNan=False)
+        else:
+            values = np.stack([ np.asarray(acq.GetPoint(i).GetValues()[0:number_steps,:], dtype=float) for i in range(numPoints) ], axis=1)
+            residuals = np.stack([ np.asarray(acq.GetPoint(i).GetResiduals()[0:number_steps,0], dtype=float) for i in range(numPoints) ], axis=1)
+        masks = get_occlusion_masks(values[0:number_steps].reshape(number_steps, numPoints, 3), residuals[0:number_steps].reshape(number_steps, numPoints))
+        missing = np.count_nonzero(masks, axis=0)
+        gaps = np.count_nonzero(np.diff(masks.astype(np.int8), axis=0, prepend=0) == 1, axis=0)
+        for i, label in enumerate(labels):
+            record["markers"].append((label, i, int(missing[i]), int(gaps[i]), longest_gap(masks[:, i])))
+    except Exception as e:
+        record["error"] = "{}: {}".format(type(e).__name__, e)
+    return record
+
+def store_record(connection, record):
+    connection.execute("DELETE FROM markers WHERE path = ?", (record["path"],))
+    connection.execute("INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                       (record["path"], record["mtime"], record["size"], record["rate"], record["firstFrame"], record["lastFrame"],
+                        record["numFrames"], record["units"], record["error"], time.time()))
+    connection.executemany("INSERT OR REPLACE INTO markers VALUES (?, ?, ?, ?, ?, ?)",
+                           [ (record["path"],) + tuple(marker) for marker in record["markers"] ])
+
+def index_files(files, workers=None):
+    """
+    Yields the records of the files, read by a pool of worker processes
+    """
+
+    from concurrent.futures import ProcessPoolExecutor
+
+    if workers == 1 or len(files) <= 1:
+        for fileName in files:
+            yield index_file(fileName)
+        return
+
+    chunksize = max(1, min(64, len(files) // (4 * (workers or os.cpu_count() or 1))))
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        for record in executor.map(index_file, files, chunksize=chunksize):
+            yield record
+
+def is_under(path, roots):
+    return any([ path == root or path.startswith(root.rstrip(os.sep) + os.sep) for root in roots ])
+
+def scan(catalogFile, inputs, pattern="*.c3d", workers=None):
+    """
+    Add the new and modified files of the inputs (directories searched recursively for pattern "*.c3d,*.trc", or glob patterns)
+    to the catalog, and remove the files that do not exist anymore in the input directories
+
+    Returns the number of files (found, indexed, removed, errors)
+    """
+
+    from batch import find_input_files
+
+    files = []
+    for filePattern in pattern.split(","):
+        files += [ os.path.abspath(inputFile) for inputFile, base in find_input_files(inputs, filePattern.strip()) ]
+    files = sorted(set(files))
+
+    connection = connect(catalogFile)
+    known = { path : (mtime, size) for path, mtime, size in connection.execute("SELECT path, mtime, size FROM files") }
+
+    toIndex = []
+    for fileName in files:
+        stat = os.stat(fileName)
+        if known.get(fileName) != (stat.st_mtime_ns, stat.st_size):
+            toIndex.append(fileName)
+    log.info("{} files found, {} new or modified".format(len(files), len(toIndex)))
+
+    errors = 0
+    with connection:
+        for record in index_files(toIndex, workers):
+            store_record(connection, record)
+            if record["error"]:
+                errors += 1
+                log.warning("Error reading {}: {}".format(record["path"], record["error"]))
+            else:
+                log.debug("Indexed {}".format(record["path"]))
+
+        # files removed from the scanned directories
+        roots = [ os.path.abspath(inputPath) for inputPath in inputs if os.path.isdir(inputPath) ]
+        removed = [ path for path in known if is_under(path, roots) and not os.path.exists(path) ]
+        for path in removed:
+            connection.execute("DELETE FROM files WHERE path = ?", (path,))
+            connection.execute("DELETE FROM markers WHERE path = ?", (path,))
+    connection.close()
+
+    return len(files), len(toIndex), len(removed), errors
+
+######################################################
+# Query
+######################################################
+
+def query_catalog(catalogFile, markers=(), rate=None, minFrames=None, gapMarkers=(), minGap=None, maxGap=None, roots=()):
+    """
+    Paths of the files of the catalog (readable, sorted) that match all the conditions:
+        markers     all these markers are in the file
+        rate        point rate (Hz)
+        minFrames   at least this number of frames
+        gapMarkers  markers (e.g. a cluster) that must be in the file, and whose longest gap (the longest of these markers)
+                    is at least minGap and/or at most maxGap frames
+        roots       only the files in these directories
+    """
+
+    conditions = [ "f.error IS NULL" ]
+    params = []
+    for label in list(markers) + [ label for label in gapMarkers if label not in markers ]:
+        conditions.append("EXISTS (SELECT 1 FROM markers m WHERE m.path = f.path AND m.label = ?)")
+        params.append(label)
+    if rate is not None:
+        conditions.append("abs(f.rate - ?) < 1e-6")
+        params.append(float(rate))
+    if minFrames is not None:
+        conditions.append("f.numFrames >= ?")
+        params.append(int(minFrames))
+    if gapMarkers and (minGap is not None or maxGap is not None):
+        longest = "(SELECT max(m.longestGap) FROM markers m WHERE m.path = f.path AND m.label IN ({}))".format(",".join(["?"] * len(gapMarkers)))
+        for limit, operator in ((minGap, ">="), (maxGap, "<=")):
+            if limit is not None:
+                conditions.append("{} {} ?".format(longest, operator))
+                params += list(gapMarkers) + [int(limit)]
+    if roots:
+        rootConditions = []
+        for root in roots:
+            root = os.path.abspath(root).rstrip(os.sep) + os.sep
+            rootConditions.append("substr(f.path, 1, ?) = ?")
+            params += [len(root), root]
+        conditions.append("({})".format(" OR ".join(rootConditions)))
+
+    connection = connect(catalogFile)
+    try:
+        rows = connection.execute("SELECT f.path FROM files f WHERE {} ORDER BY f.path".format(" AND ".join(conditions)), params).fetchall()
+    finally:
+        connection.close()
+    return [ path for (path,) in rows ]
+
+def catalog_input_files(catalogFile, roots=(), **query):
+    """
+    The files of query_catalog() as a list of (input file, base directory), as batch.find_input_files()
+    The base directory is the root the file is in, or the common directory of all the files without roots
+    """
+
+    files = query_catalog(catalogFile, roots=roots, **query)
+    roots = [ os.path.abspath(root) for root in roots ]
+    common = os.path.commonpath([ os.path.dirname(path) for path in files ]) if files else ""
+    inputFiles = []
+    for path in files:
+        base = [ root for root in roots if is_under(path, [root]) ]
+        inputFiles.append((path, base[0] if base else common))
+    return inputFiles
+
+def file_markers(catalogFile, path):
+    """
+    [(label, missing frames, gaps, longest gap)] of a file of the catalog, in the order of the file
+    """
+
+    connection = connect(catalogFile)
+    try:
+        return connection.execute("SELECT label, missingFrames, gaps, longestGap FROM markers WHERE path = ? ORDER BY position",
+                                  (os.path.abspath(path),)).fetchall()
+    finally:
+        connection.close()
+
+def query_from_args(args):
+    """
+    Keyword arguments of query_catalog() from the command line arguments (--markers, --rate, --minFrames, --gapMarkers, --minGap, --maxGap)
+    """
+
+    from marker_labels import split_patterns
+
+    return { "markers": split_patterns(args.markers) if args.markers else [], "rate": args.rate, "minFrames": args.minFrames,
+             "gapMarkers": split_patterns(args.gapMarkers) if args.gapMarkers else [], "minGap": args.minGap, "maxGap": args.maxGap }
+
+def add_query_arguments(parser):
+    parser.add_argument ('--markers',    '-m',  metavar = 'markers',    type = str,   help = 'Files with all these markers "M1,M2"', required=False, default=None)
+    parser.add_argument ('--rate',             metavar = 'rate',       type = float, help = 'Files with this point rate (Hz)',      required=False, default=None)
+    parser.add_argument ('--minFrames',        metavar = 'minFrames',  type = int,   help = 'Files with at least this number of frames', required=False, default=None)
+    parser.add_argument ('--gapMarkers', '-g',  metavar = 'gapMarkers', type = str,   help = 'Markers whose longest gap is checked by --minGap/--maxGap "M1,M2"', required=False, default=None)
+    parser.add_argument ('--minGap',           metavar = 'minGap',     type = int,   help = 'Files where the longest gap of --gapMarkers is at least minGap frames (1: any gap)', required=False, default=None)
+    parser.add_argument ('--maxGap',           metavar = 'maxGap',     type = int,   help = 'Files where the longest gap of --gapMarkers is at most maxGap frames (0: no gap)', required=False, default=None)
+
+
+
+if __name__ == '__main__':
+
+    # If loaded as main, initialise the parser (to start the program with arguments)
+    import argparse
+    from proc_log import add_arguments, setup_from_args, finish_from_args
+
+    parser = argparse.ArgumentParser(description='Catalog of the trials of a study', formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument ('--catalog', '-c', metavar = 'catalog', type = str, help = 'The catalog file (.sqlite)', required=True)
+    parser.add_argument ('--scan',    '-s', metavar = 'scan',    type = str, help = 'Add the new/modified files of these directories or glob patterns to the catalog', required=False, nargs='+', default=None)
+    parser.add_argument ('--pattern', '-p', metavar = 'pattern', type = str, help = 'Patterns of the files in the scanned directories (default "*.c3d,*.trc")', required=False, default="*.c3d,*.trc")
+    parser.add_argument ('--workers', '-w', metavar = 'workers', type = int, help = 'Number of worker processes (default: number of cores)', required=False, default=None)
+    parser.add_argument ('--roots',   '-r', metavar = 'roots',   type = str, help = 'Only the files in these directories', required=False, nargs='+', default=())
+    add_query_arguments(parser)
+    add_arguments(parser)
+    args = parser.parse_args()
+    setup_from_args(args)
+
+    if args.scan:
+        start = time.perf_counter()
+        found, indexed, removed, errors = scan(args.catalog, args.scan, args.pattern, args.workers)
+        print("{} files, {} indexed, {} removed, {} errors ({:.2f} s)".format(found, indexed, removed, errors, time.perf_counter() - start))
+    else:
+        for path in query_catalog(args.catalog, roots=args.roots, **query_from_args(args)):
+            print(path)
+    finish_from_args(args)
@@ -6,14 +6,25 @@
 
 Description:
     use Btk to read/write c3d and trc files
+    trc files are read/written with numpy by default (read_write_trc module, faster), use backend="btk" to go through btk
+    .columns directories (read_write_columns module) are a columnar copy of the markers: memory mapped per-marker arrays,
+    read without parsing (backend="memmap" gives a read only acquisition that only reads the markers asked)
+    With columnCache="cache/", a .c3d/.trc file is converted once into the cache and read from its .columns copy afterwards
+    (converted again if the file changed)
 
 
 Usage:
-    python convert_c3d_trc.py -i inputFile.c3d/trc -o outputFile.c3d/trc
+    python convert_c3d_trc.py -i inputFile.c3d/trc/columns -o outputFile.c3d/trc/columns
+    # can specify --btkTrc to read/write the trc files with btk instead of numpy
+    # export as a columnar copy (--float32 to store the markers as float32):
+    python convert_c3d_trc.py -i inputFile.c3d -o outputFile.columns --float32
+    # read through a cache of columnar copies (the first read converts the file, the next ones are memory mapped):
+    python convert_c3d_trc.py -i inputFile.c3d -o outputFile.trc --columnCache cache/
     or import as module
 
 Requirements:
     btk
+    numpy
 
 """
 
@@ -21,24 +32,68 @@ text="convert_c3d_trc module"
 
 import btk
 
-def read_c3dtrc(inputFile):
+from proc_log import get_logger, profile_stage
+from read_write_columns import is_columns
+
+log = get_logger("convert_c3d_trc")
+
+def is_native_trc(filename, backend):
+    return backend in ("numpy", "memmap") and filename.lower().endswith(".trc")
+
+def read_c3dtrc(inputFile, backend="numpy", columnCache=None):
+    if columnCache is not None and not is_columns(inputFile):
+        from read_write_columns import cached_columns
+        try:
+            inputFile = cached_columns(inputFile, columnCache)
+        except Exception as e:
+            raise IOError("Error converting {} to columns in {}: {}".format(inputFile, columnCache, e))
+    if is_columns(inputFile):
+        from read_write_columns import ColumnsAcquisition, read_columns_acquisition
+        try:
+            return ColumnsAcquisition(inputFile) if backend == "memmap" else read_columns_acquisition(inputFile)
+        except Exception as e:
+            raise IOError("Error loading the columns {}: {}".format(inputFile, e))
+    if backend == "memmap" and inputFile.lower().endswith(".c3d"):
+        from read_c3d_memmap import C3DAcquisition
+        try:
+            return C3DAcquisition(inputFile)
+        except Exception as e:
+            raise IOError("Error loading the c3d file {}: {}".format(inputFile, e))
+    if is_native_trc(inputFile, backend):
+        from read_write_trc import read_trc_acquisition
+        try:
+            return read_trc_acquisition(inputFile)
+        except Exception as e:
+            raise IOError("Error loading the trc file {}: {}".format(inputFile, e))
     try:
         reader = btk.btkAcquisitionFileReader() # build a btk reader object
         reader.SetFilename(inputFile) # set a filename to the reader
         reader.Update()
         acq = reader.GetOutput() # acq is the btk aquisition object
-    except:
-        print("Error loading btk reader (input file probably wrong)")
+    except Exception as e:
+        raise IOError("Error loading btk reader (input file {} probably wrong): {}".format(inputFile, e))
     return acq
 
-def write_c3dtrc(acq,outputFile):
+def write_c3dtrc(acq,outputFile,backend="numpy",float32=False):
+    if is_columns(outputFile):
+        from read_write_columns import write_columns
+        try:
+            return write_columns(acq, outputFile, float32)
+        except Exception as e:
+            raise IOError("Error writting the columns {}: {}".format(outputFile, e))
+    if is_native_trc(outputFile, backend):
+        from read_write_trc import write_trc_acquisition
+        try:
+            return write_trc_acquisition(acq, outputFile)
+        except Exception as e:
+            raise IOError("Error writting the trc file {}: {}".format(outputFile, e))
     try:
         writer = btk.btkAcquisitionFileWriter()
         writer.SetInput(acq)
         writer.SetFilename(outputFile)
         writer.Update()
-    except:
-        print("Error writting (did you specify an output file?")
+    except Exception as e:
+        raise IOError("Error writting {} (did you specify an output file?): {}".format(outputFile, e))
 
 
 
@@ -46,14 +101,33 @@ if __name__ == "__main__":
 
     # If loaded as main, initialise the parser (to start the program with arguments)
     import argparse
+    from proc_log import add_arguments, setup_from_args, finish_from_args
 
     parser = argparse.ArgumentParser(description='setOrigin', formatter_class=argparse.RawTextHelpFormatter)
-    parser.add_argument ('--input',  '-i',  metavar = 'input',  type = str, help = 'The input file to load (.c3d or .trc)',   required=True)
-    parser.add_argument ('--output', '-o',  metavar = 'output', type = str, help = 'The output file to write (.c3d or .trc)', required=True)
+    parser.add_argument ('--input',  '-i',  metavar = 'input',  type = str, help = 'The input file to load (.c3d, .trc or .columns)',   required=True)
+    parser.add_argument ('--output', '-o',  metavar = 'output', type = str, help = 'The output file to write (.c3d, .trc or .columns)', required=True)
+    parser.add_argument ('--btkTrc', '-b',                                  help = 'Read/write the trc files with btk instead of numpy', required=False, action='store_true', default=False)
+    parser.add_argument ('--float32', '-f',                                 help = 'Store the markers as float32 in a .columns output', required=False, action='store_true', default=False)
+    parser.add_argument ('--columnCache', '-cc', metavar = 'columnCache', type = str, help = 'Read the input through a cache of columnar copies in this directory', required=False, default=None)
+    add_arguments(parser)
     args = parser.parse_args()
+    setup_from_args(args)
 
-    # Read the input file
-    acq = read_c3dtrc(args.input)
+    import sys
 
-    # Save the output file
-    write_c3dtrc(acq,args.output)
+    try:
+        # Read the input file
+        backend = "btk" if args.btkTrc else "numpy"
+        log.info("Loading the file {}".format(args.input))
+        with profile_stage("read") as stage:
+            acq = read_c3dtrc(args.input, backend, args.columnCache)
+            stage["frames"] = acq.GetPointFrameNumber()
+
+        # Save the output file
+        log.info("Saving the file as {}".format(args.output))
+        with profile_stage("write", frames=acq.GetPointFrameNumber()):
+            write_c3dtrc(acq,args.output,backend,args.float32)
+    except IOError as e:
+        sys.exit(str(e))
+
+    finish_from_args(args)
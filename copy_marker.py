@@ -20,61 +20,13 @@ Requirements:
 text="copy_marker module"
 
 def copy_marker(acq,args):
-    
-    import numpy as np
-
-    # Create an object (point) for each marker
-    point1 = acq.GetPoint(args.marker1)
-    #point2 = acq.GetPoint(args.newMarkerName)
-
-    ######################################################
-    # Add the array as a new point
-    ######################################################
-
-    number_steps = acq.GetLastFrame() - acq.GetFirstFrame() +1
-    newpoint = btk.btkPoint(number_steps) # create an empty new point object
-    newpoint.SetLabel(args.newMarkerName) # set newPoint as label
-    newpoint.SetValues(point1.GetValues()[:]) # set the value
-    acq.AppendPoint(newpoint) # append the new point into the acquisition object
-    
-    return acq
-
-    """
-    ######################################################
-    # Loop
-    ######################################################
 
-    # For each frame, get the xyz of point1
-    ## point1.GetValues()[0,0] # get the first row, first column (frame 0, x coordinate)
-    ## point1.GetValues()[0,1] # get the first row, second column (frame 0, y coordinate)
-    ## etc...
-    # and save the values of interest to create a new marker
-
-    ## create a 3 columns numpy array
-    try:       
-        number_steps = acq.GetLastFrame() - acq.GetFirstFrame() +1
-        newpointStructure = (number_steps,3)
-        newValue = np.ones(newpointStructure) # identity numpy array with 3 colum and PointFrameNumber rows.
-        newValue[:] = np.nan # fill with NaNs to make any mistake obvious
-    except:
-        print("Could not create empty array")
+    from create_virtual_markers import create_virtual_markers
 
-    i = 0
-    while i < number_steps:
-        point1_X = point1.GetValues()[i,0]
-        point1_Y = point1.GetValues()[i,1]
-        point1_Z = point1.GetValues()[i,2]
-        
-        point2_X = point2.GetValues()[i,0]
-        point2_Y = point2.GetValues()[i,1]
-        point2_Z = point2.GetValues()[i,2]
-        # Add the values to a numpy array, we will append it to the aquisition once we have all the values (after this loop)
-        newValue[i,0] = (float(point1_X) + float(point2_X)) / 2.0 # X value at this step
-        newValue[i,1] = (float(point1_Y) + float(point2_Y)) / 2.0 # Y value at this step
-        newValue[i,2] = (float(point1_Z) + float(point2_Z)) / 2.0 # Z value at this step
+    # Copy of the whole array of the marker under a new name
+    definition = { "name": args.newMarkerName, "type": "copy", "marker": args.marker1 }
 
-        i+=1
-    """
+    return create_virtual_markers(acq, [definition])
 
 
 
@@ -82,6 +34,9 @@ if __name__ == '__main__':
 
     # If loaded as main, initialise the parser (to start the program with arguments)
     import argparse
+    from proc_log import add_arguments, setup_from_args, finish_from_args, get_logger, profile_stage
+
+    log = get_logger("copy_marker")
 
     parser = argparse.ArgumentParser(description='Create midpoint marker', formatter_class=argparse.RawTextHelpFormatter)
 
@@ -90,7 +45,9 @@ if __name__ == '__main__':
     parser.add_argument ('--newMarkerName', '-nm',  metavar = 'newMarkerName', type = str, help = 'The name of new marker that will be created', required=True)
     parser.add_argument ('--output',        '-o',   metavar = 'output',        type = str, help = 'The output file to write (.c3d or .trc)',     required=True)
     
+    add_arguments(parser)
     args = parser.parse_args()
+    setup_from_args(args)
 
     # If all the arguments have been provided, load the file with btk then start the function
 
@@ -99,12 +56,13 @@ if __name__ == '__main__':
     ######################################################
     import sys
     import btk
-    print("Loading the file {}".format(args.input))
+    log.info("Loading the file {}".format(args.input))
     try:
-        reader = btk.btkAcquisitionFileReader() # build a btk reader object
-        reader.SetFilename(args.input) # set a filename to the reader
-        reader.Update()
-        acq = reader.GetOutput() # acq is the btk aquisition object
+        with profile_stage("read"):
+            reader = btk.btkAcquisitionFileReader() # build a btk reader object
+            reader.SetFilename(args.input) # set a filename to the reader
+            reader.Update()
+            acq = reader.GetOutput() # acq is the btk aquisition object
     except:
         sys.exit("Error reading the file, exiting")
 
@@ -116,12 +74,14 @@ if __name__ == '__main__':
     ######################################################
     # Save the file
     ######################################################
-    print("Saving the file as {}".format(args.output))
+    log.info("Saving the file as {}".format(args.output))
     try:
-        writer = btk.btkAcquisitionFileWriter()
-        writer.SetInput(acq_modified)
-        writer.SetFilename(args.output)
-        writer.Update()
+        with profile_stage("write"):
+            writer = btk.btkAcquisitionFileWriter()
+            writer.SetInput(acq_modified)
+            writer.SetFilename(args.output)
+            writer.Update()
     except:
-        print("Error saving the file")
+        log.error("Error saving the file")
 
+    finish_from_args(args)
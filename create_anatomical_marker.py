@@ -11,7 +11,15 @@ Description:
 
 Usage:
     python3 create_anatomical_marker.py --calibrationFile "test.trc" --calibrationFrame 0 --clusterMarkers "HUM_CL-SupAnt","HUM_CL-SupPost","HUM_CL-InfAnt" --anatMarkerName "EPI_MED" --motionFile "test.trc" --newMarkerName "NewMarkerCustomName" --outputFile "myOutputFile.trc"
-    # can specify --onlyMissingFrames to keep existing frames if only some parts are missing and need reconstructing
+    # can specify --onlyMissingFrames to keep existing frames if only some parts are missing and need reconstructing (gaps: values at 0, NaN or btk residual < 0)
+    # or save a reusable calibration model once (--calibrationFrames "first:last" averages the calibration frames, several anatomical markers can be given):
+    python3 create_anatomical_marker.py --calibrationFile "static.c3d" --calibrationFrames 0:99 --clusterMarkers "HUM_CL-SupAnt","HUM_CL-SupPost","HUM_CL-InfAnt" --anatMarkers "EPI_MED","EPI_LAT" --saveModel "humerus.json"
+    # and apply it to any number of motion files without reading the calibration file again:
+    python3 create_anatomical_marker.py --model "humerus.json" --motionFile "trial1.c3d" "trial2.c3d" --outputFile "trial1_out.c3d" "trial2_out.c3d"
+    # several anatomical markers and clusters in one pass: repeat --clusterMarkers with their --anatMarkers "anatMarker:newMarkerName,..." (same order)
+    python3 create_anatomical_marker.py --calibrationFile "static.c3d" --calibrationFrame 0 --clusterMarkers "HUM_CL-SupAnt","HUM_CL-SupPost","HUM_CL-InfAnt" --anatMarkers "EPI_MED:EPI_MED_V","EPI_LAT:EPI_LAT_V" --clusterMarkers "SCAP_CL-1","SCAP_CL-2","SCAP_CL-3" --anatMarkers "AA:AA_V","TS:TS_V" --motionFile "test.c3d" --outputFile "myOutputFile.c3d"
+    # --clusterMarkers accepts 3 or more markers, the fit uses the ones visible at each frame (at least 3)
+    # can specify --clusterWeights 1,1,0.5,... to weight the markers in the fit, and --residualFile to save the per-frame RMS residual of the fit
     or import as module
 
 Requirements:
@@ -19,276 +27,545 @@ Requirements:
     numpy
 
 To do:
-    [] in the calibration file, calculate the average of the positions instead of just one frame
-    [] allow to define 4 or more markers instead of 3 for the cluster (*args/**kwargs)
-    [] optimize for real time processing
+    [x] in the calibration file, calculate the average of the positions instead of just one frame
+    [x] allow to define 4 or more markers instead of 3 for the cluster (*args/**kwargs)
+    [x] optimize for real time processing (see realtime_anatomical.py)
 
 """
 
 text="create_anatomical_marker module"
 
-def create_anatomical_marker(acqCalibration,acqMotion,args):
+from proc_log import get_logger, profile_stage
+
+log = get_logger("create_anatomical_marker")
+
+def rigid_transform_3D(A, B, weights=None):
+    """
+    Batched rigid transform: find, for all the frames at once, the rotation R and translation t such that B[f] = R[f]*A + t[f]
+    The fit is a weighted least squares over the markers visible in each frame (NaN in B = marker not visible)
+
+    A: (markers, 3) array, the cluster in the calibration file
+    B: (frames, markers, 3) array, the cluster at each frame of the motion file
+    weights: (markers,) array, weight of each marker in the fit (all ones by default)
+
+    Returns R (frames, 3, 3), t (frames, 3) and the RMS residual of the fit (frames,).
+    Frames with less than 3 visible markers give NaN.
+    """
+
+    # "Least-Squares Fitting of Two 3-D Point Sets", Arun, K. S. and Huang, T. S. and Blostein, S. D, IEEE Transactions on Pattern Analysis and Machine Intelligence, Volume 9 Issue 5, May 1987
+    # "A Method for Registration of 3-D Shapes" by Besl and McKay, 1992.
+    # https://github.com/nghiaho12/rigid_transform_3D/
 
     import numpy as np
 
-    # Tidying up some variables
-    calibrationFrame = args.calibrationFrame
-    clusterMarkersNamesList = args.clusterMarkers.split(",") # create a list out of the clusterMarkerNames string
-    
-    print("\nCluster markers name list is {}".format(clusterMarkersNamesList))
-    print("Anatomical marker name is {}\n".format(args.anatMarkerName))
+    A = np.asarray(A, dtype=float)
+    B = np.asarray(B, dtype=float)
 
+    if A.ndim != 2 or A.shape[1] != 3 or A.shape[0] < 3:
+        raise Exception("matrix A is not Nx3 with N >= 3, it is {}".format(A.shape))
+    if B.ndim != 3 or B.shape[1:] != A.shape:
+        raise Exception("matrix B is not (frames)x{}x3, it is {}".format(A.shape[0], B.shape))
 
-    def rigid_transform_3D(A, B):
-    
-        # "Least-Squares Fitting of Two 3-D Point Sets", Arun, K. S. and Huang, T. S. and Blostein, S. D, IEEE Transactions on Pattern Analysis and Machine Intelligence, Volume 9 Issue 5, May 1987
-        # "A Method for Registration of 3-D Shapes" by Besl and McKay, 1992.
-        # https://github.com/nghiaho12/rigid_transform_3D/
+    if weights is None:
+        weights = np.ones(A.shape[0])
+    weights = np.asarray(weights, dtype=float)
+    if weights.shape != (A.shape[0],) or (weights < 0).any():
+        raise Exception("weights must be {} positive values, got {}".format(A.shape[0], weights))
 
-        assert len(A) == len(B)
+    number_frames = B.shape[0]
 
-        num_rows, num_cols = A.shape;
+    # weight of each marker at each frame, 0 when the marker is not visible
+    visible = np.isfinite(B).all(axis=2)                # (frames, markers)
+    W = np.where(visible, weights, 0.0)                 # (frames, markers)
+    sum_W = W.sum(axis=1)                               # (frames,)
+    valid = (np.count_nonzero(W, axis=1) >= 3)
 
-        if num_rows != 3:
-            raise Exception("matrix A is not 3xN, it is {}x{}".format(num_rows, num_cols))
+    R = np.full((number_frames, 3, 3), np.nan)
+    t = np.full((number_frames, 3), np.nan)
+    rms = np.full(number_frames, np.nan)
+    if not valid.any():
+        return R, t, rms
 
-        [num_rows, num_cols] = B.shape;
-        if num_rows != 3:
-            raise Exception("matrix B is not 3xN, it is {}x{}".format(num_rows, num_cols))
+    # only solve the frames with at least 3 visible markers
+    W = W[valid]
+    sum_W = sum_W[valid]
+    B = np.where(visible[valid][:, :, np.newaxis], B[valid], 0.0)
 
-        # find mean column wise
-        centroid_A = np.mean(A, axis=1)
-        centroid_B = np.mean(B, axis=1)
+    # find weighted mean column wise (the calibration centroid depends on which markers are visible)
+    centroid_A = (W @ A) / sum_W[:, np.newaxis]                                 # (frames, 3)
+    centroid_B = np.einsum('fm,fmj->fj', W, B) / sum_W[:, np.newaxis]           # (frames, 3)
 
-        # subtract mean
-        Am = A - np.tile(centroid_A, (1, num_cols))
-        Bm = B - np.tile(centroid_B, (1, num_cols))
+    # subtract mean
+    Am = A[np.newaxis, :, :] - centroid_A[:, np.newaxis, :]
+    Bm = B - centroid_B[:, np.newaxis, :]
 
-        # dot is matrix multiplication for array
-        H = Am * np.transpose(Bm)
+    # weighted covariance matrix of every frame (same as Am * transpose(Bm) with 3xN matrices)
+    H = np.einsum('fm,fmi,fmj->fij', W, Am, Bm)
 
-        # find rotation
-        U, S, Vt = np.linalg.svd(H)
-        R = Vt.T * U.T
+    # find rotation (one stacked SVD for all the frames)
+    U, S, Vt = np.linalg.svd(H)
+    Ut = U.transpose(0, 2, 1)
+    V = Vt.transpose(0, 2, 1)
+    R_valid = V @ Ut
 
-        # special reflection case
-        if np.linalg.det(R) < 0:
-            #print("det(R) < R, reflection detected!, correcting for it ...\n");
-            Vt[2,:] *= -1
-            R = Vt.T * U.T
+    # special reflection case
+    reflection = np.linalg.det(R_valid) < 0
+    if reflection.any():
+        V[reflection, :, 2] *= -1 # same as Vt[2,:] *= -1
+        R_valid[reflection] = V[reflection] @ Ut[reflection]
 
-        t = -R*centroid_A + centroid_B
+    t_valid = centroid_B - np.einsum('fij,fj->fi', R_valid, centroid_A)
 
-        return R, t
+    # weighted RMS distance between the moved calibration cluster and the visible motion markers
+    error = np.einsum('fij,mj->fmi', R_valid, A) + t_valid[:, np.newaxis, :] - B
+    rms_valid = np.sqrt(np.einsum('fm,fmi,fmi->f', W, error, error) / sum_W)
 
-    ##############################################################################
-    # Get cluster and anatomical markers coordinates from the calibration file
-    ##############################################################################
+    R[valid] = R_valid
+    t[valid] = t_valid
+    rms[valid] = rms_valid
+
+    return R, t, rms
+
+def get_marker_values(point, frames=None):
+    """
+    Get the (frames, 3) values of a btk point as a float array, with NaN where the marker is not visible (btk stores 0,0,0)
+    """
+
+    import numpy as np
+
+    values = np.array(point.GetValues(), dtype=float)
+    if frames is not None:
+        values = values[frames]
+    values[(values == 0).all(axis=1)] = np.nan
+    return values
+
+def get_occlusion_mask(point, number_steps):
+    """
+    Boolean array (frames,), True where the marker is not visible: values all 0, NaN or btk residual < 0
+    """
+
+    import numpy as np
+
+    values = np.asarray(point.GetValues()[0:number_steps,:], dtype=float)
+    residuals = np.asarray(point.GetResiduals()[0:number_steps,:], dtype=float).reshape(-1)
+    return get_occlusion_masks(values, residuals)
+
+def get_occlusion_masks(values, residuals):
+    """
+    Boolean array, True where a marker is not visible, from values (..., 3) and residuals (...),
+    e.g. (frames, markers) for all the markers of a file at once
+    """
+
+    import numpy as np
+
+    return (values == 0).all(axis=-1) | np.isnan(values).any(axis=-1) | (residuals < 0)
+
+def count_gaps(mask):
+    """
+    Number of runs of consecutive True values in a boolean array
+    """
+
+    import numpy as np
+
+    return int(np.count_nonzero(np.diff(mask.astype(np.int8), prepend=0) == 1))
+
+def calibrate_cluster(acqCalibration, clusterMarkers, anatMarkers, calibrationFrames, clusterWeights=None):
+    """
+    Build the calibration model of a cluster from the calibration acquisition
+
+    The positions are averaged over the calibration frames (first, last), ignoring the frames where a marker is not visible.
+    The cluster geometry and the anatomical markers are then expressed in the local frame of the cluster:
+    origin at the (weighted) centroid of the cluster, axes along its principal directions.
+
+    Returns a dict (clusterMarkers, clusterWeights, clusterGeometry, landmarks) that can be saved with save_calibration_model()
+    """
+
+    import numpy as np
+
+    if len(clusterMarkers) < 3:
+        raise Exception("At least 3 cluster markers are needed, got {}".format(clusterMarkers))
+
+    if clusterWeights is None:
+        clusterWeights = [1.0] * len(clusterMarkers)
+    weights = np.asarray(clusterWeights, dtype=float)
+    if len(weights) != len(clusterMarkers):
+        raise Exception("{} cluster weights given for {} cluster markers".format(len(weights), len(clusterMarkers)))
+
+    frames = slice(calibrationFrames[0], calibrationFrames[1] + 1)
 
-    # Get cluster markers
+    # Average position of each marker over the calibration frames
+    def average_position(name):
+        values = get_marker_values(acqCalibration.GetPoint(name), frames)
+        if np.isnan(values).all():
+            raise Exception("The marker {} is not visible in the frames {} to {} of the calibration file".format(name, calibrationFrames[0], calibrationFrames[1]))
+        return np.nanmean(values, axis=0)
 
-    # Create an object (point) for each marker
-    point1Calibration = acqCalibration.GetPoint(clusterMarkersNamesList[0])
-    point2Calibration = acqCalibration.GetPoint(clusterMarkersNamesList[1])
-    point3Calibration = acqCalibration.GetPoint(clusterMarkersNamesList[2])
+    cluster = np.array([ average_position(name) for name in clusterMarkers ])
+    landmarks = np.array([ average_position(name) for name in anatMarkers ])
 
-    point1xCalibration = point1Calibration.GetValues()[calibrationFrame,0]
-    point1yCalibration = point1Calibration.GetValues()[calibrationFrame,1]
-    point1zCalibration = point1Calibration.GetValues()[calibrationFrame,2]
-    point2xCalibration = point2Calibration.GetValues()[calibrationFrame,0]
-    point2yCalibration = point2Calibration.GetValues()[calibrationFrame,1]
-    point2zCalibration = point2Calibration.GetValues()[calibrationFrame,2]
-    point3xCalibration = point3Calibration.GetValues()[calibrationFrame,0]
-    point3yCalibration = point3Calibration.GetValues()[calibrationFrame,1]
-    point3zCalibration = point3Calibration.GetValues()[calibrationFrame,2]
+    # Local frame of the cluster: weighted centroid and principal directions (right handed)
+    centroid = (weights @ cluster) / weights.sum()
+    U, S, axes = np.linalg.svd(cluster - centroid)
+    if np.linalg.det(axes) < 0:
+        axes[2,:] *= -1
 
-    cluster1 = np.mat([
-                            [ point1xCalibration , point1yCalibration , point1zCalibration ],
-                            [ point2xCalibration , point2yCalibration , point2zCalibration ],
-                            [ point3xCalibration , point3yCalibration , point3zCalibration ]
-                            ])
+    model = {
+        "clusterMarkers": list(clusterMarkers),
+        "clusterWeights": weights.tolist(),
+        "calibrationFrames": [int(calibrationFrames[0]), int(calibrationFrames[1])],
+        "clusterGeometry": ((cluster - centroid) @ axes.T).tolist(),
+        "landmarks": { name : local.tolist() for name, local in zip(anatMarkers, (landmarks - centroid) @ axes.T) },
+    }
 
-    print("Cluster 1 is:\n{}\n".format(cluster1))
+    return model
 
-    # Get anatomical marker
+def save_calibration_model(model, modelFile):
+    """
+    Save a calibration model (a list of clusters made with calibrate_cluster()) as a json file
+    """
 
-    pointAnat1 = acqCalibration.GetPoint(args.anatMarkerName)
+    import json
 
-    pointAnat1x = pointAnat1.GetValues()[calibrationFrame,0]
-    pointAnat1y = pointAnat1.GetValues()[calibrationFrame,1]
-    pointAnat1z = pointAnat1.GetValues()[calibrationFrame,2]
+    with open(modelFile, "w") as f:
+        json.dump({ "clusters": model }, f, indent=4)
 
-    ############################################################################################################################
-    # Go through the motion file, calculate rotation and translation matrices and calculate new anatomical marker coordinates
-    ############################################################################################################################
+def load_calibration_model(modelFile):
+    """
+    Load a calibration model saved with save_calibration_model(), returns the list of clusters
+    """
+
+    import json
+
+    with open(modelFile) as f:
+        return json.load(f)["clusters"]
+
+def residual_file_name(residualFile, outputFile):
+    """
+    Residual file of an output file: residualFile can use the fields {dir}, {stem}, {name} and {ext} of the output file,
+    e.g. "{dir}/{stem}_residuals.txt" to save one file per trial
+    """
+
+    import os
+
+    directory, name = os.path.split(outputFile)
+    stem, ext = os.path.splitext(name)
+    return residualFile.format(dir=directory or ".", stem=stem, name=name, ext=ext)
+
+def apply_calibration_model(acqMotion, model, newMarkerNames=None, onlyMissingFrames=False, residualFile=None):
+    """
+    Reconstruct the anatomical markers of a calibration model (list of clusters) in a motion acquisition
+
+    The cluster transform of each frame is computed once per cluster and applied to all of its anatomical markers,
+    then all the new points are added to the acquisition at the end.
+    The new marker names come from the optional "newMarkerNames" dict of each cluster, updated by the optional
+    newMarkerNames dict {anatomical marker : new marker name} (by default the anatomical marker name is kept).
+    If a marker with the new name already exists its values are replaced, otherwise a new point is appended.
+    """
+
+    import numpy as np
+    import btk
+
+    if newMarkerNames is None:
+        newMarkerNames = {}
 
-    ## create a 3 columns numpy array that will later become our new point in btk
-    #number_steps = acqMotion.GetPointFrameNumber() # give the number of frames
     number_steps = acqMotion.GetLastFrame() - acqMotion.GetFirstFrame() +1 # number_steps = acq.GetPointFrameNumber() # give the number of frames
 
-    newpointStructure = (number_steps,3)
-    newValue = np.ones(newpointStructure) # identity numpy array with 3 colum and PointFrameNumber rows.
-    newValue[:] = np.nan # fill with NaNs to make any mistake obvious
-
-    # Create an object (point) for each marker
-    point1Motion = acqMotion.GetPoint(clusterMarkersNamesList[0])
-    point2Motion = acqMotion.GetPoint(clusterMarkersNamesList[1])
-    point3Motion = acqMotion.GetPoint(clusterMarkersNamesList[2])
-    pointAnatMotion = acqMotion.GetPoint(args.anatMarkerName)
-
-    i=0
-    for frame in range(0, number_steps ): # for each frame of the motion file
-        print("Motion file, doing frame {}".format(frame))
-
-        # Get the cluster2 from the motion file at this specific frame
-        point1xMotion = point1Motion.GetValues()[frame,0]
-        point1yMotion = point1Motion.GetValues()[frame,1]
-        point1zMotion = point1Motion.GetValues()[frame,2]
-        point2xMotion = point2Motion.GetValues()[frame,0]
-        point2yMotion = point2Motion.GetValues()[frame,1]
-        point2zMotion = point2Motion.GetValues()[frame,2]
-        point3xMotion = point3Motion.GetValues()[frame,0]
-        point3yMotion = point3Motion.GetValues()[frame,1]
-        point3zMotion = point3Motion.GetValues()[frame,2]
-
-        cluster2 = np.mat([
-                                [ point1xMotion , point1yMotion , point1zMotion ],
-                                [ point2xMotion , point2yMotion , point2zMotion ],
-                                [ point3xMotion , point3yMotion , point3zMotion ]
-                                ])
-
-        print("Cluster 2 is:\n{}\n".format(cluster2))
-
-        # Calculate rotation and translation matrices between the two clusters (cluster from calibration file, and cluster from this motion frame)
-        anat1 = np.mat([ pointAnat1x , pointAnat1y , pointAnat1z ])
-        anat1t = anat1.transpose()
-        cluster1t = cluster1.transpose()
-        cluster2t = cluster2.transpose()
-
-        ret_R, ret_t = rigid_transform_3D(cluster1t, cluster2t)
-
-        # Recover coordinates of the anatomical marker at this frame of the motion file, from the calibration file
-        test_anat = (ret_R*anat1t) + ret_t
-        test_anat_norot = anat1t + ret_t
-        #print("frame {}, test anat recovered is: {}".format(i,test_anat))
-        #print("x = {}, y = {}, z={}".format(test_anat[0],test_anat[1],test_anat[2]))
+    newPoints = [] # (new marker name, values, residuals), added to the acquisition once all the clusters are done
+    clusterResiduals = []
+
+    for cluster in model:
+
+        clusterMarkersNamesList = cluster["clusterMarkers"]
+        log.debug("Cluster markers name list is {}".format(clusterMarkersNamesList))
+        log.debug("Cluster markers weights are {}".format(cluster["clusterWeights"]))
+        log.debug("Anatomical markers are {}".format(list(cluster["landmarks"])))
+
+        ############################################################################################################################
+        # Go through the motion file, calculate rotation and translation matrices and calculate new anatomical marker coordinates
+        ############################################################################################################################
+
+        anatMarkersNamesList = list(cluster["landmarks"])
 
         ## If we only asked to reconstruct only the missing frames (--onlyMissingFrames),
-        ## check if all xyz values exist. If yes copy them, if no reconstruct
-
-        # did we ask to reconstruct only the missing frames?
-        print("did we specify missing frames only?")
-        # print(args.onlyMissingFrames)
-        copyInsteadOfReconstructing = False
-        if (args.onlyMissingFrames == True):
-            print("YES")
-            print("Do we have xyz values for the anatomical marker ({}) at this frame of the motion file?".format(args.anatMarkerName))
-            anatxMotion = pointAnatMotion.GetValues()[frame,0]
-            anatyMotion = pointAnatMotion.GetValues()[frame,1]
-            anatzMotion = pointAnatMotion.GetValues()[frame,2]
-            if ( anatxMotion and anatyMotion and anatzMotion != "0.0"):
-                print("YES: need to copy, do not reconstruct")
-                print("{} ; {} ; {}".format(anatxMotion,anatyMotion,anatzMotion))
-                copyInsteadOfReconstructing = True
-            else:
-                print("NO (at least one missing value) reconstruct, do not copy")
-                print("{} ; {} ; {}".format(anatxMotion,anatyMotion,anatzMotion))
-            # yes: copy them and skip the cluster part
-            # no: reconstruct them            
-
-        if (args.onlyMissingFrames == False):
-            print("NO")
-            print("We asked to reconstruct all the frames regardless of if some already exist. Do nothing")
-            # just go ahead then
-        #input()
-
-        # Add the values to a numpy array, we will append it to the aquisition once we have all the values (after this loop)
-        if (copyInsteadOfReconstructing == True):
-            print("we are copying the values from the original file because the values already exist")
-            print("{} ; {} ; {}\n".format(anatxMotion,anatyMotion,anatzMotion))
-            newValue[i,0] = anatxMotion # X value at this step
-            newValue[i,1] = anatyMotion # Y value at this step
-            newValue[i,2] = anatzMotion # Z value at this step
-        elif (copyInsteadOfReconstructing == False):
-            print("we are generating the values from the original file because the values do NOT already exist")
-            print("{} ; {} ; {}\n".format(test_anat[0],test_anat[1],test_anat[2]))
-            newValue[i,0] = test_anat[0] # X value at this step
-            newValue[i,1] = test_anat[1] # Y value at this step
-            newValue[i,2] = test_anat[2] # Z value at this step
-
-        i+=1
+        ## find the gaps of each anatomical marker once, and only solve the cluster at these frames
+        existing = {}
+        if (onlyMissingFrames == True):
+            for anatMarkerName in anatMarkersNamesList:
+                try:
+                    anatPoint = acqMotion.GetPoint(anatMarkerName)
+                    existing[anatMarkerName] = ( np.array(anatPoint.GetValues()[0:number_steps,:], dtype=float),
+                                                 np.array(anatPoint.GetResiduals()[0:number_steps,:], dtype=float),
+                                                 get_occlusion_mask(anatPoint, number_steps) )
+                except:
+                    log.info("{} does not exist in the motion file, reconstructing all the frames".format(anatMarkerName))
+                    existing[anatMarkerName] = ( np.full((number_steps, 3), np.nan), np.full((number_steps, 1), -1.0), np.ones(number_steps, dtype=bool) )
+            solveFrames = np.flatnonzero(np.logical_or.reduce([ gaps for values, residuals, gaps in existing.values() ]))
+        else:
+            solveFrames = np.arange(number_steps)
+
+        # Get the trajectory of each cluster marker once: (frames to solve, markers, 3), NaN where a marker is occluded
+        with profile_stage("create_anatomical_marker.read", frames=len(solveFrames)) as stage:
+            clusterMotion = np.stack([ get_marker_values(acqMotion.GetPoint(name), solveFrames) for name in clusterMarkersNamesList ], axis=1)
+            stage["bytes"] = clusterMotion.nbytes
+
+        # Calculate rotation and translation matrices between the cluster in its local frame and
+        # the visible markers of the cluster at each frame to solve of the motion file, for all these frames at once
+        with profile_stage("create_anatomical_marker.compute", frames=len(solveFrames)) as stage:
+            ret_R, ret_t, solvedResiduals = rigid_transform_3D(cluster["clusterGeometry"], clusterMotion, cluster["clusterWeights"])
+            residuals = np.full(number_steps, np.nan)
+            residuals[solveFrames] = solvedResiduals
+            clusterResiduals.append(residuals)
+
+            log.info("{} frames solved, {} could not be fitted (less than 3 visible cluster markers)".format(len(solveFrames), np.count_nonzero(np.isnan(solvedResiduals))))
+            if not np.isnan(solvedResiduals).all():
+                log.info("Fit RMS residual: mean {:.3f}, max {:.3f}".format(np.nanmean(solvedResiduals), np.nanmax(solvedResiduals)))
+
+            # Recover coordinates of all the anatomical markers of the cluster at each solved frame of the motion file, from their local coordinates
+            landmarks = np.array([ cluster["landmarks"][name] for name in anatMarkersNamesList ]) # (landmarks, 3)
+            newValues = np.full((len(anatMarkersNamesList), number_steps, 3), np.nan) # (landmarks, frames, 3)
+            newValues[:, solveFrames, :] = np.einsum('fij,lj->lfi', ret_R, landmarks) + ret_t[np.newaxis, :, :]
+
+            clusterNewMarkerNames = dict(cluster.get("newMarkerNames", {}))
+            clusterNewMarkerNames.update(newMarkerNames)
+
+            for anatMarkerName, newValue in zip(anatMarkersNamesList, newValues):
+
+                newResiduals = residuals.reshape(-1,1)
+
+                ## Missing frames only: keep the existing values and fill the gaps with the reconstructed ones
+                if (onlyMissingFrames == True):
+                    values, valuesResiduals, gaps = existing[anatMarkerName]
+                    newValue = np.where(gaps[:, np.newaxis], newValue, values)
+                    newResiduals = np.where(gaps[:, np.newaxis], newResiduals, valuesResiduals)
+                    filled = gaps & ~np.isnan(residuals)
+                    log.info("{}: {} frames missing in {} gaps, {} frames filled".format(anatMarkerName, np.count_nonzero(gaps), count_gaps(gaps), np.count_nonzero(filled)))
+
+                newResiduals = np.where(np.isnan(newResiduals), -1.0, newResiduals) # the fit residual, -1 where it could not be reconstructed
+                newPoints.append((clusterNewMarkerNames.get(anatMarkerName, anatMarkerName), newValue, newResiduals))
+
+            stage["bytes"] = newValues.nbytes
+
+    # Save the per-frame residuals if asked (one column per cluster)
+    if residualFile:
+        log.info("Saving the fit residuals as {}".format(residualFile))
+        np.savetxt(residualFile, np.column_stack(clusterResiduals), header=" ".join([ ",".join(cluster["clusterMarkers"]) for cluster in model ]))
 
     ######################################################
-    # Add the array as a new point
+    # Add the arrays as new points
     ######################################################
 
-    print("\n\nDEBUG\n\n")
-    np.set_printoptions(threshold=sys.maxsize)
-    print(np.array_str(newValue, precision=5, suppress_small=False))
-
-    newpoint = btk.btkPoint(number_steps) # create an empty new point object
-    newpoint.SetLabel(args.newMarkerName) # set newPoint as label
-    newpoint.SetValues(newValue) # set the value
-    acqMotion.AppendPoint(newpoint) # append the new point into the acquisition object
+    with profile_stage("create_anatomical_marker.append", frames=number_steps, nbytes=sum([ values.nbytes for name, values, residuals in newPoints ])):
+        for newMarkerName, newValue, newResiduals in newPoints:
+            try:
+                newpoint = acqMotion.GetPoint(newMarkerName) # the marker already exists: replace its values
+                log.debug("Replacing the values of {}".format(newMarkerName))
+            except:
+                newpoint = btk.btkPoint(number_steps) # create an empty new point object
+                newpoint.SetLabel(newMarkerName) # set newPoint as label
+                acqMotion.AppendPoint(newpoint) # append the new point into the acquisition object
+                log.debug("Creating the marker {}".format(newMarkerName))
+            newpoint.SetValues(newValue) # set the value
+            newpoint.SetResiduals(newResiduals)
 
     return acqMotion
 
+def calibration_frames_from_args(args):
+    """
+    Frames (first, last) of the calibration file to average: --calibrationFrames "first:last" or the single --calibrationFrame
+    """
+
+    if getattr(args, 'calibrationFrames', None):
+        first, last = args.calibrationFrames.split(":")
+        return (int(first), int(last))
+    return (args.calibrationFrame, args.calibrationFrame)
+
+def parse_marker_pairs(anatMarkers):
+    """
+    "EPI_MED:EPI_MED_virtual,EPI_LAT" -> [("EPI_MED", "EPI_MED_virtual"), ("EPI_LAT", "EPI_LAT")]
+    The new name is optional, the anatomical marker name is kept by default
+    """
+
+    pairs = []
+    for pair in anatMarkers.split(","):
+        anatMarkerName, _, newMarkerName = pair.partition(":")
+        pairs.append((anatMarkerName, newMarkerName if newMarkerName else anatMarkerName))
+    return pairs
+
+def clusters_from_args(args):
+    """
+    List of clusters (cluster markers, [(anatomical marker, new marker name)], weights) given in args
+
+    Each cluster is one --clusterMarkers with its --anatMarkers (and optional --clusterWeights), in the same order.
+    A single cluster can also be given as strings, with --anatMarkerName/--newMarkerName for a single anatomical marker.
+    """
+
+    def as_list(value):
+        if value is None:
+            return []
+        return [value] if isinstance(value, str) else list(value)
+
+    clusterMarkers = as_list(args.clusterMarkers)
+    anatMarkers = as_list(getattr(args, 'anatMarkers', None))
+    clusterWeights = as_list(getattr(args, 'clusterWeights', None))
+
+    # Single anatomical marker (--anatMarkerName/--newMarkerName)
+    if not anatMarkers and getattr(args, 'anatMarkerName', None):
+        newMarkerName = getattr(args, 'newMarkerName', None) or args.anatMarkerName
+        anatMarkers = [ "{}:{}".format(args.anatMarkerName, newMarkerName) ]
+
+    if len(anatMarkers) != len(clusterMarkers):
+        raise Exception("{} lists of anatomical markers given for {} clusters".format(len(anatMarkers), len(clusterMarkers)))
+    if clusterWeights and len(clusterWeights) != len(clusterMarkers):
+        raise Exception("{} lists of weights given for {} clusters".format(len(clusterWeights), len(clusterMarkers)))
+
+    clusters = []
+    for i in range(len(clusterMarkers)):
+        weights = [ float(weight) for weight in clusterWeights[i].split(",") ] if clusterWeights else None
+        clusters.append((clusterMarkers[i].split(","), parse_marker_pairs(anatMarkers[i]), weights))
+    return clusters
+
+def calibrate_clusters_from_args(acqCalibration, args):
+    """
+    Calibration model (list of clusters) of all the clusters given in args, see clusters_from_args()
+    """
+
+    model = []
+    for clusterMarkersNamesList, pairs, clusterWeights in clusters_from_args(args):
+        cluster = calibrate_cluster(acqCalibration, clusterMarkersNamesList, [ anat for anat, new in pairs ], calibration_frames_from_args(args), clusterWeights)
+        cluster["newMarkerNames"] = { anat : new for anat, new in pairs }
+        model.append(cluster)
+    return model
+
+def create_anatomical_marker(acqCalibration,acqMotion,args):
+
+    ##############################################################################
+    # Get cluster and anatomical markers coordinates from the calibration file
+    ##############################################################################
+
+    model = calibrate_clusters_from_args(acqCalibration, args)
+
+    ##############################################################################
+    # Reconstruct all the anatomical markers in the motion file
+    ##############################################################################
+
+    return apply_calibration_model(acqMotion, model, None, args.onlyMissingFrames, getattr(args, 'residualFile', None))
+
 
 
 if __name__ == '__main__':
 
     # If loaded as main, initialise the parser (to start the program with arguments)
     import argparse
+    from proc_log import add_arguments, setup_from_args, finish_from_args
 
     parser = argparse.ArgumentParser(description='Create anatmical marker', formatter_class=argparse.RawTextHelpFormatter)
 
-    parser.add_argument ('--calibrationFile',   '-cfile',    metavar = 'calibrationFile',   type = str,  help = 'The calibration file to load (.c3d or .trc)',   required=True)
-    parser.add_argument ('--calibrationFrame',  '-cframe',   metavar = 'calibrationFrame',  type = int,  help = 'The frame of the calibration file to consider', required=True)
-    parser.add_argument ('--clusterMarkers',    '-cmarkers', metavar = 'clusterMarkers',    type = str,  help = 'List of names of the 3 cluster markers',        required=True)
-    parser.add_argument ('--anatMarkerName',    '-amarker',  metavar = 'anatMarkerName',    type = str,  help = 'The name of anatomical marker to consider',     required=True)
-    parser.add_argument ('--motionFile',        '-mfile',    metavar = 'motionFile',        type = str,  help = 'The motion file to load',                       required=True)
-    parser.add_argument ('--newMarkerName',     '-nmarker',  metavar = 'newMarkerName',     type = str,  help = 'The name of new marker that will be created',   required=True)
-    parser.add_argument ('--outputFile',        '-o',        metavar = 'outputFile',        type = str,  help = 'The output file to write (.c3d or .trc)',       required=True)
+    parser.add_argument ('--calibrationFile',   '-cfile',    metavar = 'calibrationFile',   type = str,  help = 'The calibration file to load (.c3d or .trc)',   required=False, default=None)
+    parser.add_argument ('--calibrationFrame',  '-cframe',   metavar = 'calibrationFrame',  type = int,  help = 'The frame of the calibration file to consider', required=False, default=None)
+    parser.add_argument ('--calibrationFrames', '-cframes',  metavar = 'calibrationFrames', type = str,  help = 'Frames of the calibration file to average, "first:last"', required=False, default=None)
+    parser.add_argument ('--clusterMarkers',    '-cmarkers', metavar = 'clusterMarkers',    type = str,  help = 'List of names of the cluster markers (3 or more), repeat for several clusters', required=False, default=None, action='append')
+    parser.add_argument ('--clusterWeights',    '-cweights', metavar = 'clusterWeights',    type = str,  help = 'List of weights of the cluster markers in the fit, repeat for several clusters', required=False, default=None, action='append')
+    parser.add_argument ('--anatMarkers',       '-amarkers', metavar = 'anatMarkers',       type = str,  help = 'List of anatomical markers of the cluster, "name:newName,name:newName", repeat for several clusters', required=False, default=None, action='append')
+    parser.add_argument ('--anatMarkerName',    '-amarker',  metavar = 'anatMarkerName',    type = str,  help = 'The name of anatomical marker to consider (single marker)', required=False, default=None)
+    parser.add_argument ('--saveModel',         '-smodel',   metavar = 'saveModel',         type = str,  help = 'Save the calibration model to this json file',  required=False, default=None)
+    parser.add_argument ('--model',             '-model',    metavar = 'model',             type = str,  help = 'Load the calibration model from this json file instead of the calibration file', required=False, default=None)
+    parser.add_argument ('--motionFile',        '-mfile',    metavar = 'motionFile',        type = str,  help = 'The motion file(s) to load',                    required=False, default=[], nargs='+')
+    parser.add_argument ('--newMarkerName',     '-nmarker',  metavar = 'newMarkerName',     type = str,  help = 'The name of new marker that will be created (single marker)', required=False, default=None)
+    parser.add_argument ('--outputFile',        '-o',        metavar = 'outputFile',        type = str,  help = 'The output file(s) to write (.c3d or .trc), one per motion file', required=False, default=[], nargs='+')
+    parser.add_argument ('--residualFile',      '-rfile',    metavar = 'residualFile',      type = str,  help = 'Text file to save the per-frame RMS residual of the cluster fits,\nwith several motion files a template such as "{dir}/{stem}_residuals.txt" ({dir}, {stem}, {name}, {ext} of the output file)', required=False, default=None)
     parser.add_argument ('--onlyMissingFrames', '-mframes',                                              help = 'Reconstruct on missing frames only',            required=False, action='store_true', default=False)
 
+    add_arguments(parser)
     args = parser.parse_args()
+    setup_from_args(args)
+
+    # Check the arguments: either build the model from a calibration file, or load it
+    if args.model is None:
+        if args.calibrationFile is None or args.clusterMarkers is None or (args.anatMarkers is None and args.anatMarkerName is None):
+            parser.error("--calibrationFile, --clusterMarkers and --anatMarkers (or --anatMarkerName) are required (or give a --model)")
+        if args.calibrationFrame is None and args.calibrationFrames is None:
+            parser.error("--calibrationFrame or --calibrationFrames is required (or give a --model)")
+    elif args.calibrationFile is not None:
+        parser.error("--model and --calibrationFile cannot be used together")
+    if len(args.motionFile) != len(args.outputFile):
+        parser.error("give one --outputFile per --motionFile")
+    if args.residualFile is not None and len(args.motionFile) > 1 and "{" not in args.residualFile:
+        parser.error("with several motion files, --residualFile must be a template such as \"{dir}/{stem}_residuals.txt\" (one file per output file)")
+    if args.saveModel is None and not args.motionFile:
+        parser.error("nothing to do: give --motionFile/--outputFile and/or --saveModel")
 
     # If all the arguments have been provided, load the files with btk then start the function
 
-    ######################################################
-    # Load the files
-    ######################################################
     import sys
     import btk
 
-    try:
-        print("Loading the calibration file {}".format(args.calibrationFile))
-        readerCalibration = btk.btkAcquisitionFileReader() # build a btk reader object
-        readerCalibration.SetFilename(args.calibrationFile) # set a filename to the reader
-        readerCalibration.Update()
-        acqCalibration = readerCalibration.GetOutput() # acq is the btk aquisition object
-
-        print("Loading the motion file {}".format(args.motionFile))
-        readerMotion = btk.btkAcquisitionFileReader() # build a btk reader object
-        readerMotion.SetFilename(args.motionFile) # set a filename to the reader
-        readerMotion.Update()
-        acqMotion = readerMotion.GetOutput() # acq is the btk aquisition object
-    except:
-        sys.exit("Error reading one of the files, exiting")
+    def read_file(filename):
+        with profile_stage("read"):
+            reader = btk.btkAcquisitionFileReader() # build a btk reader object
+            reader.SetFilename(filename) # set a filename to the reader
+            reader.Update()
+            return reader.GetOutput() # acq is the btk aquisition object
 
     ######################################################
-    # Create the anatomical marker
+    # Get the calibration model
     ######################################################
-    acq_modified = create_anatomical_marker(acqCalibration,acqMotion,args)
 
-    ######################################################
-    # Save the file
-    ######################################################
-    print("Saving the file as {}".format(args.outputFile))
-    try:
-        writer = btk.btkAcquisitionFileWriter()
-        writer.SetInput(acq_modified)
-        writer.SetFilename(args.outputFile)
-        writer.Update()
-    except:
-        print("Error saving the file")
+    newMarkerNames = {}
+    if args.model is not None:
+        log.info("Loading the calibration model {}".format(args.model))
+        model = load_calibration_model(args.model)
+        # Optional renaming of the anatomical markers of the model
+        for anatMarkers in (args.anatMarkers or []):
+            newMarkerNames.update(parse_marker_pairs(anatMarkers))
+        if args.newMarkerName is not None:
+            landmarks = [ name for cluster in model for name in cluster["landmarks"] ]
+            if len(landmarks) != 1:
+                sys.exit("--newMarkerName can only be used with a single anatomical marker, use --anatMarkers \"name:newName\"")
+            newMarkerNames[landmarks[0]] = args.newMarkerName
+    else:
+        try:
+            log.info("Loading the calibration file {}".format(args.calibrationFile))
+            if args.calibrationFile.lower().endswith(".c3d"):
+                from read_c3d_memmap import C3DAcquisition
+                acqCalibration = C3DAcquisition(args.calibrationFile) # only read: no need to load the whole file with btk
+            else:
+                acqCalibration = read_file(args.calibrationFile)
+        except:
+            sys.exit("Error reading the calibration file, exiting")
+        model = calibrate_clusters_from_args(acqCalibration, args)
+
+    if args.saveModel is not None:
+        log.info("Saving the calibration model as {}".format(args.saveModel))
+        save_calibration_model(model, args.saveModel)
+
+    for motionFile, outputFile in zip(args.motionFile, args.outputFile):
+
+        ######################################################
+        # Load the motion file
+        ######################################################
+        try:
+            log.info("Loading the motion file {}".format(motionFile))
+            acqMotion = read_file(motionFile)
+        except:
+            sys.exit("Error reading the motion file {}, exiting".format(motionFile))
+
+        ######################################################
+        # Create all the anatomical markers
+        ######################################################
+        acq_modified = apply_calibration_model(acqMotion, model, newMarkerNames, args.onlyMissingFrames,
+                                               residual_file_name(args.residualFile, outputFile) if args.residualFile else None)
+
+        ######################################################
+        # Save the file
+        ######################################################
+        log.info("Saving the file as {}".format(outputFile))
+        try:
+            with profile_stage("write"):
+                writer = btk.btkAcquisitionFileWriter()
+                writer.SetInput(acq_modified)
+                writer.SetFilename(outputFile)
+                writer.Update()
+        except:
+            log.error("Error saving the file")
+
+    finish_from_args(args)
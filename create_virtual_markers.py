@@ -0,0 +1,221 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+
+@author: Martin
+
+Description:
+    Create virtual markers from existing markers, computed on the whole (frames, 3) arrays at once
+    A list of definitions (json) creates as many markers as needed in one read/write, a definition can use the markers created before it.
+    Frames where one of the markers used is not visible (btk residual < 0) are not visible in the new marker (0 with a residual of -1).
+
+    Types of definitions:
+        {"name": "MID",  "type": "centroid",      "markers": ["M1", "M2"], "weights": [1, 1]}           weighted centroid of N markers (weights optional)
+        {"name": "COPY", "type": "copy",          "marker": "M1"}                                        copy of a marker
+        {"name": "OFF",  "type": "offset",        "marker": "M1", "from": "M2", "to": "M3", "distance": 30}
+                                                  M1 moved by 30 along the unit vector M2 -> M3 (or "factor": 0.5 to move by 0.5 x (M3 - M2))
+        {"name": "PL",   "type": "project_line",  "marker": "M1", "line": ["M2", "M3"]}                  projection of M1 on the line (M2, M3)
+        {"name": "PP",   "type": "project_plane", "marker": "M1", "plane": ["M2", "M3", "M4"]}           projection of M1 on the plane (M2, M3, M4)
+        {"name": "AX",   "type": "axis",          "marker": "M1", "via": "M2", "axes": "y"}              M1 with its y (or "xz"...) coordinates replaced by the ones of M2
+
+Usage:
+    python create_virtual_markers.py -i inputFile.c3d/trc -d definitions.json -o outputFile.c3d/trc
+    or import as module
+
+Requirements:
+    btk
+    numpy
+
+"""
+
+text="create_virtual_markers module"
+
+from proc_log import get_logger, profile_stage
+
+log = get_logger("create_virtual_markers")
+
+def load_definitions(definitionsFile):
+    import json
+
+    with open(definitionsFile) as f:
+        definitions = json.load(f)
+    if isinstance(definitions, dict):
+        definitions = definitions["markers"]
+    return definitions
+
+def definition_inputs(definition):
+    """
+    Names of the markers used by a definition
+    """
+
+    kind = definition["type"]
+    if kind == "centroid":
+        return list(definition["markers"])
+    if kind == "copy":
+        return [definition["marker"]]
+    if kind == "offset":
+        return [definition["marker"], definition["from"], definition["to"]]
+    if kind == "project_line":
+        return [definition["marker"]] + list(definition["line"])
+    if kind == "project_plane":
+        return [definition["marker"]] + list(definition["plane"])
+    if kind == "axis":
+        return [definition["marker"], definition["via"]]
+    raise Exception("Unknown type of virtual marker {} ({})".format(kind, definition.get("name")))
+
+def evaluate_definition(definition, markers):
+    """
+    Compute one virtual marker, markers is a dict {name : (frames, 3) array}
+    """
+
+    import numpy as np
+
+    kind = definition["type"]
+
+    if kind == "centroid":
+        weights = np.asarray(definition.get("weights", [1.0] * len(definition["markers"])), dtype=float)
+        if len(weights) != len(definition["markers"]):
+            raise Exception("{} weights given for {} markers ({})".format(len(weights), len(definition["markers"]), definition["name"]))
+        values = np.stack([ markers[name] for name in definition["markers"] ]) # (markers, frames, 3)
+        return np.einsum('m,mfi->fi', weights, values) / weights.sum()
+
+    if kind == "copy":
+        return markers[definition["marker"]].copy()
+
+    if kind == "offset":
+        direction = markers[definition["to"]] - markers[definition["from"]]
+        if "factor" in definition:
+            return markers[definition["marker"]] + float(definition["factor"]) * direction
+        with np.errstate(invalid='ignore', divide='ignore'):
+            direction = direction / np.linalg.norm(direction, axis=1, keepdims=True)
+        return markers[definition["marker"]] + float(definition["distance"]) * direction
+
+    if kind == "project_line":
+        origin = markers[definition["line"][0]]
+        direction = markers[definition["line"][1]] - origin
+        with np.errstate(invalid='ignore', divide='ignore'):
+            t = np.einsum('fi,fi->f', markers[definition["marker"]] - origin, direction) / np.einsum('fi,fi->f', direction, direction)
+        return origin + t[:, np.newaxis] * direction
+
+    if kind == "project_plane":
+        origin = markers[definition["plane"][0]]
+        normal = np.cross(markers[definition["plane"][1]] - origin, markers[definition["plane"][2]] - origin)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            normal = normal / np.linalg.norm(normal, axis=1, keepdims=True)
+        point = markers[definition["marker"]]
+        return point - np.einsum('fi,fi->f', point - origin, normal)[:, np.newaxis] * normal
+
+    if kind == "axis":
+        values = markers[definition["marker"]].copy()
+        for axis in definition["axes"].lower():
+            if axis not in "xyz":
+                raise Exception("Did not recognise the coordinates {} (has to be 'x', 'y' or 'z') ({})".format(definition["axes"], definition["name"]))
+            values[:, "xyz".index(axis)] = markers[definition["via"]][:, "xyz".index(axis)]
+        return values
+
+    raise Exception("Unknown type of virtual marker {} ({})".format(kind, definition.get("name")))
+
+def create_virtual_markers(acq, definitions):
+    """
+    Create all the virtual markers of the list of definitions, and append them to the acquisition
+    Each marker used is read once from the acquisition, and the new points are appended at the end
+    """
+
+    import numpy as np
+    import btk
+
+    number_steps = acq.GetLastFrame() - acq.GetFirstFrame() +1
+
+    markers = {}   # name : (frames, 3) values
+    occluded = {}  # name : (frames,) True where the marker is not visible
+    newMarkers = []
+
+    for definition in definitions:
+        # Get the markers used by this definition (once)
+        with profile_stage("create_virtual_markers.read", frames=number_steps) as stage:
+            for name in definition_inputs(definition):
+                if name not in markers:
+                    point = acq.GetPoint(name)
+                    markers[name] = np.asarray(point.GetValues()[0:number_steps,:], dtype=float)
+                    occluded[name] = np.asarray(point.GetResiduals()[0:number_steps,0]) < 0
+                    stage["bytes"] = (stage.get("bytes") or 0) + markers[name].nbytes
+
+        with profile_stage("create_virtual_markers.compute", frames=number_steps) as stage:
+            name = definition["name"]
+            markers[name] = evaluate_definition(definition, markers)
+            occluded[name] = np.logical_or.reduce([ occluded[used] for used in definition_inputs(definition) ])
+            if name not in newMarkers:
+                newMarkers.append(name)
+            stage["bytes"] = markers[name].nbytes
+
+    ######################################################
+    # Add the arrays as new points
+    ######################################################
+
+    with profile_stage("create_virtual_markers.append", frames=number_steps, nbytes=sum([ markers[name].nbytes for name in newMarkers ])):
+        for name in newMarkers:
+            newValue = np.where(occluded[name][:, np.newaxis], 0.0, markers[name])
+            newpoint = btk.btkPoint(number_steps) # create an empty new point object
+            newpoint.SetLabel(name) # set newPoint as label
+            newpoint.SetValues(newValue) # set the value
+            newpoint.SetResiduals(np.where(occluded[name], -1.0, 0.0).reshape(-1,1)) # not visible if one of the markers used is not visible
+            acq.AppendPoint(newpoint) # append the new point into the acquisition object
+
+    return acq
+
+
+
+if __name__ == '__main__':
+
+    # If loaded as main, initialise the parser (to start the program with arguments)
+    import argparse
+    from proc_log import add_arguments, setup_from_args, finish_from_args
+
+    parser = argparse.ArgumentParser(description='Create virtual markers', formatter_class=argparse.RawTextHelpFormatter)
+
+    parser.add_argument ('--input',       '-i', metavar = 'input',       type = str, help = 'The input file to load (.c3d or .trc)',              required=True)
+    parser.add_argument ('--definitions', '-d', metavar = 'definitions', type = str, help = 'The json list of definitions of the virtual markers', required=True)
+    parser.add_argument ('--output',      '-o', metavar = 'output',      type = str, help = 'The output file to write (.c3d or .trc)',            required=True)
+
+    add_arguments(parser)
+    args = parser.parse_args()
+    setup_from_args(args)
+
+    # If all the arguments have been provided, load the file with btk then start the function
+
+    ######################################################
+    # Load the file
+    ######################################################
+    import sys
+    import btk
+    log.info("Loading the file {}".format(args.input))
+    try:
+        with profile_stage("read"):
+            reader = btk.btkAcquisitionFileReader() # build a btk reader object
+            reader.SetFilename(args.input) # set a filename to the reader
+            reader.Update()
+            acq = reader.GetOutput() # acq is the btk aquisition object
+    except:
+        sys.exit("Error reading the file, exiting")
+
+    ######################################################
+    # Create the virtual markers
+    ######################################################
+    definitions = load_definitions(args.definitions)
+    log.info("Creating {} virtual markers".format(len(definitions)))
+    acq_modified = create_virtual_markers(acq,definitions)
+
+    ######################################################
+    # Save the file
+    ######################################################
+    log.info("Saving the file as {}".format(args.output))
+    try:
+        with profile_stage("write"):
+            writer = btk.btkAcquisitionFileWriter()
+            writer.SetInput(acq_modified)
+            writer.SetFilename(args.output)
+            writer.Update()
+    except:
+        log.error("Error saving the file")
+
+    finish_from_args(args)
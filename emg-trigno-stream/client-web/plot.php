@@ -35,7 +35,6 @@
 
 // The graphs will be updated later
  var emg_window_size_total = 3240 // Size of the table that contains the EMG data
- var emg_window_size_newdata = 270 // Part of the table that will be updated with new EMG data (from the python script)
 
   // Fill X axis
   var xaxis = [];
@@ -53,17 +52,28 @@
   var newArray_emg7 = []
 
   // Fill all the the Y with 0 values
-  for(var i = 0; i < arrayLength; i++) {
-    var y = 0
-    newArray_emg0[i] = y
-    newArray_emg1[i] = y
-    newArray_emg2[i] = y
-    newArray_emg3[i] = y
-    newArray_emg4[i] = y
-    newArray_emg5[i] = y
-    newArray_emg6[i] = y
-    newArray_emg7[i] = y
+  function reset_emg_arrays(length) {
+    newArray_emg0 = []
+    newArray_emg1 = []
+    newArray_emg2 = []
+    newArray_emg3 = []
+    newArray_emg4 = []
+    newArray_emg5 = []
+    newArray_emg6 = []
+    newArray_emg7 = []
+    for(var i = 0; i < length; i++) {
+      var y = 0
+      newArray_emg0[i] = y
+      newArray_emg1[i] = y
+      newArray_emg2[i] = y
+      newArray_emg3[i] = y
+      newArray_emg4[i] = y
+      newArray_emg5[i] = y
+      newArray_emg6[i] = y
+      newArray_emg7[i] = y
+    }
   }
+  reset_emg_arrays(arrayLength)
 
 // define the layout that will be used for the graphs
 var custom_layout_emg_global = { title: 'EMG waiting', font: {size: 18}, yaxis: {range: [-0.0005, 0.0005]} };
@@ -82,67 +92,130 @@ Plotly.plot('divemg7', [{ y: newArray_emg7, mode: 'lines', line: {color: '#80CAF
 //************************************************
 
   var socket1 = io('http://169.254.1.1:7766/emg');
+  var emg_format = 'float32' // format of the data sent by the server: binary 'float32' or 'int16' frames, or 'json' lists
+  var last_sequence = null // number of the last binary frame, to detect lost frames
+  // display settings: the server decimates the EMG to the width of the graphs (see server-python/emg_decimation.py)
+  var emg_rate = 2000 // Hz
+  // channels shown, and the queue of the server for this page: at most 4 messages waiting, merged if the page is slow (acknowledged)
+  var emg_channels = [0, 1, 2, 3, 4, 5, 6, 7]
+  var emg_settings = { width: document.getElementById('divemg0').clientWidth, window: emg_window_size_total / emg_rate, rate: 10, method: 'minmax',
+                       channels: emg_channels, queue: 4, policy: 'coalesce', ack: true }
+
+  socket1.on('connect', function(){console.log('connect!'); socket1.emit('format', emg_format); socket1.emit('settings', emg_settings)});
+  // the server gives the number of points of the window once decimated
+  socket1.on('settings', function(msg){
+    console.log('settings:', msg.method, msg.bucket, 'samples per point,', msg.points, 'points');
+    last_sequence = null;
+    emg_channels = msg.channels;
+    reset_emg_arrays(msg.points);
+  });
 
-  socket1.on('connect', function(){console.log('connect!')});
+  // rows of the channels sent -> rows of the 8 channels (empty for the channels not sent)
+  function channel_rows(rows) {
+    var data = [[], [], [], [], [], [], [], []];
+    for (var i = 0; i < rows.length; i++) { data[emg_channels[i]] = rows[i] }
+    return data;
+  }
   socket1.on('confirmation_connection', function(msg){console.log('Connected on:', msg)});
   socket1.on('disconnect', function(){console.log('disconnect!')});
   socket1.on('reply', function(msg){console.log('reply!', msg)});
+  socket1.on('overrun', function(msg){console.log('overrun:', msg.dropped, 'samples dropped,', msg.total, 'in total')});
   
 
-  // Every time the server sends a "message", update all the EMG graphs
-  socket1.on("message", function(data) {
+  // Decode a binary frame (see server-python/emg_frames.py): header of 20 bytes, then the samples channel after channel (little-endian)
+  function decode_frame(buffer) {
+    var view = new DataView(buffer);
+    var encoding = view.getUint8(1); // 0: float32, 1: int16 * scale
+    var channels = view.getUint16(2, true);
+    var sequence = view.getUint32(4, true);
+    var first_sample = view.getUint32(8, true);
+    var samples = view.getUint32(12, true);
+    var scale = view.getFloat32(16, true);
+    var rows = [];
+    for (var c = 0; c < channels; c++) {
+      if (encoding == 0) {
+        rows.push(new Float32Array(buffer, 20 + c * samples * 4, samples));
+      } else {
+        var raw = new Int16Array(buffer, 20 + c * samples * 2, samples);
+        var row = new Float32Array(samples);
+        for (var i = 0; i < samples; i++) { row[i] = raw[i] * scale }
+        rows.push(row);
+      }
+    }
+    return { sequence: sequence, first_sample: first_sample, rows: rows };
+  }
+
+  // Every time the server sends a binary "frame", decode it and update all the EMG graphs
+  // (the sequence numbers also skip the frames merged by the server when the page was slow)
+  socket1.on("frame", function(buffer, ack) {
+    var frame = decode_frame(buffer);
+    if (last_sequence !== null && frame.sequence != last_sequence + 1) {
+      console.log('lost or merged', frame.sequence - last_sequence - 1, 'frames');
+    }
+    last_sequence = frame.sequence;
+    update_emg_graphs(channel_rows(frame.rows.map(function(row) { return Array.from(row) })));
+    if (ack) { ack() } // the server sends the next frames once this one is drawn
+  });
+
+  // Every time the server sends a "message" (json lists, fallback), update all the EMG graphs
+  socket1.on("message", function(data, ack) {
+    update_emg_graphs(channel_rows(data));
+    if (ack) { ack() }
+  });
+
+  function update_emg_graphs(data) {
 
     console.log(data, " for ", socket1.id);
 
     var y_emg0 = data[0]; // get the first row of the table
-    newArray_emg0 = newArray_emg0.concat(y_emg0) // add it (270 values) to our main array 
-    newArray_emg0.splice(0, emg_window_size_newdata) // remove as many cells (270) from the beginning of the array
+    newArray_emg0 = newArray_emg0.concat(y_emg0) // add the new values to our main array
+    newArray_emg0.splice(0, y_emg0.length) // remove as many cells from the beginning of the array
   	var data_update_emg0 = { y: [newArray_emg0] }; // format the data to update the plot
   	Plotly.update('divemg0', data_update_emg0) // update the plot
 
     var y_emg1 = data[1];
     newArray_emg1 = newArray_emg1.concat(y_emg1)
-    newArray_emg1.splice(0, emg_window_size_newdata)
+    newArray_emg1.splice(0, y_emg1.length)
   	var data_update_emg1 = { y: [newArray_emg1] };
   	Plotly.update('divemg1', data_update_emg1)
 
     var y_emg2 = data[2];
     newArray_emg2 = newArray_emg2.concat(y_emg2)
-    newArray_emg2.splice(0, emg_window_size_newdata)
+    newArray_emg2.splice(0, y_emg2.length)
   	var data_update_emg2 = { y: [newArray_emg2] };
   	Plotly.update('divemg2', data_update_emg2)
 
     var y_emg3 = data[3];
     newArray_emg3 = newArray_emg3.concat(y_emg3)
-    newArray_emg3.splice(0, emg_window_size_newdata)
+    newArray_emg3.splice(0, y_emg3.length)
   	var data_update_emg3 = { y: [newArray_emg3] };
   	Plotly.update('divemg3', data_update_emg3)
 
     var y_emg4 = data[4];
     newArray_emg4 = newArray_emg4.concat(y_emg4)
-    newArray_emg4.splice(0, emg_window_size_newdata)
+    newArray_emg4.splice(0, y_emg4.length)
   	var data_update_emg4 = { y: [newArray_emg4] };
   	Plotly.update('divemg4', data_update_emg4)
   		
     var y_emg5 = data[5];
     newArray_emg5 = newArray_emg5.concat(y_emg5)
-    newArray_emg5.splice(0, emg_window_size_newdata)
+    newArray_emg5.splice(0, y_emg5.length)
   	var data_update_emg5 = { y: [newArray_emg5] };
   	Plotly.update('divemg5', data_update_emg5)
 
     var y_emg6 = data[6];
     newArray_emg6 = newArray_emg6.concat(y_emg6)
-    newArray_emg6.splice(0, emg_window_size_newdata)
+    newArray_emg6.splice(0, y_emg6.length)
   	var data_update_emg6 = { y: [newArray_emg6] };
   	Plotly.update('divemg6', data_update_emg6)
 
     var y_emg7 = data[7];
     newArray_emg7 = newArray_emg7.concat(y_emg7)
-    newArray_emg7.splice(0, emg_window_size_newdata)
+    newArray_emg7.splice(0, y_emg7.length)
   	var data_update_emg7 = { y: [newArray_emg7] };
   	Plotly.update('divemg7', data_update_emg7)
 	
-  });
+  }
 
 </script>
 
@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+
+"""
+
+Decimation of the EMG for display: a client showing `window` seconds on `width` pixels does not need more than
+one (LTTB) or two (min/max) points per pixel. All the channels are decimated at once.
+
+The samples are decimated by buckets of `bucket` samples (samples per pixel), aligned on the sample index: only the
+complete buckets are used, the remaining samples are decimated with the next ones (`consumed` samples are returned).
+
+    minmax: minimum and maximum of each bucket, in the order they occur (the spikes stay visible)
+    lttb:   Largest-Triangle-Three-Buckets, the point of each bucket making the largest triangle with the point kept
+            in the previous bucket and the average of the next bucket (the last bucket waits for the next samples)
+
+"""
+
+import numpy
+
+METHODS = ('none', 'minmax', 'lttb')
+
+def bucket_size(width, window, rate):
+    """Number of samples per pixel for `window` seconds at `rate` Hz on `width` pixels"""
+    return max(1, int(round(window * rate / width)))
+
+def points_per_bucket(method):
+    return 2 if method == 'minmax' else 1
+
+def minmax_decimate(data, bucket):
+    """
+    data (channels, samples) -> (points (channels, 2 * buckets), consumed samples)
+    """
+    channels, num_samples = data.shape
+    buckets = num_samples // bucket
+    blocks = data[:, :buckets * bucket].reshape(channels, buckets, bucket)
+
+    imin = blocks.argmin(axis=2)
+    imax = blocks.argmax(axis=2)
+    vmin = numpy.take_along_axis(blocks, imin[:, :, numpy.newaxis], axis=2)[:, :, 0]
+    vmax = numpy.take_along_axis(blocks, imax[:, :, numpy.newaxis], axis=2)[:, :, 0]
+
+    points = numpy.empty((channels, buckets, 2), dtype=data.dtype)
+    min_first = imin <= imax
+    points[:, :, 0] = numpy.where(min_first, vmin, vmax)
+    points[:, :, 1] = numpy.where(min_first, vmax, vmin)
+    return points.reshape(channels, 2 * buckets), buckets * bucket
+
+def lttb_decimate(data, bucket, previous=None):
+    """
+    data (channels, samples) -> (points (channels, buckets), consumed samples, previous)
+
+    previous: (x (channels,), y (channels,)) point kept in the bucket before data, x relative to the first sample of data
+              (None at the start: the first sample is used)
+    The returned previous is relative to the first sample after the consumed ones, for the next call.
+    """
+    channels, num_samples = data.shape
+    buckets = num_samples // bucket - 1 # the last complete bucket is only used as the next bucket
+    if buckets <= 0:
+        return numpy.empty((channels, 0), dtype=data.dtype), 0, previous
+
+    if previous is None:
+        previous = (numpy.zeros(channels), data[:, 0])
+    xa, ya = previous
+
+    blocks = data[:, :(buckets + 1) * bucket].reshape(channels, buckets + 1, bucket)
+    averages = blocks.mean(axis=2) # (channels, buckets + 1)
+    x = numpy.arange(bucket)
+
+    points = numpy.empty((channels, buckets), dtype=data.dtype)
+    for i in range(buckets):
+        xc = (i + 1) * bucket + (bucket - 1) / 2.
+        yc = averages[:, i + 1]
+        xj = i * bucket + x
+        yj = blocks[:, i, :]
+        # twice the area of the triangles (a, j, c) for all the candidates j of the bucket, for all the channels
+        area = numpy.abs((xa - xc)[:, numpy.newaxis] * (yj - ya[:, numpy.newaxis])
+                         - (xa[:, numpy.newaxis] - xj[numpy.newaxis, :]) * (yc - ya)[:, numpy.newaxis])
+        best = area.argmax(axis=1)
+        points[:, i] = yj[numpy.arange(channels), best]
+        xa, ya = (i * bucket + best).astype(float), points[:, i]
+
+    consumed = buckets * bucket
+    return points, consumed, (xa - consumed, ya)
+
+def decimate(data, method, bucket, state=None):
+    """
+    (points, consumed samples, state) of data (channels, samples) with a method of METHODS
+    state is the state of the method between two calls (lttb), None at the start
+    """
+    if method == 'minmax':
+        points, consumed = minmax_decimate(data, bucket)
+        return points, consumed, state
+    if method == 'lttb':
+        return lttb_decimate(data, bucket, state)
+    return data, data.shape[1], state
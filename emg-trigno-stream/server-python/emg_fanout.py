@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+
+"""
+
+Fan-out of the EMG to the web clients (used by server.py)
+
+The clients with the same subscription (format, channels, decimation, rate) share a stream: the samples are read,
+decimated and encoded once per stream, then queued for each client of the stream.
+
+Each client has a bounded outgoing queue, so that a slow client only delays (and loses) its own messages:
+    drop:     when the queue is full, the oldest message is dropped (the client sees a gap in the sequence numbers)
+    coalesce: when the queue is full, the two oldest messages are merged into one (re-encoded for this client only),
+              no sample is lost until the merged message would hold more than max_points points, or after an overrun (then: drop)
+A client acknowledging its messages (ack) has at most max_in_flight messages sent and not acknowledged, the others
+wait in its queue.
+
+"""
+
+import collections
+
+import numpy
+
+from emg_frames import encode
+
+POLICIES = ('drop', 'coalesce')
+
+def stream_key(settings):
+    """Key of the stream of a client: the clients with the same key get the same messages"""
+    return (settings['format'], tuple(settings['channels']), settings['method'], settings['bucket'], settings['rate'])
+
+def new_message(points, first, end, sequence, client_format, payload=None):
+    """
+    Message of a stream: decimated points (channels, points) of the samples first to end (excluded),
+    sequence number, format and payload (None: not encoded yet)
+    """
+    return {'points': points, 'first': first, 'end': end, 'sequence': sequence, 'format': client_format, 'payload': payload}
+
+def payload(message):
+    """Payload of a message (encoded at most once, see emg_frames.encode())"""
+    if message['payload'] is None:
+        message['payload'] = encode(message['points'], message['sequence'], message['first'], message['format'])
+    return message['payload']
+
+class OutgoingQueue(object):
+    """
+    Bounded queue of the messages waiting to be sent to a client
+    dropped: number of messages dropped, coalesced: number of messages merged into another
+    """
+
+    def __init__(self, length=4, policy='drop', max_points=None):
+        if policy not in POLICIES:
+            raise ValueError("Unknown policy {} (policies: {})".format(policy, ", ".join(POLICIES)))
+        self.length = max(1, length)
+        self.policy = policy
+        self.max_points = max_points
+        self.messages = collections.deque()
+        self.dropped = 0
+        self.coalesced = 0
+
+    def __len__(self):
+        return len(self.messages)
+
+    def push(self, message):
+        self.messages.append(message)
+        while len(self.messages) > self.length:
+            if self.policy == 'coalesce' and len(self.messages) >= 2 and self._can_merge(self.messages[0], self.messages[1]):
+                oldest = self.messages.popleft()
+                self.messages[0] = self._merge(oldest, self.messages[0])
+                self.coalesced += 1
+            else:
+                self.messages.popleft()
+                self.dropped += 1
+
+    def pop(self):
+        return self.messages.popleft()
+
+    def _can_merge(self, a, b):
+        # only consecutive samples: a message after an overrun is not merged with the one before
+        return a['end'] == b['first'] and (self.max_points is None or a['points'].shape[1] + b['points'].shape[1] <= self.max_points)
+
+    @staticmethod
+    def _merge(a, b):
+        # the merged message keeps the sequence number of the newest, the next messages follow it
+        points = numpy.concatenate((a['points'], b['points']), axis=1)
+        return new_message(points, a['first'], b['end'], b['sequence'], b['format'])
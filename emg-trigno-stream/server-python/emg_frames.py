@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+
+"""
+
+Binary frames of EMG samples sent to the web clients (decoded in client-web/plot.php)
+
+A frame is a header of 20 bytes followed by the samples, channel after channel, all little-endian:
+    uint8    version (1)
+    uint8    encoding: 0 float32, 1 int16 (value = int16 * scale)
+    uint16   number of channels
+    uint32   sequence number of the frame
+    uint32   index of the first sample (since the start of the acquisition)
+    uint32   number of samples per channel
+    float32  scale (int16 encoding, 1 for float32)
+    samples  (channels, samples) float32 or int16
+
+"""
+
+import struct
+
+import numpy
+
+FRAME_VERSION = 1
+HEADER = struct.Struct('<BBHIIIf')
+ENCODINGS = {'float32': 0, 'int16': 1}
+FORMATS = ('json',) + tuple(ENCODINGS) # formats a client can ask for, json is the fallback
+
+def encode_frame(data, sequence, first_sample, encoding='float32'):
+    """
+    Binary frame of data (channels, samples)
+    With int16, the scale is the maximum absolute value of the frame / 32767
+    """
+    data = numpy.asarray(data)
+    scale = 1.
+    if encoding == 'int16':
+        peak = float(numpy.max(numpy.abs(data))) if data.size else 0.
+        scale = peak / 32767 if peak > 0 else 1.
+        samples = numpy.rint(data / scale).astype('<i2')
+    elif encoding == 'float32':
+        samples = numpy.ascontiguousarray(data, dtype='<f4')
+    else:
+        raise ValueError("Unknown encoding {} (encodings: {})".format(encoding, ", ".join(ENCODINGS)))
+
+    header = HEADER.pack(FRAME_VERSION, ENCODINGS[encoding], data.shape[0], sequence & 0xFFFFFFFF,
+                         first_sample & 0xFFFFFFFF, data.shape[1], scale)
+    return header + samples.tobytes()
+
+def decode_frame(frame):
+    """
+    (data (channels, samples) float64, sequence, first sample) of a binary frame
+    """
+    version, encoding, channels, sequence, first_sample, num_samples, scale = HEADER.unpack_from(frame)
+    if version != FRAME_VERSION:
+        raise ValueError("Unknown frame version {}".format(version))
+    dtype = '<f4' if encoding == ENCODINGS['float32'] else '<i2'
+    samples = numpy.frombuffer(frame, dtype=dtype, count=channels * num_samples, offset=HEADER.size)
+    data = samples.reshape(channels, num_samples).astype(numpy.float64)
+    if encoding == ENCODINGS['int16']:
+        data *= scale
+    return data, sequence, first_sample
+
+def encode(data, sequence, first_sample, client_format):
+    """
+    Payload of a message for a client format: binary frame, or list of lists (json)
+    """
+    if client_format == 'json':
+        return data.tolist()
+    return encode_frame(data, sequence, first_sample, client_format)
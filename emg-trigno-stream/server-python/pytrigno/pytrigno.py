@@ -1,5 +1,5 @@
 import socket
-import struct
+import threading
 import numpy
 
 class _BaseTrignoDaq(object):
@@ -48,6 +48,9 @@ class _BaseTrignoDaq(object):
 
         self._min_recv_size = self.total_channels * self.BYTES_PER_CHANNEL
 
+        # receive buffer, reused (and only grown) between reads
+        self._buffer = bytearray(0)
+
         self._initialize()
 
     def _initialize(self):
@@ -77,6 +80,9 @@ class _BaseTrignoDaq(object):
         This is a blocking method, meaning it returns only once the requested
         number of samples are available.
 
+        The samples are received directly into a preallocated buffer that is
+        reused by the next read, and decoded without copy.
+
         Parameters
         ----------
         num_samples : int
@@ -84,27 +90,46 @@ class _BaseTrignoDaq(object):
 
         Returns
         -------
-        data : ndarray, shape=(total_channels, num_samples)
-            Data read from the device. Each channel is a row and each column
-            is a point in time.
+        data : ndarray, shape=(total_channels, num_samples), dtype='<f4'
+            Read-only view of the data read from the device. Each channel is
+            a row and each column is a point in time. The view is only valid
+            until the next read: copy it (or the rows needed) to keep it.
         """
         l_des = num_samples * self._min_recv_size
+        if len(self._buffer) < l_des:
+            self._buffer = bytearray(l_des)
+        view = memoryview(self._buffer)
         l = 0
-        packet = bytes()
         while l < l_des:
             try:
-                packet += self._data_socket.recv(l_des - l)
+                n = self._data_socket.recv_into(view[l:l_des], l_des - l)
             except socket.timeout:
-                l = len(packet)
-                packet += b'\x00' * (l_des - l)
                 raise IOError("Device disconnected.")
-            l = len(packet)
+            if n == 0:
+                raise IOError("Device disconnected.")
+            l += n
 
-        data = numpy.asarray(
-            struct.unpack('<'+'f'*self.total_channels*num_samples, packet))
-        data = numpy.transpose(data.reshape((-1, self.total_channels)))
+        data = numpy.frombuffer(self._buffer, dtype='<f4',
+                                count=self.total_channels * num_samples)
+        data.flags.writeable = False  # the buffer is owned by the next read
+        return data.reshape((num_samples, self.total_channels)).T
 
-        return data
+    def _read_channels(self, channel_range, scaler=1., out=None,
+                       dtype=numpy.float64):
+        """
+        Read ``samples_per_read`` samples and copy the channels of
+        ``channel_range`` (scaled) into ``out``: the other channels are not
+        converted.
+        """
+        data = _BaseTrignoDaq.read(self, self.samples_per_read)
+        selected = data[channel_range[0]:channel_range[1]+1, :]
+        if out is None:
+            out = numpy.empty(selected.shape, dtype=dtype)
+        if scaler == 1.:
+            numpy.copyto(out, selected, casting='same_kind')
+        else:
+            numpy.multiply(selected, scaler, out=out, dtype=out.dtype)
+        return out
 
     def stop(self):
         """Tell the device to stop streaming data."""
@@ -206,22 +231,29 @@ class TrignoEMG(_BaseTrignoDaq):
         self.channel_range = channel_range
         self.num_channels = channel_range[1] - channel_range[0] + 1
 
-    def read(self):
+    def read(self, out=None, dtype=numpy.float64):
         """
         Request a sample of data from the device.
 
         This is a blocking method, meaning it returns only once the requested
         number of samples are available.
 
+        Parameters
+        ----------
+        out : ndarray, shape=(num_channels, num_samples), optional
+            Array to write the data into (reused between reads to avoid any
+            allocation).
+        dtype : dtype, optional
+            Type of the returned array when ``out`` is not given, e.g.
+            ``numpy.float32`` (the data sent by the device is float32).
+
         Returns
         -------
         data : ndarray, shape=(num_channels, num_samples)
             Data read from the device. Each channel is a row and each column
             is a point in time.
         """
-        data = super(TrignoEMG, self).read(self.samples_per_read)
-        data = data[self.channel_range[0]:self.channel_range[1]+1, :]
-        return self.scaler * data
+        return self._read_channels(self.channel_range, self.scaler, out, dtype)
 
 
 class TrignoAccel(_BaseTrignoDaq):
@@ -272,19 +304,157 @@ class TrignoAccel(_BaseTrignoDaq):
         self.channel_range = channel_range
         self.num_channels = channel_range[1] - channel_range[0] + 1
 
-    def read(self):
+    def read(self, out=None, dtype=numpy.float64):
         """
         Request a sample of data from the device.
 
         This is a blocking method, meaning it returns only once the requested
         number of samples are available.
 
+        Parameters
+        ----------
+        out : ndarray, shape=(num_channels, num_samples), optional
+            Array to write the data into (reused between reads to avoid any
+            allocation).
+        dtype : dtype, optional
+            Type of the returned array when ``out`` is not given, e.g.
+            ``numpy.float32`` (the data sent by the device is float32).
+
         Returns
         -------
         data : ndarray, shape=(num_channels, num_samples)
             Data read from the device. Each channel is a row and each column
             is a point in time.
         """
-        data = super(TrignoAccel, self).read(self.samples_per_read)
-        data = data[self.channel_range[0]:self.channel_range[1]+1, :]
-        return data
+        return self._read_channels(self.channel_range, 1., out, dtype)
+
+
+class TrignoReader(object):
+    """
+    Background thread reading a Trigno data source into a circular buffer.
+
+    The thread reads the device continuously (so that its TCP buffer never
+    falls behind) and writes the samples into a preallocated
+    (num_channels, buffer_samples) circular buffer. Consumers get the newest
+    samples with ``read_new()`` without blocking, and are told how many samples
+    they missed when they did not read often enough.
+
+    There is a single writer and no lock: the sample counter is only
+    increased once a block is written, and a consumer checks after copying
+    that the samples it copied were not overwritten meanwhile.
+
+    Parameters
+    ----------
+    dev : TrignoEMG or TrignoAccel
+        Started device to read from (``samples_per_read`` samples per read).
+    buffer_samples : int, optional
+        Number of samples per channel kept in the circular buffer.
+    dtype : dtype, optional
+        Type of the buffer.
+
+    Attributes
+    ----------
+    total_samples : int
+        Number of samples per channel written since the start.
+    error : Exception or None
+        Error that stopped the thread (e.g. device disconnected).
+    """
+
+    def __init__(self, dev, buffer_samples=20000, dtype=numpy.float64):
+        channel_range = dev.channel_range
+        self.dev = dev
+        self.num_channels = channel_range[1] - channel_range[0] + 1
+        self.buffer_samples = buffer_samples
+        if buffer_samples < dev.samples_per_read:
+            raise ValueError("The buffer must hold at least one read "
+                             "({} samples)".format(dev.samples_per_read))
+
+        self._buffer = numpy.zeros((self.num_channels, buffer_samples),
+                                   dtype=dtype)
+        self._block = numpy.empty((self.num_channels, dev.samples_per_read),
+                                  dtype=dtype)
+        self.total_samples = 0
+        self.error = None
+        self._running = False
+        self._thread = None
+
+    def start(self):
+        """Start the reading thread."""
+        self._running = True
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """Stop the reading thread (after its current read)."""
+        self._running = False
+        if self._thread is not None:
+            self._thread.join()
+
+    @property
+    def running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def _run(self):
+        try:
+            while self._running:
+                block = self.dev.read(out=self._block)
+                n = block.shape[1]
+                start = self.total_samples % self.buffer_samples
+                first = min(n, self.buffer_samples - start)
+                self._buffer[:, start:start+first] = block[:, :first]
+                self._buffer[:, :n-first] = block[:, first:]
+                self.total_samples += n
+        except Exception as e:
+            self.error = e
+            self._running = False
+
+    def read_new(self, cursor, max_samples=None):
+        """
+        Copy the samples written since ``cursor``, without blocking.
+
+        Parameters
+        ----------
+        cursor : int
+            Index of the first sample wanted (index of the last sample read
+            plus one, 0 at the start).
+        max_samples : int, optional
+            Maximum number of samples returned: when more samples are
+            waiting, the oldest are skipped (and counted as dropped) instead
+            of adding latency.
+
+        Returns
+        -------
+        data : ndarray, shape=(num_channels, num_samples)
+            The new samples (possibly none).
+        first : int
+            Index of the first returned sample (the next cursor is
+            ``first + num_samples``).
+        dropped : int
+            Number of samples missed since ``cursor``: overwritten in the
+            buffer, or skipped because of ``max_samples``.
+
+        Raises
+        ------
+        IOError
+            If the thread stopped on an error and all its samples were read.
+        """
+        total = self.total_samples
+        if self.error is not None and cursor >= total:
+            raise IOError("Trigno reader stopped: {}".format(self.error))
+
+        limit = self.buffer_samples - self.dev.samples_per_read
+        if max_samples is not None:
+            limit = min(limit, max_samples)
+        first = max(cursor, total - limit)
+
+        indices = numpy.arange(first, total) % self.buffer_samples
+        data = self._buffer[:, indices]
+
+        # the writer may have overwritten the oldest samples during the copy
+        overwritten = self.total_samples + self.dev.samples_per_read \
+            - self.buffer_samples - first
+        if overwritten > 0:
+            data = data[:, overwritten:]
+            first += overwritten
+
+        return data, first, first - cursor
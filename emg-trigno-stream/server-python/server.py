@@ -21,6 +21,9 @@ except ImportError:
     import sys
     sys.path.insert(0, '..')
     import pytrigno
+from emg_frames import FORMATS, encode
+from emg_decimation import METHODS, bucket_size, decimate, points_per_bucket
+from emg_fanout import POLICIES, OutgoingQueue, new_message, payload, stream_key
 
 # Server
 sio = socketio.AsyncServer()
@@ -29,6 +32,15 @@ sio.attach(app)
 
 ############################ Trigno ####################################
 
+EMIT_PERIOD = 0.1 # seconds between two messages to the clients without settings
+TICK = 0.01 # seconds between two checks of the clients to serve (each client has its own rate)
+MIN_WIDTH, MAX_WIDTH = 10, 10000 # pixels of the display of a client
+MIN_RATE, MAX_RATE = 1., 60. # messages per second a client can ask for
+MAX_LATENCY = 1.0 # seconds of data waiting at most: older samples are dropped (and reported) instead of being sent late
+QUEUE_LENGTH, MAX_QUEUE_LENGTH = 4, 100 # messages waiting at most for a client (default, maximum a client can ask for)
+MAX_IN_FLIGHT = 2 # messages sent and not acknowledged at most, for the clients acknowledging their messages
+ACK_TIMEOUT = 5.0 # seconds without acknowledgement before sending again
+
 # Start the EMG
 dev = pytrigno.TrignoEMG(channel_range=(0, 7), samples_per_read=270,host='169.254.1.2')
 # test multi-channels
@@ -36,8 +48,50 @@ dev.set_channel_range((0, 7)) # connect to the 8 channels of the emg
 dev.start()
 print("Started Trigno")
 
+# Read the EMG continuously in a thread, into a circular buffer of 10 s
+reader = pytrigno.TrignoReader(dev, buffer_samples=int(10 * dev.rate))
+reader.start()
+
 ############################# Websockets ###############################
 
+# Settings of a client (see the 'settings' message):
+#   format:   'json' (lists of numbers, default), or binary frames 'float32'/'int16' (see emg_frames.py)
+#   channels: indices of the channels sent (all by default)
+#   method:   decimation for display (see emg_decimation.py), 'none' (all the samples) until the client sends its settings
+#   bucket:   samples per point (per pixel), rate: messages per second
+# The clients with the same settings share a stream (see emg_fanout.py), read, decimated and encoded once:
+#   streams[key] = {'settings', 'sids', 'cursor', 'state', 'sequence', 'next_time', 'dropped'}
+#   cursor: index of the next sample to read (None: start at the next bucket), state: state of the decimation
+# Each client has its own bounded queue of messages:
+#   clients[sid] = {'settings', 'queue', 'ack', 'in_flight', 'sent_time'}
+streams = {}
+clients = {}
+
+def default_settings():
+    return {'format': 'json', 'channels': list(range(reader.num_channels)), 'method': 'none', 'bucket': 1, 'rate': 1. / EMIT_PERIOD}
+
+def join_stream(sid, settings):
+    """Move the client to the stream of its settings (created if no other client has these settings)"""
+    client = clients[sid]
+    client['queue'].max_points = int(MAX_LATENCY * dev.rate / settings['bucket']) * points_per_bucket(settings['method'])
+    key = stream_key(settings)
+    if client['settings'] is not None and stream_key(client['settings']) == key:
+        return # same stream: keep its cursor, decimation state and sequence
+    leave_stream(sid)
+    client['settings'] = settings
+    if key not in streams:
+        streams[key] = {'settings': settings, 'sids': set(), 'cursor': None, 'state': None, 'sequence': 0, 'next_time': 0., 'dropped': 0}
+    streams[key]['sids'].add(sid)
+
+def leave_stream(sid):
+    client = clients.get(sid)
+    if client is None or client['settings'] is None:
+        return
+    key = stream_key(client['settings'])
+    streams[key]['sids'].discard(sid)
+    if not streams[key]['sids']:
+        del streams[key]
+
 async def index(request):
     """Serve the client-side application."""
     with open('index.html') as f:
@@ -46,11 +100,59 @@ async def index(request):
 @sio.on('connect', namespace='/emg')
 async def connect(sid, environ):
     print("connection de sid: ", sid, "on namespace /emg")
+    clients[sid] = {'settings': None, 'queue': OutgoingQueue(QUEUE_LENGTH), 'ack': False, 'in_flight': 0, 'sent_time': 0.}
+    join_stream(sid, default_settings())
     await sio.emit('confirmation_connection', "emg", namespace='/emg')
 
 @sio.on('disconnect', namespace='/emg')
 def disconnect(sid):
     print('disconnect', sid)
+    leave_stream(sid)
+    clients.pop(sid, None)
+
+@sio.on('format', namespace='/emg')
+async def set_format(sid, client_format):
+    """The client asks for binary frames ('float32', 'int16') or lists of numbers ('json')"""
+    if client_format not in FORMATS:
+        await sio.emit('reply', "unknown format {} (formats: {})".format(client_format, ", ".join(FORMATS)), room=sid, namespace='/emg')
+        return
+    print("sid", sid, "format", client_format)
+    join_stream(sid, dict(clients[sid]['settings'], format=client_format))
+
+@sio.on('settings', namespace='/emg')
+async def set_settings(sid, settings):
+    """
+    The client gives its display and its subscription (can be sent again, e.g. when the graphs are resized):
+        {'width': pixels, 'window': seconds shown, 'rate': messages per second, 'method': 'minmax'/'lttb'/'none',
+         'channels': [indices of the channels], 'queue': messages waiting at most, 'policy': 'drop'/'coalesce',
+         'ack': true if the client acknowledges its messages}
+    The server replies 'settings' with the samples per point (bucket) and the channels sent.
+    """
+    try:
+        width = int(settings.get('width', 1000))
+        window = float(settings.get('window', 1.))
+        rate = float(settings.get('rate', 1. / EMIT_PERIOD))
+        method = settings.get('method', 'minmax')
+        channels = [ int(c) for c in settings.get('channels', range(reader.num_channels)) ]
+        length = int(settings.get('queue', QUEUE_LENGTH))
+        policy = settings.get('policy', 'drop')
+        ack = bool(settings.get('ack', False))
+        if not MIN_WIDTH <= width <= MAX_WIDTH or window <= 0 or not MIN_RATE <= rate <= MAX_RATE or method not in METHODS \
+           or not channels or len(set(channels)) != len(channels) or not all([ 0 <= c < reader.num_channels for c in channels ]) \
+           or not 1 <= length <= MAX_QUEUE_LENGTH or policy not in POLICIES:
+            raise ValueError(settings)
+    except (AttributeError, TypeError, ValueError):
+        await sio.emit('reply', "wrong settings {} (width {}-{} pixels, window > 0 s, rate {}-{} per second, method: {}, channels 0-{}, queue 1-{}, policy: {})".format(
+            settings, MIN_WIDTH, MAX_WIDTH, MIN_RATE, MAX_RATE, ", ".join(METHODS), reader.num_channels - 1, MAX_QUEUE_LENGTH, ", ".join(POLICIES)),
+            room=sid, namespace='/emg')
+        return
+    client = clients[sid]
+    bucket = bucket_size(width, window, dev.rate) if method != 'none' else 1
+    client.update(queue=OutgoingQueue(length, policy), ack=ack, in_flight=0)
+    join_stream(sid, dict(client['settings'], method=method, bucket=bucket, rate=rate, channels=channels))
+    print("sid", sid, "settings", method, bucket, "samples per point,", rate, "per second, channels", channels, "queue", length, policy)
+    await sio.emit('settings', {'method': method, 'bucket': bucket, 'points_per_bucket': points_per_bucket(method), 'rate': rate, 'channels': channels,
+                                'points': int(window * dev.rate / bucket) * points_per_bucket(method)}, room=sid, namespace='/emg')
 
 @sio.on('emg message', namespace='/emg')
 async def message(sid, data):
@@ -60,14 +162,80 @@ async def message(sid, data):
 
 ######################### Asynchrone ###################################
 
-async def start_background_task_trigno():
-    while True:
-        data = dev.read() # get data from trigno
-        # we get a numpy.darray (8, 270) # print(type(data), data.shape)
-        datalist = data.tolist() # instead of serialize/json
-        await sio.emit('message', datalist, namespace='/emg')
-        await sio.sleep(0.1)
+async def read_stream(stream):
+    """
+    Message of the samples of the stream not read yet, decimated (None if no complete bucket),
+    the samples of an incomplete bucket wait for the next call
+    """
+    settings = stream['settings']
+    bucket = settings['bucket']
+    if stream['cursor'] is None: # start at the next bucket, the buckets are aligned on the sample index
+        stream['cursor'] = -(-reader.total_samples // bucket) * bucket
+    # at most the samples of MAX_LATENCY and of one period
+    data, first, dropped = reader.read_new(stream['cursor'], max_samples=int((MAX_LATENCY + 1. / settings['rate']) * dev.rate))
+    if dropped:
+        stream['dropped'] += dropped
+        print("overrun: {} samples dropped ({} in total) for {} clients".format(dropped, stream['dropped'], len(stream['sids'])))
+        for sid in list(stream['sids']):
+            await sio.emit('overrun', {'dropped': dropped, 'total': stream['dropped']}, room=sid, namespace='/emg')
+        skip = min(-first % bucket, data.shape[1]) # align on the next bucket again
+        data, first, stream['state'] = data[:, skip:], first + skip, None
+
+    if settings['channels'] != list(range(data.shape[0])): # subset and/or order of the channels
+        data = data[settings['channels']]
+    points, consumed, stream['state'] = decimate(data, settings['method'], bucket, stream['state'])
+    stream['cursor'] = first + consumed
+    if not points.shape[1]:
+        return None
+    # first is the index of the first sample of the first bucket
+    message = new_message(points, first, first + consumed, stream['sequence'], settings['format'])
+    stream['sequence'] += 1
+    return message
+
+def acknowledgement(sid):
+    def acknowledged(*args):
+        client = clients.get(sid)
+        if client is not None:
+            client['in_flight'] = max(0, client['in_flight'] - 1)
+    return acknowledged
+
+async def send_queue(sid, client, now):
+    """Send the messages waiting in the queue of the client (at most MAX_IN_FLIGHT not acknowledged if the client acknowledges them)"""
+    if client['ack'] and client['in_flight'] and now - client['sent_time'] > ACK_TIMEOUT:
+        client['in_flight'] = 0 # acknowledgements lost, send again
+    while client['queue'] and (not client['ack'] or client['in_flight'] < MAX_IN_FLIGHT):
+        message = client['queue'].pop()
+        # binary frames as 'frame' and json lists as 'message', encoded once for all the clients of the stream
+        event = 'message' if message['format'] == 'json' else 'frame'
+        if client['ack']:
+            client['in_flight'] += 1
+            client['sent_time'] = now
+            await sio.emit(event, payload(message), room=sid, namespace='/emg', callback=acknowledgement(sid))
+        else:
+            await sio.emit(event, payload(message), room=sid, namespace='/emg')
 
+async def start_background_task_trigno():
+    running = True
+    while running:
+        now = time.perf_counter()
+        for key, stream in list(streams.items()):
+            if now < stream['next_time']:
+                continue
+            stream['next_time'] = now + 1. / stream['settings']['rate']
+            try:
+                message = await read_stream(stream)
+            except IOError as e:
+                print(e)
+                running = False
+                break
+            if message is not None:
+                for sid in stream['sids']:
+                    clients[sid]['queue'].push(message)
+        for sid, client in list(clients.items()):
+            await send_queue(sid, client, now)
+        await sio.sleep(TICK)
+
+    reader.stop()
     dev.stop() # stop the trigno
     print("stopped trigno")
 
@@ -0,0 +1,291 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+
+@author: Martin
+
+Description:
+    On-disk cache of the markers created (or modified) by the operations of a recipe (see pipeline.py)
+
+    Each result is stored under a key: sha256 of the operation name, its parameters (and calibration model)
+    and the values/residuals of the markers it uses. When a recipe is run again, an operation whose inputs did not change
+    is not computed: the cached arrays are put back in the acquisition (replacing the points that exist, appending the others).
+    Changing a parameter (e.g. the calibration frame) or one of the input markers only recomputes the operations concerned.
+
+    The entries are .npz files in the cache directory. When the total size is over the limit, the least recently used
+    entries (oldest modification time, updated at each use) are removed.
+
+    Cached operations: create_anatomical_marker (not with residualFile), create_midpoint_marker, create_projected_marker,
+                       copy_marker, create_virtual_markers, setOrigin
+
+Usage:
+    python pipeline.py -i inputFile.c3d/trc -r recipe.json -o outputFile.c3d/trc --cacheDir cache/ --cacheSize 2000
+    python marker_cache.py -c cache/              # display the size of the cache
+    python marker_cache.py -c cache/ --clear      # remove all the entries
+    or import as module
+
+Requirements:
+    btk
+    numpy
+
+"""
+
+text="marker_cache module"
+
+import hashlib
+import json
+import os
+
+import numpy as np
+
+CACHE_VERSION = 2 # change it when the results of an operation change, to not reuse the old entries
+ENTRY_EXTENSION = ".npz"
+
+def operation_markers(operation, params, labels, model=None):
+    """
+    Markers used and created by an operation: (inputs, outputs, optional inputs)
+    labels are the labels of all the points of the acquisition
+    The optional inputs are used only if they exist (existing values kept with onlyMissingFrames...)
+    Returns None if the operation is not cached
+    """
+
+    if operation == "create_midpoint_marker":
+        return [params["marker1"], params["marker2"]], [params["newMarkerName"]], []
+
+    if operation == "create_projected_marker":
+        return [params["marker"], params["markerVia"]], [params["newMarkerName"]], []
+
+    if operation == "copy_marker":
+        return [params["marker1"]], [params["newMarkerName"]], []
+
+    if operation == "create_virtual_markers":
+        from create_virtual_markers import definition_inputs
+        outputs = []
+        inputs = []
+        for definition in params["definitions"]:
+            inputs += [ name for name in definition_inputs(definition) if name not in outputs and name not in inputs ]
+            if definition["name"] not in outputs:
+                outputs.append(definition["name"])
+        return inputs, outputs, []
+
+    if operation == "setOrigin":
+        # all the points are moved
+        return list(labels), list(labels), []
+
+    if operation == "create_anatomical_marker" and model is not None and not params.get("residualFile"):
+        model, newMarkerNames = model
+        inputs = []
+        outputs = []
+        landmarks = []
+        for cluster in model:
+            names = dict(cluster.get("newMarkerNames", {}))
+            names.update(newMarkerNames)
+            inputs += [ name for name in cluster["clusterMarkers"] if name not in inputs ]
+            landmarks += list(cluster["landmarks"])
+            outputs += [ names.get(name, name) for name in cluster["landmarks"] ]
+        return inputs, outputs, landmarks + outputs
+
+    return None
+
+def to_json(value):
+    """
+    json.dumps default: numpy arrays (calibration models) as lists
+    """
+
+    return np.asarray(value).tolist()
+
+class MarkerCache(object):
+    """
+    Content-addressed store of marker arrays in a directory, with a maximum size (bytes, None for no limit)
+    """
+
+    def __init__(self, directory, maxBytes=None):
+        self.directory = directory
+        self.maxBytes = maxBytes
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(directory, exist_ok=True)
+
+    def key(self, operation, params, acq, inputs, model=None):
+        """
+        sha256 of the operation, its parameters, the calibration model, and the frames, values and residuals of the input markers
+        """
+
+        number_steps = acq.GetLastFrame() - acq.GetFirstFrame() +1
+
+        h = hashlib.sha256()
+        h.update(json.dumps({ "version": CACHE_VERSION, "operation": operation, "params": params, "model": model, "frames": number_steps },
+                            sort_keys=True, default=to_json).encode())
+        for name in inputs:
+            point = acq.GetPoint(name)
+            h.update(name.encode() + b"\0")
+            h.update(np.ascontiguousarray(point.GetValues()[0:number_steps,:], dtype=float).tobytes())
+            h.update(np.ascontiguousarray(point.GetResiduals()[0:number_steps,:], dtype=float).tobytes())
+        return h.hexdigest()
+
+    def entry_file(self, key):
+        return os.path.join(self.directory, key + ENTRY_EXTENSION)
+
+    def get(self, key):
+        """
+        The cached markers [(label, values, residuals, appended)], or None if the key is not in the cache
+        """
+
+        entryFile = self.entry_file(key)
+        try:
+            with np.load(entryFile) as entry:
+                labels = list(entry["labels"])
+                appended = list(entry["appended"])
+                markers = [ (str(label), entry["values_{}".format(i)], entry["residuals_{}".format(i)], bool(appended[i])) for i, label in enumerate(labels) ]
+            os.utime(entryFile) # most recently used
+        except (OSError, KeyError, ValueError): # not cached (or removed by another process meanwhile)
+            self.misses += 1
+            return None
+        self.hits += 1
+        return markers
+
+    def put(self, key, markers):
+        """
+        Store the markers [(label, values, residuals, appended)] under the key, then remove the least recently used entries if needed
+        """
+
+        arrays = { "labels": np.array([ label for label, values, residuals, appended in markers ]),
+                   "appended": np.array([ appended for label, values, residuals, appended in markers ], dtype=bool) }
+        for i, (label, values, residuals, appended) in enumerate(markers):
+            arrays["values_{}".format(i)] = values
+            arrays["residuals_{}".format(i)] = residuals
+
+        # write then rename, so that other processes never read an incomplete entry
+        temporaryFile = os.path.join(self.directory, "{}.{}.tmp".format(key, os.getpid()))
+        with open(temporaryFile, "wb") as f:
+            np.savez(f, **arrays)
+        os.replace(temporaryFile, self.entry_file(key))
+
+        self.evict()
+
+    def entries(self):
+        """
+        List of (modification time, size, file) of the entries
+        """
+
+        entries = []
+        for name in os.listdir(self.directory):
+            if name.endswith(ENTRY_EXTENSION):
+                try:
+                    stat = os.stat(os.path.join(self.directory, name))
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, os.path.join(self.directory, name)))
+        return entries
+
+    def size(self):
+        return sum([ size for mtime, size, entryFile in self.entries() ])
+
+    def evict(self):
+        """
+        Remove the least recently used entries until the cache is under maxBytes
+        """
+
+        if self.maxBytes is None:
+            return
+        entries = sorted(self.entries())
+        total = sum([ size for mtime, size, entryFile in entries ])
+        for mtime, size, entryFile in entries:
+            if total <= self.maxBytes:
+                break
+            try:
+                os.remove(entryFile)
+            except OSError:
+                pass
+            total -= size
+
+    def clear(self):
+        for mtime, size, entryFile in self.entries():
+            os.remove(entryFile)
+
+def read_markers(acq, labels, firstAppended=None):
+    """
+    [(label, values, residuals, appended)] of the markers of the acquisition
+    The points from the index firstAppended on were appended by the operation: a label found there is the appended point
+    (even if a point with the same label existed before), the others are existing points replaced by the operation
+    """
+
+    number_steps = acq.GetLastFrame() - acq.GetFirstFrame() +1
+    if firstAppended is None:
+        firstAppended = acq.GetPointNumber()
+    appendedIndex = {}
+    for i in range(firstAppended, acq.GetPointNumber()):
+        appendedIndex.setdefault(acq.GetPoint(i).GetLabel(), i)
+    markers = []
+    for label in labels:
+        appended = label in appendedIndex
+        point = acq.GetPoint(appendedIndex[label] if appended else label)
+        markers.append((label, np.array(point.GetValues()[0:number_steps,:], dtype=float), np.array(point.GetResiduals()[0:number_steps,:], dtype=float), appended))
+    return markers
+
+def splice_markers(acq, markers):
+    """
+    Put the cached markers in the acquisition as the operation did: append the points it appended, replace the values of the others
+    """
+
+    import btk
+
+    number_steps = acq.GetLastFrame() - acq.GetFirstFrame() +1
+    for label, values, residuals, appended in markers:
+        if not appended:
+            point = acq.GetPoint(label)
+        else:
+            point = btk.btkPoint(number_steps) # create an empty new point object
+            point.SetLabel(label)
+            acq.AppendPoint(point)
+        point.SetValues(values)
+        point.SetResiduals(residuals)
+    return acq
+
+def cached_operation(cache, acq, operation, params, function, model=None):
+    """
+    Run function(acq) -> acq, or put back its result from the cache if the operation was already done with the same inputs
+
+    model is the (calibration model, newMarkerNames) of create_anatomical_marker
+    Returns the acquisition and True if the result came from the cache
+    """
+
+    if cache is None:
+        return function(acq), False
+
+    labels = [ acq.GetPoint(i).GetLabel() for i in range(acq.GetPointNumber()) ]
+    markers = operation_markers(operation, params, labels, model)
+    if markers is None:
+        return function(acq), False
+
+    inputs, outputs, optional = markers
+    inputs = inputs + [ name for name in optional if name in labels and name not in inputs ]
+    if not all([ name in labels for name in inputs ]):
+        return function(acq), False # a marker is missing: let the operation report it
+
+    key = cache.key(operation, params, acq, inputs, model)
+    cached = cache.get(key)
+    if cached is not None:
+        return splice_markers(acq, cached), True
+
+    numberOfPoints = acq.GetPointNumber()
+    acq = function(acq)
+    cache.put(key, read_markers(acq, outputs, numberOfPoints))
+    return acq, False
+
+
+
+if __name__ == '__main__':
+
+    # If loaded as main, initialise the parser (to start the program with arguments)
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Display or clear the marker cache', formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument ('--cacheDir', '-c', metavar = 'cacheDir', type = str, help = 'The cache directory', required=True)
+    parser.add_argument ('--clear',          help = 'Remove all the entries', required=False, action='store_true', default=False)
+    args = parser.parse_args()
+
+    cache = MarkerCache(args.cacheDir)
+    if args.clear:
+        cache.clear()
+    print("{} entries, {:.1f} MB in {}".format(len(cache.entries()), cache.size() / 1e6, args.cacheDir))
@@ -0,0 +1,128 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+
+@author: Martin
+
+Description:
+    Helpers to find markers by label in an acquisition: label -> index map built once, and selection of labels with lists,
+    glob patterns ("HUM_*") or regular expressions ("re:^HUM_CL-(Sup|Inf)"), separated by commas (outside of brackets)
+    Used by remove_marker and rename_markers
+
+Usage:
+    import as module
+
+Requirements:
+    btk (any btk-like acquisition)
+
+"""
+
+text="marker_labels module"
+
+import fnmatch
+import re
+
+def get_labels(acq):
+    """
+    Labels of all the points, in order
+    """
+
+    return [ acq.GetPoint(i).GetLabel() for i in range(acq.GetPointNumber()) ]
+
+def get_label_index(acq):
+    """
+    {label : index} of all the points (built once instead of scanning the points for each label)
+    """
+
+    return { label : i for i, label in enumerate(get_labels(acq)) }
+
+def split_patterns(patterns):
+    """
+    "A,B,C*" or ["A", "B", "C*"] -> ["A", "B", "C*"]
+    The commas inside brackets ("re:^M{1,3}$", "[A,B]*") do not split (escaped brackets "\\(" are not counted)
+    """
+
+    if isinstance(patterns, str):
+        parts = [""]
+        depth = 0
+        escaped = False
+        for c in patterns:
+            if escaped:
+                escaped = False
+            elif c == "\\":
+                escaped = True
+            elif c in "([{":
+                depth += 1
+            elif c in ")]}":
+                depth = max(0, depth - 1)
+            elif c == "," and depth == 0:
+                parts.append("")
+                continue
+            parts[-1] += c
+        patterns = parts
+    return [ pattern.strip() for pattern in patterns if pattern.strip() ]
+
+def is_regex(pattern):
+    return pattern.startswith("re:")
+
+def is_glob(pattern):
+    return any([ c in pattern for c in "*?[" ])
+
+def glob_regex(pattern):
+    """
+    Regular expression of a glob pattern, with a group for each wildcard ("*", "?", "[...]")
+    """
+
+    parts = []
+    i = 0
+    while i < len(pattern):
+        c = pattern[i]
+        if c == "*":
+            parts.append("(.*)")
+        elif c == "?":
+            parts.append("(.)")
+        elif c == "[" and "]" in pattern[i+2:]:
+            end = pattern.index("]", i + 2)
+            content = pattern[i+1:end]
+            parts.append("([{}{}])".format("^" if content.startswith("!") else "", re.escape(content.lstrip("!"))))
+            i = end
+        else:
+            parts.append(re.escape(c))
+        i += 1
+    return re.compile("".join(parts) + r"\Z")
+
+def glob_rename(target, match):
+    """
+    New label of a label matching a glob pattern (match of glob_regex): the wildcards "*" and "?" of the target
+    are replaced by the parts matched by the wildcards of the pattern, in order ("HUM_*" -> "ARM_*")
+    """
+
+    groups = iter(match.groups())
+    return re.sub(r"[*?]", lambda m: next(groups, ""), target)
+
+def match_labels(patterns, labels, strict=True):
+    """
+    Labels matching a list of patterns: exact labels, glob patterns or regular expressions (prefixed with "re:")
+
+    Returns the matching labels without duplicates, in the order of the patterns.
+    With strict, an exact label that does not exist or a pattern that matches nothing raises a KeyError.
+    """
+
+    matched = []
+    missing = []
+    for pattern in split_patterns(patterns):
+        if is_regex(pattern):
+            regex = re.compile(pattern[3:])
+            found = [ label for label in labels if regex.search(label) ]
+        elif is_glob(pattern):
+            found = fnmatch.filter(labels, pattern)
+        else:
+            found = [pattern] if pattern in labels else []
+        if not found:
+            missing.append(pattern)
+        matched += [ label for label in found if label not in matched ]
+
+    if strict and missing:
+        raise KeyError("No marker matching {}".format(", ".join(missing)))
+
+    return matched
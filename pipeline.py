@@ -0,0 +1,306 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+
+@author: Martin
+
+Description:
+    Run a list of operations (a recipe) on a motion file in a single pass:
+    the file is read once, all the operations are done in memory with the functions of the other modules, and the result is written once.
+    The time spent in each step is displayed at the end.
+
+    The recipe is a json (or yaml) list of operations, each one with the same parameters as the standalone script
+    (long names of the arguments, without the input/output files):
+
+    [
+        {"operation": "rename_markers",           "markerListFrom": "M1original,M2original", "markerListTo": "M1,M2"},
+        {"operation": "create_midpoint_marker",   "marker1": "M1", "marker2": "M2", "newMarkerName": "MID"},
+        {"operation": "create_anatomical_marker", "model": "humerus.json"},
+        {"operation": "remove_marker",            "marker": ["M2", "HUM_*"]},
+        {"operation": "setOrigin",                "markerOrigin": "MID"}
+    ]
+
+    Arguments that can be repeated in a script (--clusterMarkers, --anatMarkers, --clusterWeights) are lists, one entry per repetition.
+
+    Operations: rename_markers, copy_marker, create_midpoint_marker, create_projected_marker,
+                create_anatomical_marker (calibration file or saved --model), create_virtual_markers ("definitions": list or json file),
+                remove_marker, setOrigin
+
+    With --cacheDir, the markers created by the operations are kept in a cache (see marker_cache.py): when the recipe is run again,
+    only the operations whose parameters or input markers changed are computed.
+
+Usage:
+    python pipeline.py -i inputFile.c3d/trc -r recipe.json -o outputFile.c3d/trc
+    python pipeline.py -i inputFile.c3d/trc -r recipe.json -o outputFile.c3d/trc --cacheDir cache/ --cacheSize 2000
+    or import as module
+
+Requirements:
+    btk
+    numpy
+    pyyaml (only for yaml recipes)
+
+"""
+
+text="pipeline module"
+
+import argparse
+import time
+
+from proc_log import get_logger, profile_stage
+
+log = get_logger("pipeline")
+
+def load_recipe(recipeFile):
+    """
+    Load a recipe: a list of operations, or a dict with the list in "steps"
+    """
+
+    if recipeFile.endswith((".yaml", ".yml")):
+        try:
+            import yaml
+        except ImportError:
+            raise Exception("pyyaml is needed to read the yaml recipe {}".format(recipeFile))
+        with open(recipeFile) as f:
+            recipe = yaml.safe_load(f)
+    else:
+        import json
+        with open(recipeFile) as f:
+            recipe = json.load(f)
+
+    if isinstance(recipe, dict):
+        recipe = recipe["steps"]
+
+    for step in recipe:
+        if step.get("operation") not in OPERATIONS:
+            raise Exception("Unknown operation {} in the recipe {} (operations: {})".format(step.get("operation"), recipeFile, ", ".join(OPERATIONS)))
+
+    return recipe
+
+def as_string_list(value):
+    """
+    The scripts take lists as "a,b,c": accept python lists in the recipe too
+    """
+
+    if isinstance(value, (list, tuple)):
+        return ",".join([ str(x) for x in value ])
+    return value
+
+def as_repeated_list(value):
+    """
+    Arguments that can be repeated in the scripts (one per cluster) are a list in the recipe, one entry per repetition
+    (each entry is "a,b,c" or a list). A single string is a single repetition.
+    """
+
+    if value is None:
+        return None
+    if isinstance(value, str):
+        return [value]
+    return [ as_string_list(x) for x in value ]
+
+######################################################
+# Operations: (acq, parameters, calibrations) -> acq
+######################################################
+
+def run_rename_markers(acq, params, calibrations):
+    from rename import rename_markers
+    # lists are passed as they are (a regular expression can contain a ",")
+    args = argparse.Namespace(markerListFrom=params["markerListFrom"], markerListTo=params["markerListTo"],
+                              ignoreMissing=params.get("ignoreMissing", False))
+    return rename_markers(acq, args)
+
+def run_copy_marker(acq, params, calibrations):
+    from copy_marker import copy_marker
+    args = argparse.Namespace(marker1=params["marker1"], newMarkerName=params["newMarkerName"])
+    return copy_marker(acq, args)
+
+def run_create_midpoint_marker(acq, params, calibrations):
+    from create_midpoint_marker import create_midpoint_marker
+    args = argparse.Namespace(marker1=params["marker1"], marker2=params["marker2"], newMarkerName=params["newMarkerName"])
+    return create_midpoint_marker(acq, args)
+
+def run_create_projected_marker(acq, params, calibrations):
+    from create_projected_marker import create_projected_marker
+    args = argparse.Namespace(input=None, output=None, marker=params["marker"], markerVia=params["markerVia"], axis=params["axis"], newMarkerName=params["newMarkerName"])
+    acq_modified = create_projected_marker(acq, args)
+    if acq_modified is None:
+        raise Exception("create_projected_marker failed (axis {})".format(params["axis"]))
+    return acq_modified
+
+def anatomical_model(params, calibrations):
+    """
+    The calibration model and the newMarkerNames of a create_anatomical_marker step
+    """
+
+    import create_anatomical_marker as anat
+
+    # The calibration models are built (or loaded) once, then kept for the next steps and files
+    if "model" in params:
+        key = ("model", params["model"])
+        if key not in calibrations:
+            calibrations[key] = anat.load_calibration_model(params["model"])
+        model = calibrations[key]
+        newMarkerNames = {}
+        for anatMarkers in (as_repeated_list(params.get("anatMarkers")) or []):
+            newMarkerNames.update(anat.parse_marker_pairs(anatMarkers))
+    else:
+        args = argparse.Namespace(
+            calibrationFrame=params.get("calibrationFrame"),
+            calibrationFrames=params.get("calibrationFrames"),
+            clusterMarkers=as_repeated_list(params["clusterMarkers"]),
+            clusterWeights=as_repeated_list(params.get("clusterWeights")),
+            anatMarkers=as_repeated_list(params.get("anatMarkers")),
+            anatMarkerName=params.get("anatMarkerName"),
+            newMarkerName=params.get("newMarkerName"))
+        key = ("calibration", params["calibrationFile"], repr(sorted(vars(args).items())))
+        if key not in calibrations:
+            from convert_c3d_trc import read_c3dtrc
+            calibrations[key] = anat.calibrate_clusters_from_args(read_c3dtrc(params["calibrationFile"], backend="memmap"), args) # the calibration file is only read
+        model = calibrations[key]
+        newMarkerNames = {}
+
+    return model, newMarkerNames
+
+def run_create_anatomical_marker(acq, params, calibrations):
+    from create_anatomical_marker import apply_calibration_model
+    model, newMarkerNames = anatomical_model(params, calibrations)
+    return apply_calibration_model(acq, model, newMarkerNames, params.get("onlyMissingFrames", False), params.get("residualFile"))
+
+def run_create_virtual_markers(acq, params, calibrations):
+    from create_virtual_markers import create_virtual_markers, load_definitions
+    definitions = params["definitions"]
+    if isinstance(definitions, str): # json file of definitions
+        definitions = load_definitions(definitions)
+    return create_virtual_markers(acq, definitions)
+
+def run_remove_marker(acq, params, calibrations):
+    from remove_marker import remove_marker
+    args = argparse.Namespace(marker=params["marker"], ignoreMissing=params.get("ignoreMissing", False))
+    return remove_marker(acq, args)
+
+def run_setOrigin(acq, params, calibrations):
+    from setOrigin import setOrigin
+    axisMarkers = params.get("axisMarkers")
+    if isinstance(axisMarkers, str):
+        axisMarkers = axisMarkers.split(",")
+    return setOrigin(acq, params["markerOrigin"], axisMarkers, params.get("staticFrame"))
+
+OPERATIONS = {
+    "rename_markers":           run_rename_markers,
+    "copy_marker":              run_copy_marker,
+    "create_midpoint_marker":   run_create_midpoint_marker,
+    "create_projected_marker":  run_create_projected_marker,
+    "create_anatomical_marker": run_create_anatomical_marker,
+    "create_virtual_markers":   run_create_virtual_markers,
+    "remove_marker":            run_remove_marker,
+    "setOrigin":                run_setOrigin,
+}
+
+# Parameters of the operations that are input files (the definitions can also be given as a list)
+INPUT_FILE_PARAMS = ("model", "calibrationFile", "definitions")
+
+def recipe_input_files(recipe):
+    """
+    The files read by the steps of the recipe (calibration models, calibration files, definitions...), besides the input file
+    """
+
+    return [ step[key] for step in recipe for key in INPUT_FILE_PARAMS if isinstance(step.get(key), str) ]
+
+def run_pipeline(acq, recipe, calibrations=None, cache=None):
+    """
+    Run all the operations of the recipe on the acquisition, in memory
+
+    calibrations is an optional dict to keep the calibration models between several calls (several files)
+    cache is an optional marker_cache.MarkerCache: the operations whose inputs did not change are not computed again
+    Returns the modified acquisition and the list of (step name, seconds)
+    """
+
+    from marker_cache import cached_operation
+
+    if calibrations is None:
+        calibrations = {}
+
+    timings = []
+    for i, step in enumerate(recipe):
+        operation = step["operation"]
+        params = { key : value for key, value in step.items() if key != "operation" }
+        log.info("[{}] {} {}".format(i, operation, params))
+        start = time.perf_counter()
+        with profile_stage("[{}] {}".format(i, operation), frames=acq.GetPointFrameNumber()):
+            if cache is None:
+                acq = OPERATIONS[operation](acq, params, calibrations)
+                cached = False
+            else:
+                model = None
+                if operation == "create_anatomical_marker":
+                    model = anatomical_model(params, calibrations)
+                if operation == "create_virtual_markers" and isinstance(params["definitions"], str):
+                    from create_virtual_markers import load_definitions
+                    params["definitions"] = load_definitions(params["definitions"])
+                acq, cached = cached_operation(cache, acq, operation, params, lambda acq: OPERATIONS[operation](acq, params, calibrations), model)
+        timings.append(("[{}] {}{}".format(i, operation, " (cached)" if cached else ""), time.perf_counter() - start))
+
+    return acq, timings
+
+def process_file(inputFile, recipe, outputFile, calibrations=None, cache=None):
+    """
+    Read the input file once, run the recipe (with the optional marker cache), write the output file once
+    Returns the list of (step name, seconds), including the read and the write
+    """
+
+    from convert_c3d_trc import read_c3dtrc, write_c3dtrc
+    from create_anatomical_marker import residual_file_name
+
+    # one residual file per output file (residualFile can be a template of the output file name)
+    recipe = [ dict(step, residualFile=residual_file_name(step["residualFile"], outputFile)) if step.get("residualFile") else step for step in recipe ]
+
+    start = time.perf_counter()
+    with profile_stage("read") as stage:
+        acq = read_c3dtrc(inputFile)
+        stage["frames"] = acq.GetPointFrameNumber()
+    timings = [("read", time.perf_counter() - start)]
+
+    acq, stepTimings = run_pipeline(acq, recipe, calibrations, cache)
+    timings += stepTimings
+
+    start = time.perf_counter()
+    with profile_stage("write", frames=acq.GetPointFrameNumber()):
+        write_c3dtrc(acq, outputFile)
+    timings.append(("write", time.perf_counter() - start))
+
+    return timings
+
+def print_timings(timings):
+    total = sum([ seconds for name, seconds in timings ])
+    print("\nTimings:")
+    for name, seconds in timings:
+        print("    {:40s} {:10.4f} s".format(name, seconds))
+    print("    {:40s} {:10.4f} s".format("total", total))
+
+
+
+if __name__ == '__main__':
+
+    # If loaded as main, initialise the parser (to start the program with arguments)
+    from proc_log import add_arguments, setup_from_args, finish_from_args
+
+    parser = argparse.ArgumentParser(description='Run a recipe of operations in a single pass', formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument ('--input',  '-i', metavar = 'input',  type = str, help = 'The input file to load (.c3d or .trc)',        required=True)
+    parser.add_argument ('--recipe', '-r', metavar = 'recipe', type = str, help = 'The recipe: list of operations (.json or .yaml)', required=True)
+    parser.add_argument ('--output', '-o', metavar = 'output', type = str, help = 'The output file to write (.c3d or .trc)',      required=True)
+    parser.add_argument ('--cacheDir',  '-c',  metavar = 'cacheDir',  type = str,   help = 'Directory of the marker cache (default: no cache)', required=False, default=None)
+    parser.add_argument ('--cacheSize', '-cs', metavar = 'cacheSize', type = float, help = 'Maximum size of the marker cache in MB (default: no limit)', required=False, default=None)
+    add_arguments(parser)
+    args = parser.parse_args()
+    setup_from_args(args)
+
+    cache = None
+    if args.cacheDir is not None:
+        from marker_cache import MarkerCache
+        cache = MarkerCache(args.cacheDir, None if args.cacheSize is None else int(args.cacheSize * 1e6))
+
+    recipe = load_recipe(args.recipe)
+    timings = process_file(args.input, recipe, args.output, None, cache)
+    print_timings(timings)
+    if cache is not None:
+        print("Marker cache: {} operations reused, {} computed".format(cache.hits, cache.misses))
+    finish_from_args(args)
@@ -0,0 +1,199 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+
+@author: Martin
+
+Description:
+    Logging and profiling shared by all the modules
+
+    Logging: the modules log their messages with get_logger(name) instead of printing them. Nothing below the warnings
+    is displayed by default: -v displays the steps (info), -vv the details (debug). --logFile also writes them in a file.
+
+    Profiling (off by default): the modules record their stages (read, compute, append, write) with profile_stage(), which
+    does nothing unless the profiling is enabled. When it is (--profile profile.json), each stage records its wall time,
+    the number of frames processed and the size of the arrays it allocated (and the tracemalloc peak with --profileMemory),
+    and the records are exported as json.
+
+Usage:
+    import as module:
+
+    from proc_log import get_logger, profile_stage
+    log = get_logger("myModule")
+    log.info("Processing {} frames".format(numFrames))
+    with profile_stage("myModule.compute", frames=numFrames) as stage:
+        values = ...
+        stage["bytes"] = values.nbytes
+
+    in a script:
+    add_arguments(parser)       # -v, --logFile, --profile, --profileMemory
+    setup_from_args(args)
+    ...
+    finish_from_args(args)      # export the profile
+
+Requirements:
+    (none)
+
+"""
+
+text="proc_log module"
+
+import contextlib
+import json
+import logging
+import sys
+import time
+
+LOGGER_NAME = "proc_tools"
+LOG_FORMAT = "%(message)s"
+LOG_FILE_FORMAT = "%(asctime)s %(levelname)s %(name)s: %(message)s"
+
+def get_logger(name):
+    """
+    Logger of a module (child of the proc_tools logger)
+    """
+
+    return logging.getLogger("{}.{}".format(LOGGER_NAME, name))
+
+def setup_logging(verbosity=0, logFile=None):
+    """
+    Display the messages of the modules: warnings only (0), info (1) or debug (2 or more), optionally also in logFile
+    """
+
+    level = logging.WARNING if verbosity <= 0 else (logging.INFO if verbosity == 1 else logging.DEBUG)
+
+    logger = logging.getLogger(LOGGER_NAME)
+    logger.setLevel(level)
+    logger.handlers = []
+    logger.propagate = False
+
+    handler = logging.StreamHandler(sys.stderr)
+    handler.setFormatter(logging.Formatter(LOG_FORMAT))
+    logger.addHandler(handler)
+
+    if logFile:
+        handler = logging.FileHandler(logFile)
+        handler.setFormatter(logging.Formatter(LOG_FILE_FORMAT))
+        logger.addHandler(handler)
+
+    return logger
+
+@contextlib.contextmanager
+def quiet():
+    """
+    Only the warnings are displayed inside the block (e.g. the same messages for every chunk of a file)
+    """
+
+    logger = logging.getLogger(LOGGER_NAME)
+    level = logger.level
+    logger.setLevel(max(level, logging.WARNING))
+    try:
+        yield
+    finally:
+        logger.setLevel(level)
+
+######################################################
+# Profiling
+######################################################
+
+class Profiler(object):
+    """
+    Records of the stages: name, seconds, frames, bytes (and peakBytes with trackMemory)
+    """
+
+    def __init__(self, trackMemory=False):
+        self.records = []
+        self.trackMemory = trackMemory
+        self._open = [] # stages in progress (nested), to keep the peak of the inner stages in the outer ones
+        if trackMemory:
+            import tracemalloc
+            tracemalloc.start()
+
+    @contextlib.contextmanager
+    def stage(self, name, frames=None, nbytes=None):
+        record = { "stage": name, "seconds": None, "frames": frames, "bytes": nbytes }
+        if self.trackMemory:
+            import tracemalloc
+            # the peak is reset for this stage: the stage in progress keeps the peak so far
+            if self._open:
+                self._open[-1]["peakBytes"] = max(self._open[-1].get("peakBytes", 0), tracemalloc.get_traced_memory()[1])
+            tracemalloc.reset_peak()
+            self._open.append(record)
+        start = time.perf_counter()
+        try:
+            yield record
+        finally:
+            record["seconds"] = time.perf_counter() - start
+            if self.trackMemory:
+                record["peakBytes"] = max(record.get("peakBytes", 0), tracemalloc.get_traced_memory()[1])
+                self._open.pop()
+                if self._open:
+                    self._open[-1]["peakBytes"] = max(self._open[-1].get("peakBytes", 0), record["peakBytes"])
+            self.records.append(record)
+
+    def add(self, name, seconds, frames=None, nbytes=None):
+        """
+        Add a stage timed elsewhere (e.g. in a worker process)
+        """
+
+        self.records.append({ "stage": name, "seconds": seconds, "frames": frames, "bytes": nbytes })
+
+    def summary(self):
+        """
+        Records summed by stage name: {name : {calls, seconds, frames, bytes}}
+        """
+
+        summary = {}
+        for record in self.records:
+            total = summary.setdefault(record["stage"], { "calls": 0, "seconds": 0.0, "frames": 0, "bytes": 0 })
+            total["calls"] += 1
+            total["seconds"] += record["seconds"]
+            total["frames"] += record["frames"] or 0
+            total["bytes"] += record["bytes"] or 0
+            if "peakBytes" in record:
+                total["peakBytes"] = max(total.get("peakBytes", 0), record["peakBytes"])
+        return summary
+
+    def export_json(self, jsonFile):
+        with open(jsonFile, "w") as f:
+            json.dump({ "summary": self.summary(), "records": self.records }, f, indent=4)
+
+# The profiler of the process, None when the profiling is off
+_profiler = None
+
+def enable_profiling(trackMemory=False):
+    global _profiler
+    _profiler = Profiler(trackMemory)
+    return _profiler
+
+def get_profiler():
+    return _profiler
+
+def profile_stage(name, frames=None, nbytes=None):
+    """
+    Context manager recording a stage if the profiling is enabled, yields the record dict (frames and bytes can be set in the block)
+    """
+
+    if _profiler is None:
+        return contextlib.nullcontext({})
+    return _profiler.stage(name, frames, nbytes)
+
+######################################################
+# Command line
+######################################################
+
+def add_arguments(parser):
+    parser.add_argument ('--verbose',       '-v',                               help = 'Display the steps (-v) or the details (-vv)',  required=False, action='count', default=0)
+    parser.add_argument ('--logFile',             metavar = 'logFile', type = str, help = 'Also write the messages in this file',         required=False, default=None)
+    parser.add_argument ('--profile',             metavar = 'profile', type = str, help = 'Save the time, frames and bytes of each stage as json', required=False, default=None)
+    parser.add_argument ('--profileMemory',                                       help = 'Also record the peak memory of each stage (tracemalloc, slower)', required=False, action='store_true', default=False)
+
+def setup_from_args(args):
+    setup_logging(args.verbose, args.logFile)
+    if args.profile:
+        enable_profiling(args.profileMemory)
+
+def finish_from_args(args):
+    if args.profile and _profiler is not None:
+        _profiler.export_json(args.profile)
+        get_logger("proc_log").info("Saved the profile as {}".format(args.profile))
@@ -0,0 +1,348 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+
+@author: Martin
+
+Description:
+    Read the markers of a c3d file without btk (read only)
+    Only the header and the parameter section are parsed: the data section is opened as a numpy memmap,
+    and the point block is a strided view on it. Asking for some markers or a range of frames only reads these bytes
+    (the analog channels are never read).
+    Float and integer (scaled) storage are supported, for the Intel, DEC and MIPS processor types.
+
+    C3DAcquisition gives the same read methods as a btk acquisition (GetPoint(label).GetValues(), GetFirstFrame(), ...),
+    so the functions of the other modules that only read markers can use it instead of read_c3dtrc
+
+Usage:
+    python read_c3d_memmap.py -i inputFile.c3d
+    # can specify --markers "M1,M2" and --frames "first:last" (indices from 0) to print only some markers/frames
+    or import as module:
+
+    c3d = C3DFile("file.c3d")
+    data, residuals = c3d.get_points(["M1", "M2"], slice(0, 1000))   # (frames, markers, 3), NaN where not visible
+    acq = C3DAcquisition("file.c3d")                                 # read only, btk-like
+    values = acq.GetPoint("M1").GetValues()
+
+Material:
+    https://www.c3d.org/HTML/default.htm (file format documentation)
+
+Requirements:
+    numpy
+
+"""
+
+text="read_c3d_memmap module"
+
+import numpy as np
+
+BLOCK_SIZE = 512
+PROCESSOR_INTEL = 84
+PROCESSOR_DEC = 85
+PROCESSOR_MIPS = 86
+
+def dec_to_ieee(words):
+    """
+    DEC floats (uint32 words read little endian): swap the two 16 bit words then divide by 4
+    """
+
+    words = np.asarray(words, dtype=np.uint32)
+    swapped = ((words >> 16) | (words << 16)).astype(np.uint32)
+    return swapped.view(np.float32) / 4.0
+
+class C3DFile(object):
+    """
+    Header, parameters and memory mapped point data of a c3d file
+
+    Attributes
+    ----------
+    parameters : dict
+        {group name : {parameter name : value}}, names in upper case
+    labels : list of str
+        Labels of the points (POINT:LABELS, LABELS2...)
+    rate : float
+        Point frame rate
+    first_frame, last_frame : int
+        First and last frame numbers
+    scale : float
+        POINT:SCALE (negative for float storage)
+    units : str
+        POINT:UNITS
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+
+        with open(filename, "rb") as f:
+            header = f.read(BLOCK_SIZE)
+            parameterBlock = header[0]
+            f.seek((parameterBlock - 1) * BLOCK_SIZE)
+            parameterHeader = f.read(4)
+            self.processor = parameterHeader[3]
+            f.seek((parameterBlock - 1) * BLOCK_SIZE)
+            parameterSection = f.read(parameterHeader[2] * BLOCK_SIZE)
+
+        if self.processor not in (PROCESSOR_INTEL, PROCESSOR_DEC, PROCESSOR_MIPS):
+            raise IOError("Unknown processor type {} in {}".format(self.processor, filename))
+        self.endian = ">" if self.processor == PROCESSOR_MIPS else "<"
+
+        self._parse_header(header)
+        self.parameters = self._parse_parameters(parameterSection)
+        self._init_from_parameters()
+        self._init_memmap()
+
+    ######################################################
+    # Header and parameters
+    ######################################################
+
+    def _int16(self, data):
+        return np.frombuffer(data, dtype=self.endian + "i2")
+
+    def _float32(self, data):
+        if self.processor == PROCESSOR_DEC:
+            return dec_to_ieee(np.frombuffer(data, dtype="<u4"))
+        return np.frombuffer(data, dtype=self.endian + "f4")
+
+    def _parse_header(self, header):
+        words = self._int16(header[0:20])
+        self.point_number = int(words[1])
+        self.analog_per_frame = int(words[2]) # total number of analog samples per 3D frame (channels x samples)
+        self.first_frame = int(words[3]) & 0xFFFF
+        self.last_frame = int(words[4]) & 0xFFFF
+        self.scale = float(self._float32(header[12:16])[0])
+        self.data_block = int(words[8]) & 0xFFFF
+        self.rate = float(self._float32(header[20:24])[0])
+
+    def _parse_parameters(self, section):
+        """
+        Returns {group : {parameter : value}}
+        """
+
+        groups = {}
+        rawParameters = []
+
+        position = 4
+        while position < len(section):
+            nameLength = abs(np.frombuffer(section[position:position+1], dtype=np.int8)[0])
+            if nameLength == 0:
+                break
+            groupId = int(np.frombuffer(section[position+1:position+2], dtype=np.int8)[0])
+            name = section[position+2:position+2+nameLength].decode("ascii", "replace").upper()
+            offsetPosition = position + 2 + nameLength
+            offset = int(self._int16(section[offsetPosition:offsetPosition+2])[0])
+
+            if groupId < 0:
+                groups[-groupId] = name
+            else:
+                cursor = offsetPosition + 2
+                dataType = int(np.frombuffer(section[cursor:cursor+1], dtype=np.int8)[0])
+                numberDimensions = section[cursor+1]
+                dimensions = list(section[cursor+2:cursor+2+numberDimensions])
+                cursor += 2 + numberDimensions
+                size = abs(dataType) * int(np.prod(dimensions)) if dimensions else abs(dataType)
+                rawParameters.append((groupId, name, dataType, dimensions, section[cursor:cursor+size]))
+
+            if offset == 0:
+                break
+            position = offsetPosition + offset
+
+        parameters = { name : {} for name in groups.values() }
+        for groupId, name, dataType, dimensions, data in rawParameters:
+            group = groups.get(groupId, str(groupId))
+            parameters.setdefault(group, {})[name] = self._decode_parameter(dataType, dimensions, data)
+
+        return parameters
+
+    def _decode_parameter(self, dataType, dimensions, data):
+        if dataType == -1: # characters: first dimension is the length of the strings
+            if len(dimensions) <= 1:
+                return data.decode("ascii", "replace").strip()
+            length = dimensions[0]
+            return [ data[i:i+length].decode("ascii", "replace").strip() for i in range(0, len(data), length) ]
+        if dataType == 1:
+            values = np.frombuffer(data, dtype=np.int8)
+        elif dataType == 2:
+            values = self._int16(data)
+        elif dataType == 4:
+            values = self._float32(data)
+        else:
+            return data
+        if not dimensions:
+            return values[0]
+        return values.reshape(dimensions[::-1]) # the first dimension varies the fastest
+
+    def get_parameter(self, group, name, default=None):
+        return self.parameters.get(group, {}).get(name, default)
+
+    def _init_from_parameters(self):
+        # Labels (more than 255 points are continued in LABELS2, LABELS3...)
+        labels = list(self.get_parameter("POINT", "LABELS", []))
+        i = 2
+        while self.get_parameter("POINT", "LABELS{}".format(i)) is not None:
+            labels += list(self.get_parameter("POINT", "LABELS{}".format(i)))
+            i += 1
+        self.labels = labels[0:self.point_number]
+        self.labels += [ "uname*{}".format(i+1) for i in range(len(self.labels), self.point_number) ]
+
+        self.units = self.get_parameter("POINT", "UNITS", "mm")
+
+        dataStart = self.get_parameter("POINT", "DATA_START")
+        if dataStart is not None:
+            self.data_block = int(dataStart) & 0xFFFF
+
+        # Number of frames: the header is limited to 65535, long trials use TRIAL:ACTUAL_END_FIELD (2 words)
+        self.frame_number = self.last_frame - self.first_frame + 1
+        actualStart = self.get_parameter("TRIAL", "ACTUAL_START_FIELD")
+        actualEnd = self.get_parameter("TRIAL", "ACTUAL_END_FIELD")
+        if actualStart is not None and actualEnd is not None:
+            first = (int(actualStart[0]) & 0xFFFF) + ((int(actualStart[1]) & 0xFFFF) << 16)
+            last = (int(actualEnd[0]) & 0xFFFF) + ((int(actualEnd[1]) & 0xFFFF) << 16)
+            if last - first + 1 > self.frame_number:
+                self.first_frame, self.last_frame = first, last
+                self.frame_number = last - first + 1
+
+    def _init_memmap(self):
+        self.is_float = self.scale < 0
+        if self.is_float:
+            dtype = "<u4" if self.processor == PROCESSOR_DEC else self.endian + "f4"
+        else:
+            dtype = self.endian + "i2"
+
+        frameWords = 4 * self.point_number + self.analog_per_frame
+        self._data = np.memmap(self.filename, dtype=dtype, mode="r", offset=(self.data_block - 1) * BLOCK_SIZE, shape=(self.frame_number, frameWords))
+
+        # (frames, points, 4) strided view: x, y, z, residual word (the analog samples are skipped)
+        self.points = self._data[:, 0:4*self.point_number].reshape(self.frame_number, self.point_number, 4)
+
+    ######################################################
+    # Point data
+    ######################################################
+
+    def label_index(self, label):
+        try:
+            return self.labels.index(label)
+        except ValueError:
+            raise KeyError("No point {} in {}".format(label, self.filename))
+
+    def get_points(self, labels=None, frames=None, missingAsNan=True):
+        """
+        Coordinates of some points (all by default) at some frames (slice or indices from 0, all by default)
+
+        Returns values (frames, points, 3) as float64 and residuals (frames, points), -1 where the point is not visible.
+        Values where the point is not visible are NaN (missingAsNan) or 0 (as btk)
+        """
+
+        indices = slice(None) if labels is None else [ self.label_index(label) for label in labels ]
+        frames = slice(None) if frames is None else frames
+
+        # only the selected frames and points are read from the file
+        raw = self.points[frames][:, indices, :]
+        if self.is_float and self.processor == PROCESSOR_DEC:
+            raw = dec_to_ieee(raw)
+
+        values = np.asarray(raw[:, :, 0:3], dtype=np.float64)
+        residualWord = np.asarray(raw[:, :, 3], dtype=np.float64)
+
+        if not self.is_float:
+            values *= self.scale
+
+        # residual word: < 0 the point is not visible, otherwise the low byte is the residual (x |scale|)
+        missing = residualWord < 0
+        residuals = (residualWord.astype(np.int32) & 0xFF) * abs(self.scale)
+        residuals[missing] = -1.0
+        values[missing] = np.nan if missingAsNan else 0.0
+
+        return values, residuals
+
+class C3DPoint(object):
+    """
+    Read only, btk-like point of a C3DAcquisition: the values are read from the file when asked
+    """
+
+    def __init__(self, c3d, index):
+        self._c3d = c3d
+        self._index = index
+
+    def GetLabel(self):
+        return self._c3d.labels[self._index]
+
+    def GetValues(self):
+        values, residuals = self._c3d.get_points([self.GetLabel()], missingAsNan=False)
+        return values[:, 0, :]
+
+    def GetResiduals(self):
+        values, residuals = self._c3d.get_points([self.GetLabel()])
+        return residuals[:, 0:1]
+
+    def GetFrameNumber(self):
+        return self._c3d.frame_number
+
+class C3DAcquisition(object):
+    """
+    Read only, btk-like acquisition on a memory mapped c3d file
+    """
+
+    def __init__(self, filename):
+        self._c3d = C3DFile(filename)
+
+    def GetPoint(self, key):
+        if isinstance(key, str):
+            key = self._c3d.label_index(key)
+        if key < 0 or key >= self._c3d.point_number:
+            raise IndexError("No point {} in {}".format(key, self._c3d.filename))
+        return C3DPoint(self._c3d, key)
+
+    def GetPointNumber(self):
+        return self._c3d.point_number
+
+    def GetFirstFrame(self):
+        return self._c3d.first_frame
+
+    def GetLastFrame(self):
+        return self._c3d.last_frame
+
+    def GetPointFrameNumber(self):
+        return self._c3d.frame_number
+
+    def GetPointFrequency(self):
+        return self._c3d.rate
+
+    def GetPointUnit(self):
+        return self._c3d.units
+
+    def get_points(self, labels=None, frames=None, missingAsNan=True):
+        """
+        All the points (or some) in one read, see C3DFile.get_points()
+        """
+
+        return self._c3d.get_points(labels, frames, missingAsNan)
+
+    def AppendPoint(self, point):
+        raise IOError("C3DAcquisition is read only, use read_c3dtrc to modify the file")
+
+    def RemovePoint(self, index):
+        raise IOError("C3DAcquisition is read only, use read_c3dtrc to modify the file")
+
+
+
+if __name__ == "__main__":
+
+    # If loaded as main, initialise the parser (to start the program with arguments)
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Read the markers of a c3d file without btk', formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument ('--input',   '-i', metavar = 'input',   type = str, help = 'The input file to load (.c3d)',                     required=True)
+    parser.add_argument ('--markers', '-m', metavar = 'markers', type = str, help = 'Only read these markers "M1,M2" (default: all)',     required=False, default=None)
+    parser.add_argument ('--frames',  '-f', metavar = 'frames',  type = str, help = 'Only read these frames "first:last" (indices from 0)', required=False, default=None)
+    args = parser.parse_args()
+
+    c3d = C3DFile(args.input)
+    print("{}: {} points, frames {} to {} at {} Hz, {} storage".format(args.input, c3d.point_number, c3d.first_frame, c3d.last_frame, c3d.rate, "float" if c3d.is_float else "integer"))
+    print("Labels: {}".format(", ".join(c3d.labels)))
+
+    frames = None
+    if args.frames:
+        first, last = args.frames.split(":")
+        frames = slice(int(first), int(last) + 1)
+    values, residuals = c3d.get_points(args.markers.split(",") if args.markers else None, frames)
+    print(values)
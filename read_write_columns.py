@@ -0,0 +1,247 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+
+@author: Martin
+
+Description:
+    Columnar copy of the markers of a trial, to read the same files many times without parsing them again
+
+    A .columns directory holds one .npy file per marker (contiguous (frames, 3) array, float64 or float32, NaN where not visible),
+    residuals.npy (frames, markers, -1 where not visible) and meta.json (labels, rate, first frame, number of frames, units, dtype, source file).
+    The arrays are memory mapped when read: ColumnsAcquisition is a read only, btk-like acquisition (as C3DAcquisition) that
+    only reads the markers asked, read_columns_acquisition() loads everything in a btk acquisition.
+
+    Cache: cached_columns() converts a .c3d/.trc file once into a cache directory and returns the .columns copy,
+    converted again only if the modification time or the size of the source file changed.
+    read_c3dtrc(inputFile, columnCache="cache/") (convert_c3d_trc module) reads through this cache.
+
+Usage:
+    python convert_c3d_trc.py -i inputFile.c3d -o outputFile.columns --float32
+    python convert_c3d_trc.py -i inputFile.c3d -o outputFile.trc --columnCache cache/
+    or import as module:
+
+    directory = cached_columns("trial.c3d", "cache/")
+    acq = ColumnsAcquisition(directory)       # memory mapped, read only
+    values = acq.GetPoint("M1").GetValues()
+
+Requirements:
+    numpy
+    btk (btk acquisitions only)
+
+"""
+
+text="read_write_columns module"
+
+import json
+import os
+import shutil
+
+import numpy as np
+
+from read_c3d_memmap import C3DAcquisition
+
+COLUMNS_VERSION = 1
+COLUMNS_EXTENSION = ".columns"
+META_FILE = "meta.json"
+RESIDUALS_FILE = "residuals.npy"
+
+def is_columns(filename):
+    return filename.rstrip("/\\").lower().endswith(COLUMNS_EXTENSION)
+
+def marker_file(index):
+    return "marker_{}.npy".format(index)
+
+######################################################
+# Write
+######################################################
+
+def write_columns_arrays(directory, values, residuals, labels, rate, firstFrame=1, units="mm", float32=False, source=None):
+    """
+    Write (frames, markers, 3) values (NaN where not visible) and (frames, markers) residuals as a .columns directory
+    The directory is written next to its final place then renamed, so that other processes never read an incomplete copy
+    (an existing copy is renamed aside first, and deleted once the new one is in place)
+    """
+
+    dtype = np.float32 if float32 else np.float64
+    missing = np.isnan(values).any(axis=2) | (residuals < 0)
+
+    temporaryDirectory = "{}.{}.tmp".format(directory.rstrip("/\\"), os.getpid())
+    os.makedirs(temporaryDirectory)
+    for i in range(len(labels)):
+        markerValues = np.array(values[:, i, :], dtype=dtype)
+        markerValues[missing[:, i]] = np.nan
+        np.save(os.path.join(temporaryDirectory, marker_file(i)), markerValues)
+    np.save(os.path.join(temporaryDirectory, RESIDUALS_FILE), np.where(missing, -1.0, residuals).astype(dtype))
+
+    meta = { "version": COLUMNS_VERSION, "labels": list(labels), "rate": float(rate), "firstFrame": int(firstFrame),
+             "numFrames": int(values.shape[0]), "units": units, "dtype": np.dtype(dtype).name, "source": source }
+    with open(os.path.join(temporaryDirectory, META_FILE), "w") as f:
+        json.dump(meta, f, indent=4)
+
+    # move the old copy aside (one rename) before putting the new one in place, and only delete it then:
+    # the other processes find either a complete old copy or a complete new one, never a half deleted directory
+    oldDirectory = None
+    if os.path.isdir(directory):
+        oldDirectory = "{}.{}.old".format(directory.rstrip("/\\"), os.getpid())
+        try:
+            os.rename(directory, oldDirectory)
+        except OSError: # moved by another process meanwhile
+            oldDirectory = None
+    try:
+        os.rename(temporaryDirectory, directory)
+    except OSError: # written by another process meanwhile
+        shutil.rmtree(temporaryDirectory, ignore_errors=True)
+    if oldDirectory is not None:
+        shutil.rmtree(oldDirectory, ignore_errors=True)
+
+def write_columns(acq, directory, float32=False):
+    """
+    Write the markers of a btk acquisition as a .columns directory
+    """
+
+    from read_write_trc import acquisition_to_array
+
+    values, labels = acquisition_to_array(acq)
+    residuals = np.column_stack([ acq.GetPoint(label).GetResiduals()[:, 0] for label in labels ]) if labels else np.empty((values.shape[0], 0))
+    write_columns_arrays(directory, values, residuals, labels, acq.GetPointFrequency(), acq.GetFirstFrame(), acq.GetPointUnit(), float32)
+
+######################################################
+# Read
+######################################################
+
+class ColumnsFile(object):
+    """
+    Metadata and memory mapped arrays of a .columns directory, same reading interface as read_c3d_memmap.C3DFile
+    """
+
+    def __init__(self, directory):
+        self.filename = directory
+        with open(os.path.join(directory, META_FILE)) as f:
+            self.meta = json.load(f)
+        if self.meta.get("version") != COLUMNS_VERSION:
+            raise IOError("Unknown version {} of {}".format(self.meta.get("version"), directory))
+
+        self.labels = self.meta["labels"]
+        self.point_number = len(self.labels)
+        self.rate = self.meta["rate"]
+        self.first_frame = self.meta["firstFrame"]
+        self.frame_number = self.meta["numFrames"]
+        self.last_frame = self.first_frame + self.frame_number - 1
+        self.units = self.meta["units"]
+
+        self.residuals = np.load(os.path.join(directory, RESIDUALS_FILE), mmap_mode="r")
+        self._markers = {} # memory mapped marker arrays, opened when first used
+
+    def label_index(self, label):
+        try:
+            return self.labels.index(label)
+        except ValueError:
+            raise KeyError("No point {} in {}".format(label, self.filename))
+
+    def marker(self, index):
+        """
+        Memory mapped (frames, 3) array of a marker
+        """
+
+        if index not in self._markers:
+            self._markers[index] = np.load(os.path.join(self.filename, marker_file(index)), mmap_mode="r")
+        return self._markers[index]
+
+    def get_points(self, labels=None, frames=None, missingAsNan=True):
+        """
+        Coordinates of some points (all by default) at some frames (slice or indices from 0, all by default)
+
+        Returns values (frames, points, 3) as float64 and residuals (frames, points), -1 where the point is not visible.
+        Values where the point is not visible are NaN (missingAsNan) or 0 (as btk)
+        """
+
+        indices = list(range(self.point_number)) if labels is None else [ self.label_index(label) for label in labels ]
+        frames = slice(None) if frames is None else frames
+
+        residuals = np.array(self.residuals[frames][:, indices], dtype=np.float64)
+        values = np.empty(residuals.shape + (3,))
+        for i, index in enumerate(indices):
+            values[:, i, :] = self.marker(index)[frames]
+
+        if not missingAsNan:
+            values[residuals < 0] = 0.0
+
+        return values, residuals
+
+class ColumnsAcquisition(C3DAcquisition):
+    """
+    Read only, btk-like acquisition on a .columns directory (the markers are read from the memory mapped arrays when asked)
+    """
+
+    def __init__(self, directory):
+        self._c3d = ColumnsFile(directory)
+
+def read_columns_acquisition(directory):
+    """
+    Read a .columns directory into a btk acquisition (missing values are 0 with a residual of -1, as with the btk reader)
+    """
+
+    from read_write_trc import array_to_acquisition
+
+    columns = ColumnsFile(directory)
+    values, residuals = columns.get_points()
+    return array_to_acquisition(values, columns.labels, columns.rate, columns.first_frame, columns.units, residuals)
+
+######################################################
+# Cache
+######################################################
+
+def source_signature(inputFile):
+    stat = os.stat(inputFile)
+    return { "file": os.path.abspath(inputFile), "mtime": stat.st_mtime_ns, "size": stat.st_size }
+
+def columns_cache_directory(inputFile, cacheDir, float32=False):
+    """
+    The .columns directory of a source file in the cache (one per source path and dtype)
+    """
+
+    import hashlib
+
+    digest = hashlib.sha256(os.path.abspath(inputFile).encode()).hexdigest()[0:16]
+    stem = os.path.splitext(os.path.basename(inputFile))[0]
+    return os.path.join(cacheDir, "{}-{}{}{}".format(stem, digest, "-f32" if float32 else "", COLUMNS_EXTENSION))
+
+def read_source_arrays(inputFile):
+    """
+    values (frames, markers, 3), residuals (frames, markers), labels, rate, first frame and units of a .c3d or .trc file
+    """
+
+    if inputFile.lower().endswith(".c3d"):
+        from read_c3d_memmap import C3DFile
+        c3d = C3DFile(inputFile)
+        values, residuals = c3d.get_points()
+        return values, residuals, list(c3d.labels), c3d.rate, c3d.first_frame, c3d.units
+
+    if inputFile.lower().endswith(".trc"):
+        from read_write_trc import read_trc
+        values, header = read_trc(inputFile)
+        residuals = np.where(np.isnan(values).any(axis=2), -1.0, 0.0)
+        return values, residuals, header["labels"], header["dataRate"], header["firstFrame"], header["units"]
+
+    raise IOError("Cannot convert {} to columns: only .c3d and .trc files".format(inputFile))
+
+def cached_columns(inputFile, cacheDir, float32=False):
+    """
+    The .columns copy of inputFile in cacheDir, converted now if it does not exist or if the source file changed (mtime or size)
+    """
+
+    directory = columns_cache_directory(inputFile, cacheDir, float32)
+    source = source_signature(inputFile)
+    try:
+        with open(os.path.join(directory, META_FILE)) as f:
+            meta = json.load(f)
+        if meta.get("version") == COLUMNS_VERSION and meta.get("source") == source:
+            return directory
+    except (IOError, ValueError):
+        pass
+
+    os.makedirs(cacheDir, exist_ok=True)
+    values, residuals, labels, rate, firstFrame, units = read_source_arrays(inputFile)
+    write_columns_arrays(directory, values, residuals, labels, rate, firstFrame, units, float32, source)
+    return directory
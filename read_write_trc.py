@@ -0,0 +1,308 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+
+@author: Martin
+
+Description:
+    Read/write trc files with numpy, without going through the btk point objects
+    The data block is loaded in one call into a (frames, markers, 3) array, and written back with one formatting call per block of frames.
+    Missing values (empty fields in the file) are NaN in the array.
+
+    read_trc_acquisition() and write_trc_acquisition() convert from/to a btk acquisition, so they can be used instead of
+    the btk reader/writer (convert_c3d_trc.read_c3dtrc and write_c3dtrc use them for the .trc files)
+
+Usage:
+    python read_write_trc.py -i inputFile.trc -o outputFile.trc
+    # can specify --markers "M1,M2" to only load some of the markers
+    or import as module:
+
+    data, header = read_trc("file.trc")                           # all the markers
+    data, header = read_trc("file.trc", markers=["M1", "M2"])     # only the columns of M1 and M2 are converted
+    write_trc("out.trc", data, header["labels"], header["dataRate"], header["firstFrame"], header["units"])
+    for data, frameNumbers, times in iter_trc("file.trc", 10000): # by chunks of 10000 frames
+        ...
+
+Requirements:
+    numpy
+    btk (only to convert from/to a btk acquisition)
+
+"""
+
+text="read_write_trc module"
+
+import io
+import os
+
+import numpy as np
+
+HEADER_LINES = 5 # PathFileType, header names, header values, marker labels, X1 Y1 Z1...
+FRAMES_PER_BLOCK = 1000 # number of frames formatted at once when writing
+
+def read_trc_header(trcFile):
+    """
+    Read the 5 header lines of a trc file
+
+    Returns a dict: dataRate, cameraRate, numFrames, numMarkers, units, origDataRate, origDataStartFrame, origNumFrames, labels
+    """
+
+    with open(trcFile) as f:
+        lines = [ f.readline().rstrip("\r\n") for i in range(HEADER_LINES) ]
+
+    names = lines[1].split("\t")
+    values = lines[2].split("\t")
+    fields = dict(zip(names, values))
+
+    # labels are every 3 columns after Frame# and Time
+    labels = [ label.strip() for label in lines[3].split("\t")[2::3] ]
+    labels = [ label for label in labels if label ]
+
+    header = {
+        "dataRate":           float(fields.get("DataRate", 0)),
+        "cameraRate":         float(fields.get("CameraRate", fields.get("DataRate", 0))),
+        "numFrames":          int(fields.get("NumFrames", 0)),
+        "numMarkers":         int(fields.get("NumMarkers", len(labels))),
+        "units":              fields.get("Units", "mm"),
+        "origDataRate":       float(fields.get("OrigDataRate", fields.get("DataRate", 0))),
+        "origDataStartFrame": int(float(fields.get("OrigDataStartFrame", 1))),
+        "origNumFrames":      int(fields.get("OrigNumFrames", fields.get("NumFrames", 0))),
+        "labels":             labels,
+    }
+
+    return header
+
+def trc_columns(header, trcFile, markers=None):
+    """
+    Labels and columns of the data block to load (all the markers, or only markers)
+    """
+
+    labels = header["labels"]
+    if markers is not None:
+        missing = [ marker for marker in markers if marker not in labels ]
+        if missing:
+            raise KeyError("Markers {} not found in {}".format(missing, trcFile))
+        indices = [ labels.index(marker) for marker in markers ]
+        labels = list(markers)
+    else:
+        indices = range(len(labels))
+
+    # Frame#, Time, then X Y Z of the selected markers
+    columns = [0, 1] + [ 2 + 3*index + axis for index in indices for axis in range(3) ]
+    return labels, columns
+
+def parse_trc_rows(text, columns, numMarkers):
+    """
+    Parse rows of the data block (text) into data (frames, markers, 3), frame numbers and times
+    """
+
+    try:
+        # one bulk call (empty lines are skipped)
+        block = np.loadtxt(io.StringIO(text), delimiter="\t", usecols=columns, ndmin=2)
+    except ValueError:
+        # some values are missing (empty fields): fill them with nan and parse again
+        text = text.replace("\t\t", "\tnan\t").replace("\t\t", "\tnan\t").replace("\t\n", "\tnan\n")
+        if text.endswith("\t"):
+            text += "nan"
+        block = np.loadtxt(io.StringIO(text), delimiter="\t", usecols=columns, ndmin=2)
+
+    return block[:, 2:].reshape(len(block), numMarkers, 3), block[:, 0].astype(int), block[:, 1]
+
+def read_trc_first_frame(trcFile, header=None):
+    """
+    Frame number of the first data row, as read_trc() (origDataStartFrame of the header if the file has no data row)
+    """
+
+    if header is None:
+        header = read_trc_header(trcFile)
+    with open(trcFile) as f:
+        for i in range(HEADER_LINES):
+            f.readline()
+        for line in f:
+            if line.strip():
+                return int(float(line.split("\t", 1)[0]))
+    return header["origDataStartFrame"]
+
+def read_trc(trcFile, markers=None):
+    """
+    Read a trc file into a numpy array
+
+    markers: optional list of marker labels, only these columns are converted (in this order)
+
+    Returns data (frames, markers, 3) and the header dict (see read_trc_header) with also:
+    labels (of the loaded markers), frameNumbers, times and firstFrame
+    """
+
+    header = read_trc_header(trcFile)
+    labels, columns = trc_columns(header, trcFile, markers)
+
+    with open(trcFile) as f:
+        for i in range(HEADER_LINES):
+            f.readline()
+        text = f.read()
+
+    data, frameNumbers, times = parse_trc_rows(text, columns, len(labels))
+
+    header["labels"] = labels
+    header["frameNumbers"] = frameNumbers
+    header["times"] = times
+    header["firstFrame"] = int(frameNumbers[0]) if len(frameNumbers) else header["origDataStartFrame"]
+
+    return data, header
+
+def iter_trc(trcFile, chunkFrames, markers=None):
+    """
+    Read a trc file by chunks of chunkFrames frames (only one chunk of text in memory at a time)
+
+    Yields (data (frames, markers, 3), frameNumbers, times) for each chunk, the labels are the ones of read_trc_header (or markers)
+    """
+
+    import itertools
+
+    header = read_trc_header(trcFile)
+    labels, columns = trc_columns(header, trcFile, markers)
+
+    with open(trcFile) as f:
+        for i in range(HEADER_LINES):
+            f.readline()
+        rows = ( line for line in f if line.strip() ) # the empty lines are skipped
+        while True:
+            text = "".join(itertools.islice(rows, chunkFrames))
+            if not text:
+                break
+            yield parse_trc_rows(text, columns, len(labels))
+
+def trc_header_text(trcFile, labels, dataRate, numFrames, firstFrame=1, units="mm"):
+    """
+    The 5 header lines (and the empty line) of a trc file
+    """
+
+    numMarkers = len(labels)
+    header = "PathFileType\t4\t(X/Y/Z)\t{}\n".format(os.path.basename(trcFile))
+    header += "DataRate\tCameraRate\tNumFrames\tNumMarkers\tUnits\tOrigDataRate\tOrigDataStartFrame\tOrigNumFrames\n"
+    header += "{:.2f}\t{:.2f}\t{}\t{}\t{}\t{:.2f}\t{}\t{}\n".format(dataRate, dataRate, numFrames, numMarkers, units, dataRate, firstFrame, numFrames)
+    header += "Frame#\tTime\t" + "".join([ "{}\t\t\t".format(label) for label in labels ]) + "\n"
+    header += "\t\t" + "\t".join([ "X{0}\tY{0}\tZ{0}".format(i+1) for i in range(numMarkers) ]) + "\n"
+    header += "\n"
+    return header
+
+def write_trc_rows(f, data, dataRate, firstFrame=1):
+    """
+    Write the rows of a (frames, markers, 3) array starting at frame number firstFrame in the open file f, NaN are written as empty fields
+    (the data block of a trc file can be written by several calls, one per chunk of frames)
+    """
+
+    data = np.asarray(data, dtype=float)
+    numFrames, numMarkers = data.shape[0], data.shape[1]
+
+    frameNumbers = np.arange(firstFrame, firstFrame + numFrames)
+    times = (frameNumbers - 1) / dataRate
+
+    # one row: Frame# Time X1 Y1 Z1 X2 ...
+    rows = np.empty((numFrames, 2 + 3*numMarkers))
+    rows[:, 0] = frameNumbers
+    rows[:, 1] = times
+    rows[:, 2:] = data.reshape(numFrames, 3*numMarkers)
+    rowFormat = "%d\t%.5f" + "\t%.5f" * (3*numMarkers) + "\n"
+
+    # format a whole block of frames with a single % operation
+    for first in range(0, numFrames, FRAMES_PER_BLOCK):
+        block = rows[first:first + FRAMES_PER_BLOCK]
+        text = (rowFormat * len(block)) % tuple(block.ravel())
+        if np.isnan(block).any():
+            text = text.replace("nan", "")
+        f.write(text)
+
+def write_trc(trcFile, data, labels, dataRate, firstFrame=1, units="mm"):
+    """
+    Write a (frames, markers, 3) array as a trc file, NaN are written as empty fields
+    """
+
+    data = np.asarray(data, dtype=float)
+    if len(labels) != data.shape[1]:
+        raise Exception("{} labels given for {} markers".format(len(labels), data.shape[1]))
+
+    with open(trcFile, "w") as f:
+        f.write(trc_header_text(trcFile, labels, dataRate, data.shape[0], firstFrame, units))
+        write_trc_rows(f, data, dataRate, firstFrame)
+
+def array_to_acquisition(data, labels, dataRate, firstFrame=1, units="mm", residuals=None):
+    """
+    btk acquisition from a (frames, markers, 3) array: NaN values are 0 with a residual of -1, as with the btk reader
+    residuals (frames, markers) are optional (0 where visible by default)
+    """
+
+    import btk
+
+    numFrames, numMarkers = data.shape[0], data.shape[1]
+
+    acq = btk.btkAcquisition()
+    acq.Init(numMarkers, numFrames)
+    acq.SetPointFrequency(dataRate)
+    acq.SetFirstFrame(firstFrame)
+    acq.SetPointUnit(btk.btkPoint.Marker, units)
+
+    missing = np.isnan(data).any(axis=2) # (frames, markers)
+    if residuals is None:
+        residuals = np.zeros(missing.shape)
+    residuals = np.where(missing, -1.0, residuals)
+    data = np.where(missing[:, :, np.newaxis], 0.0, data)
+
+    for i, label in enumerate(labels):
+        point = acq.GetPoint(i)
+        point.SetLabel(label)
+        point.SetValues(np.ascontiguousarray(data[:, i, :]))
+        point.SetResiduals(np.ascontiguousarray(residuals[:, i:i+1]))
+
+    return acq
+
+def acquisition_to_array(acq):
+    """
+    (frames, markers, 3) array of the markers of a btk acquisition (NaN where the residual is < 0) and their labels
+    """
+
+    import btk
+
+    points = [ acq.GetPoint(i) for i in range(acq.GetPointNumber()) ]
+    points = [ point for point in points if point.GetType() == btk.btkPoint.Marker ]
+
+    numFrames = acq.GetPointFrameNumber()
+    data = np.empty((numFrames, len(points), 3))
+    for i, point in enumerate(points):
+        data[:, i, :] = point.GetValues()
+        data[point.GetResiduals()[:, 0] < 0, i, :] = np.nan
+
+    return data, [ point.GetLabel() for point in points ]
+
+def read_trc_acquisition(trcFile):
+    """
+    Read a trc file into a btk acquisition (missing values are 0 with a residual of -1, as with the btk reader)
+    """
+
+    data, header = read_trc(trcFile)
+    return array_to_acquisition(data, header["labels"], header["dataRate"], header["firstFrame"], header["units"])
+
+def write_trc_acquisition(acq, trcFile):
+    """
+    Write the markers of a btk acquisition as a trc file (frames with a residual < 0 are written as empty fields)
+    """
+
+    data, labels = acquisition_to_array(acq)
+    write_trc(trcFile, data, labels, acq.GetPointFrequency(), acq.GetFirstFrame(), acq.GetPointUnit())
+
+
+
+if __name__ == "__main__":
+
+    # If loaded as main, initialise the parser (to start the program with arguments)
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Read/write trc files with numpy', formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument ('--input',   '-i', metavar = 'input',   type = str, help = 'The input file to load (.trc)',                required=True)
+    parser.add_argument ('--output',  '-o', metavar = 'output',  type = str, help = 'The output file to write (.trc)',               required=True)
+    parser.add_argument ('--markers', '-m', metavar = 'markers', type = str, help = 'Only load these markers "M1,M2" (default: all)', required=False, default=None)
+    args = parser.parse_args()
+
+    data, header = read_trc(args.input, args.markers.split(",") if args.markers else None)
+    print("Loaded {} frames, {} markers from {}".format(data.shape[0], data.shape[1], args.input))
+    write_trc(args.output, data, header["labels"], header["dataRate"], header["firstFrame"], header["units"])
+    print("Saved as {}".format(args.output))
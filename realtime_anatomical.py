@@ -0,0 +1,307 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+
+@author: Martin
+
+Description:
+    Real time reconstruction of the anatomical markers of a calibration model (see create_anatomical_marker.py)
+    from streamed cluster markers, frame by frame or by small batches of frames
+
+    The reconstructor is built once from the calibration model: the cluster geometry is centred and weighted in advance and
+    the work arrays are allocated for maxFrames frames, so update() only computes the fit (same least squares fit as
+    rigid_transform_3D) and writes the landmarks in the output array (given with out= to not allocate anything but the SVD).
+    Frames with an occluded cluster marker use the fit on the visible markers (rigid_transform_3D), NaN if less than 3 are visible.
+
+    The command line measures the latency of update() on synthetic motion of the model clusters, or replays a motion file
+    through it and reports the maximum difference with the offline reconstruction (apply_calibration_model).
+
+Usage:
+    python realtime_anatomical.py --model humerus.json --frames 10000 --batch 1
+    python realtime_anatomical.py --model humerus.json --motionFile trial1.c3d --batch 10
+    or import as module:
+
+    reconstructor = ModelReconstructor(load_calibration_model("humerus.json"))
+    landmarks = np.empty((len(reconstructor.outputMarkers), 3))
+    for frame in stream:    # (len(reconstructor.inputMarkers), 3) in the order of reconstructor.inputMarkers
+        reconstructor.update(frame, out=landmarks)
+
+Requirements:
+    numpy
+    btk (--motionFile only)
+
+"""
+
+text="realtime_anatomical module"
+
+import time
+
+import numpy as np
+
+from proc_log import get_logger
+
+log = get_logger("realtime_anatomical")
+
+class ClusterReconstructor(object):
+    """
+    Landmarks of one cluster of a calibration model from the positions of its cluster markers
+    """
+
+    def __init__(self, cluster, maxFrames=1):
+        geometry = np.asarray(cluster["clusterGeometry"], dtype=float)
+        weights = np.asarray(cluster["clusterWeights"], dtype=float)
+        if np.count_nonzero(weights > 0) < 3:
+            raise Exception("At least 3 cluster markers with a positive weight are needed, got {}".format(cluster["clusterMarkers"]))
+
+        self.clusterMarkers = list(cluster["clusterMarkers"])
+        self.landmarkNames = list(cluster["landmarks"])
+        self.geometry = geometry
+        self.weights = weights
+        self.landmarks = np.array([ cluster["landmarks"][name] for name in self.landmarkNames ], dtype=float) # (landmarks, 3)
+
+        # centred and weighted cluster geometry, for the frames where all the markers are visible
+        self.normWeights = weights / weights.sum()
+        self.centroid = self.normWeights @ geometry                                   # (3,)
+        self.weightedGeometry = np.ascontiguousarray((weights[:, np.newaxis] * (geometry - self.centroid)).T) # (3, markers)
+
+        self.allocate(maxFrames)
+
+    def allocate(self, maxFrames):
+        """
+        Work arrays for up to maxFrames frames per update
+        """
+
+        numMarkers = len(self.clusterMarkers)
+        self.maxFrames = maxFrames
+        self._finite = np.empty((maxFrames, numMarkers, 3), dtype=bool)
+        self._visible = np.empty((maxFrames, numMarkers), dtype=bool)
+        self._centroid = np.empty((maxFrames, 3))
+        self._centred = np.empty((maxFrames, numMarkers, 3))
+        self._H = np.empty((maxFrames, 3, 3))
+        self._rotationT = np.empty((maxFrames, 3, 3)) # transpose of the rotation: U @ Vt
+        self._translation = np.empty((maxFrames, 3))
+
+    def update(self, clusterXYZ, out=None):
+        """
+        Landmarks from the cluster markers (NaN where not visible)
+
+        clusterXYZ: (markers, 3) for one frame, or (frames, markers, 3) for a batch of frames, markers in the order of clusterMarkers
+        out: optional output array, (landmarks, 3) or (frames, landmarks, 3)
+        Returns the landmarks, in the order of landmarkNames
+        """
+
+        clusterXYZ = np.asarray(clusterXYZ, dtype=float)
+        B = clusterXYZ.reshape(-1, len(self.clusterMarkers), 3)
+        n = B.shape[0]
+        if n > self.maxFrames:
+            self.allocate(n)
+
+        if out is None:
+            out = np.empty(clusterXYZ.shape[:-2] + (len(self.landmarkNames), 3))
+        result = out.reshape(n, len(self.landmarkNames), 3)
+
+        finite = np.isfinite(B, out=self._finite[:n])
+        visible = np.logical_and.reduce(finite, axis=2, out=self._visible[:n])
+        if visible.all():
+            self._solve_visible(B, result)
+        else:
+            self._solve_occluded(B, visible, result)
+
+        if not np.may_share_memory(result, out): # out is not contiguous: reshape gave a copy
+            out[...] = result.reshape(out.shape)
+        return out
+
+    def _solve_visible(self, B, result):
+        """
+        Fit of the frames where all the markers are visible, in the work arrays
+        """
+
+        n = B.shape[0]
+        centroid = np.matmul(self.normWeights, B, out=self._centroid[:n])               # (frames, 3)
+        centred = np.subtract(B, centroid[:, np.newaxis, :], out=self._centred[:n])
+        H = np.matmul(self.weightedGeometry, centred, out=self._H[:n])                  # (frames, 3, 3)
+
+        U, S, Vt = np.linalg.svd(H)
+        rotationT = np.matmul(U, Vt, out=self._rotationT[:n])                           # R = V @ Ut = (U @ Vt)T
+
+        # special reflection case
+        reflection = np.linalg.det(rotationT) < 0
+        if reflection.any():
+            Vt[reflection, 2, :] *= -1
+            rotationT[reflection] = U[reflection] @ Vt[reflection]
+
+        # t = centroid_B - R @ centroid_A, landmarks = R @ landmark + t
+        translation = np.matmul(self.centroid, rotationT, out=self._translation[:n])
+        np.subtract(centroid, translation, out=translation)
+        np.matmul(self.landmarks, rotationT, out=result)
+        result += translation[:, np.newaxis, :]
+
+    def _solve_occluded(self, B, visible, result):
+        from create_anatomical_marker import rigid_transform_3D
+
+        R, t, rms = rigid_transform_3D(self.geometry, B, self.weights)
+        result[...] = np.einsum('fij,lj->fli', R, self.landmarks) + t[:, np.newaxis, :]
+
+class ModelReconstructor(object):
+    """
+    Landmarks of all the clusters of a calibration model from the positions of all their cluster markers
+    """
+
+    def __init__(self, model, newMarkerNames=None, maxFrames=1):
+        if newMarkerNames is None:
+            newMarkerNames = {}
+
+        self.clusters = [ ClusterReconstructor(cluster, maxFrames) for cluster in model ]
+
+        self.inputMarkers = []
+        self.outputMarkers = []
+        for cluster in model:
+            names = dict(cluster.get("newMarkerNames", {}))
+            names.update(newMarkerNames)
+            self.inputMarkers += [ name for name in cluster["clusterMarkers"] if name not in self.inputMarkers ]
+            self.outputMarkers += [ names.get(name, name) for name in cluster["landmarks"] ]
+
+        # position of the markers of each cluster in the input, and of its landmarks in the output
+        self._inputs = []
+        self._outputs = []
+        first = 0
+        for reconstructor in self.clusters:
+            self._inputs.append(np.array([ self.inputMarkers.index(name) for name in reconstructor.clusterMarkers ]))
+            self._outputs.append(slice(first, first + len(reconstructor.landmarkNames)))
+            first += len(reconstructor.landmarkNames)
+        self.allocate(maxFrames)
+
+    def allocate(self, maxFrames):
+        self.maxFrames = maxFrames
+        self._clusterXYZ = [ np.empty((maxFrames, len(indices), 3)) for indices in self._inputs ]
+        self._landmarks = [ np.empty((maxFrames, len(reconstructor.landmarkNames), 3)) for reconstructor in self.clusters ]
+
+    def update(self, markerXYZ, out=None):
+        """
+        markerXYZ: (markers, 3) or (frames, markers, 3) in the order of inputMarkers
+        Returns the landmarks (landmarks, 3) or (frames, landmarks, 3) in the order of outputMarkers
+        """
+
+        markerXYZ = np.asarray(markerXYZ, dtype=float)
+        B = markerXYZ.reshape(-1, len(self.inputMarkers), 3)
+        n = B.shape[0]
+        if n > self.maxFrames:
+            self.allocate(n)
+
+        if out is None:
+            out = np.empty(markerXYZ.shape[:-2] + (len(self.outputMarkers), 3))
+        result = out.reshape(n, len(self.outputMarkers), 3)
+
+        for reconstructor, indices, outputs, clusterXYZ, landmarks in zip(self.clusters, self._inputs, self._outputs, self._clusterXYZ, self._landmarks):
+            np.take(B, indices, axis=1, out=clusterXYZ[:n])
+            reconstructor.update(clusterXYZ[:n], out=landmarks[:n])
+            result[:, outputs, :] = landmarks[:n]
+
+        if not np.may_share_memory(result, out): # out is not contiguous: reshape gave a copy
+            out[...] = result.reshape(out.shape)
+        return out
+
+######################################################
+# Latency and equivalence
+######################################################
+
+def synthetic_motion(model, numFrames, rate=100.0, seed=0):
+    """
+    (frames, markers, 3) positions of the cluster markers of the model (order of ModelReconstructor.inputMarkers)
+    moved by smooth random rigid motions
+    """
+
+    from benchmark import rotation_matrices, smooth_signal
+
+    rng = np.random.default_rng(seed)
+    reconstructor = ModelReconstructor(model)
+    data = np.empty((numFrames, len(reconstructor.inputMarkers), 3))
+    for cluster, indices in zip(model, reconstructor._inputs):
+        R = rotation_matrices(smooth_signal(numFrames, 3, rate, rng, 0.4))
+        t = rng.uniform(-500, 500, 3) + smooth_signal(numFrames, 3, rate, rng, 300.0)
+        data[:, indices, :] = np.einsum('fij,mj->fmi', R, np.asarray(cluster["clusterGeometry"], dtype=float)) + t[:, np.newaxis, :]
+    return data
+
+def measure_latency(reconstructor, data, batch=1):
+    """
+    Stream data (frames, markers, 3) through the reconstructor by batches of frames
+    Returns the latencies of the updates (seconds) and the landmarks (frames, landmarks, 3)
+    """
+
+    numFrames = len(data)
+    landmarks = np.empty((numFrames, len(reconstructor.outputMarkers), 3))
+    latencies = np.empty((numFrames + batch - 1) // batch)
+    for i, first in enumerate(range(0, numFrames, batch)):
+        start = time.perf_counter()
+        reconstructor.update(data[first:first + batch], out=landmarks[first:first + batch])
+        latencies[i] = time.perf_counter() - start
+    return latencies, landmarks
+
+# Maximum difference (in the units of the markers) between the streamed and the offline landmarks
+OFFLINE_TOLERANCE = 1e-6
+
+def offline_difference(acqMotion, model, landmarks, newMarkerNames=None):
+    """
+    Maximum distance between the streamed landmarks (frames, landmarks, 3) and the offline reconstruction of the acquisition
+    """
+
+    from create_anatomical_marker import apply_calibration_model
+
+    reconstructor = ModelReconstructor(model, newMarkerNames)
+    acqMotion = apply_calibration_model(acqMotion, model, newMarkerNames)
+    difference = 0.0
+    for i, name in enumerate(reconstructor.outputMarkers):
+        point = acqMotion.GetPoint(name)
+        visible = point.GetResiduals()[:, 0] >= 0
+        if visible.any():
+            difference = max(difference, float(np.abs(point.GetValues()[visible] - landmarks[visible, i]).max()))
+        if np.isfinite(landmarks[~visible, i]).any():
+            return np.inf # streamed landmark where the offline one could not be reconstructed
+    return difference
+
+def print_latency(latencies, batch, numClusters):
+    micro = latencies * 1e6
+    print("Latency of update() ({} frame(s) per update): median {:.1f} us, 99% {:.1f} us, max {:.1f} us".format(
+                batch, np.median(micro), np.percentile(micro, 99), micro.max()))
+    print("{:.0f} updates/s, {:.0f} frames/s per cluster".format(1 / np.mean(latencies), batch * numClusters / np.mean(latencies)))
+
+
+
+if __name__ == '__main__':
+
+    # If loaded as main, initialise the parser (to start the program with arguments)
+    import argparse
+    from proc_log import add_arguments, setup_from_args, finish_from_args
+
+    parser = argparse.ArgumentParser(description='Latency of the real time reconstruction of anatomical markers', formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument ('--model',      '-m',  metavar = 'model',      type = str, help = 'The calibration model (saved with create_anatomical_marker.py --saveModel)', required=True)
+    parser.add_argument ('--frames',     '-f',  metavar = 'frames',     type = int, help = 'Number of synthetic frames (default 10000)', required=False, default=10000)
+    parser.add_argument ('--batch',      '-b',  metavar = 'batch',      type = int, help = 'Number of frames per update (default 1)',    required=False, default=1)
+    parser.add_argument ('--motionFile', '-mf', metavar = 'motionFile', type = str, help = 'Replay the cluster markers of this file (.c3d or .trc) instead, and compare with the offline reconstruction', required=False, default=None)
+    add_arguments(parser)
+    args = parser.parse_args()
+    setup_from_args(args)
+
+    from create_anatomical_marker import load_calibration_model
+
+    model = load_calibration_model(args.model)
+    reconstructor = ModelReconstructor(model, maxFrames=args.batch)
+
+    if args.motionFile:
+        from convert_c3d_trc import read_c3dtrc
+        from create_anatomical_marker import get_marker_values
+        acqMotion = read_c3dtrc(args.motionFile)
+        number_steps = acqMotion.GetLastFrame() - acqMotion.GetFirstFrame() +1
+        data = np.stack([ get_marker_values(acqMotion.GetPoint(name), slice(0, number_steps)) for name in reconstructor.inputMarkers ], axis=1)
+    else:
+        data = synthetic_motion(model, args.frames)
+
+    latencies, landmarks = measure_latency(reconstructor, data, args.batch)
+    print_latency(latencies, args.batch, len(model))
+    if args.motionFile:
+        difference = offline_difference(acqMotion, model, landmarks)
+        print("Maximum difference with the offline reconstruction: {:.2e}".format(difference))
+        if difference > OFFLINE_TOLERANCE:
+            import sys
+            sys.exit("The real time landmarks differ from the offline reconstruction ({:.2e} > {:.0e})".format(difference, OFFLINE_TOLERANCE))
+    finish_from_args(args)
@@ -5,10 +5,13 @@
 @author: Martin
 
 Description:
-    Removes a marker. Useful when the value is set to 0, or the list is empty.
+    Removes markers. Useful when the value is set to 0, or the list is empty.
+    The markers can be a list of labels, glob patterns ("HUM_*") or regular expressions ("re:^HUM_"), all removed in one pass.
+    A label (or pattern) not found is an error, unless --ignoreMissing is given.
 
 Usage:
     python remove_marker.py -i inputFile.c3d/trc -o outputFile.c3d/trc -m1 "markerToDelete"
+    python remove_marker.py -i inputFile.c3d/trc -o outputFile.c3d/trc -m1 "marker1,marker2,HUM_*,re:^SCAP_CL-[0-9]$"
     or import as module
 
 Requirements:
@@ -21,31 +24,30 @@ Material:
 
 text="remove_marker module"
 
+from proc_log import get_logger, profile_stage
+
+log = get_logger("remove_marker")
+
 def remove_marker(acq,args):
 
-    # Create an object (point)
-    point1 = acq.GetPoint(args.marker)
-
-    # need to find the number (in the list) of the choosen marker (can't get the RemovePoint to work otherwise)
-    numberOfPoints = acq.GetPointNumber()
-    #print("There are {} markers in the file".format(numberOfPoints))
-    i = 0
-    while i < numberOfPoints: # loop through them and display the labels
-        currentName = acq.GetPoint(i).GetLabel()
-        #print(i , currentName)
-        if (currentName == args.marker):
-            #print("Found our marker's number")
-            break
-        i+=1
+    from marker_labels import get_label_index, match_labels
+
+    # need to find the number (in the list) of the choosen markers (can't get the RemovePoint to work otherwise):
+    # build the label -> number map once
+    labelIndex = get_label_index(acq)
+
+    # args.marker is a list of markers, glob patterns ("HUM_*") or regular expressions ("re:^HUM_")
+    markersToRemove = match_labels(args.marker, list(labelIndex), strict=not getattr(args, 'ignoreMissing', False))
 
     ######################################################
-    # Remove the marker
+    # Remove the markers
     ######################################################
 
-    #try:
-    acq.RemovePoint(i)
-    #except:
-    #    print("Error removing the point")
+    # from the last to the first, so the numbers of the markers not removed yet do not change
+    for i in sorted([ labelIndex[label] for label in markersToRemove ], reverse=True):
+        acq.RemovePoint(i)
+
+    log.info("Removed {} markers: {}".format(len(markersToRemove), ", ".join(markersToRemove)))
 
     return acq
 
@@ -53,14 +55,18 @@ if __name__ == '__main__':
 
     # If loaded as main, initialise the parser (to start the program with arguments)
     import argparse
+    from proc_log import add_arguments, setup_from_args, finish_from_args
 
     parser = argparse.ArgumentParser(description='Create midpoint marker', formatter_class=argparse.RawTextHelpFormatter)
 
     parser.add_argument ('--input',  '-i',  metavar = 'input',  type = str, help = 'The input file to load (.c3d or .trc)',   required=True)
-    parser.add_argument ('--marker', '-m1', metavar = 'marker', type = str, help = 'The name of the marker to delete',        required=True)
+    parser.add_argument ('--marker', '-m1', metavar = 'marker', type = str, help = 'The names of the markers to delete (list, glob patterns or "re:regex")', required=True)
+    parser.add_argument ('--ignoreMissing', '-im',                          help = 'Do not stop if a marker is not found',     required=False, action='store_true', default=False)
     parser.add_argument ('--output', '-o',  metavar = 'output', type = str, help = 'The output file to write (.c3d or .trc)', required=True)
     
+    add_arguments(parser)
     args = parser.parse_args()
+    setup_from_args(args)
 
     # If all the arguments have been provided, load the file with btk then start the function
 
@@ -69,29 +75,35 @@ if __name__ == '__main__':
     ######################################################
     import sys
     import btk
-    print("Loading the file {}".format(args.input))
+    log.info("Loading the file {}".format(args.input))
     try:
-        reader = btk.btkAcquisitionFileReader() # build a btk reader object
-        reader.SetFilename(args.input) # set a filename to the reader
-        reader.Update()
-        acq = reader.GetOutput() # acq is the btk aquisition object
+        with profile_stage("read"):
+            reader = btk.btkAcquisitionFileReader() # build a btk reader object
+            reader.SetFilename(args.input) # set a filename to the reader
+            reader.Update()
+            acq = reader.GetOutput() # acq is the btk aquisition object
     except:
         sys.exit("Error reading the file, exiting")
 
     ######################################################
-    # Create the midpoint marker
+    # Remove the markers
     ######################################################
-    acq_modified = remove_marker(acq,args)
+    try:
+        acq_modified = remove_marker(acq,args)
+    except KeyError as e:
+        sys.exit("Error: {}, exiting".format(e))
 
     ######################################################
     # Save the file
     ######################################################
-    print("Saving the file as {}".format(args.output))
+    log.info("Saving the file as {}".format(args.output))
     try:
-        writer = btk.btkAcquisitionFileWriter()
-        writer.SetInput(acq_modified)
-        writer.SetFilename(args.output)
-        writer.Update()
+        with profile_stage("write"):
+            writer = btk.btkAcquisitionFileWriter()
+            writer.SetInput(acq_modified)
+            writer.SetFilename(args.output)
+            writer.Update()
     except:
-        print("Error saving the file")
+        log.error("Error saving the file")
 
+    finish_from_args(args)
@@ -6,9 +6,14 @@
 
 Description:
     Rename a list of markers in a c3d or trc file
+    A "from" name can also be a regular expression ("re:...") renaming all the matching markers, its "to" name is then the replacement,
+    or a glob pattern ("HUM_*"), the wildcards of its "to" name are then replaced by the matched parts ("ARM_*")
+    A marker not found is an error, unless --ignoreMissing is given.
 
 Usage:
     python3 rename_markers.py --inputFile "test.trc" --from "M1original","M2original" --to "M1modified","M2modified" --outputFile test_renamed.trc
+    python3 rename_markers.py --inputFile "test.trc" --from "re:^(.*)_R$" --to "\1_right" --outputFile test_renamed.trc
+    python3 rename_markers.py --inputFile "test.trc" --from "HUM_*" --to "ARM_*" --outputFile test_renamed.trc
     or import as module
 
 Requirements:
@@ -19,26 +24,66 @@ Ressources:
 
 """
 
+text="rename module"
+
+from proc_log import get_logger, profile_stage
+
+log = get_logger("rename")
+
 def rename_markers(acq,args):
 
+    import re
+    from collections import Counter
+    from marker_labels import get_labels, split_patterns, is_regex, is_glob, glob_regex, glob_rename
+
     # Load the marker names
-    markerListFrom = args.markerListFrom.split(",") # create a list out of the string with ","
-    markerListTo = args.markerListTo.split(",")
+    markerListFrom = split_patterns(args.markerListFrom) # create a list out of the string with ","
+    markerListTo = split_patterns(args.markerListTo)
+    strict = not getattr(args, 'ignoreMissing', False)
 
     # Check that we have same number of labels
     if (len(markerListFrom) != len(markerListTo)):
-        print("Markers From and markers To do not have the same size. Exitting.")
-        quit()
+        raise Exception("Markers From and markers To do not have the same size.")
+
+    # Build the new labels of all the points at once (label -> index map instead of a lookup per label)
+    labels = get_labels(acq)
+    labelIndex = { label : i for i, label in enumerate(labels) }
+    newLabels = list(labels)
+
+    for x in range(len(markerListFrom)):
+        if is_regex(markerListFrom[x]):
+            # regular expression: rename all the matching markers, the new name is the replacement ("\1_right"...)
+            regex = re.compile(markerListFrom[x][3:])
+            found = [ i for i, label in enumerate(labels) if regex.search(label) ]
+            for i in found:
+                newLabels[i] = regex.sub(markerListTo[x], labels[i])
+        elif is_glob(markerListFrom[x]):
+            # glob pattern: rename all the matching markers, the wildcards of the new name take the matched parts
+            regex = glob_regex(markerListFrom[x])
+            found = [ i for i, label in enumerate(labels) if regex.match(label) ]
+            for i in found:
+                newLabels[i] = glob_rename(markerListTo[x], regex.match(labels[i]))
+        else:
+            found = [ labelIndex[markerListFrom[x]] ] if markerListFrom[x] in labelIndex else []
+            for i in found:
+                newLabels[i] = markerListTo[x]
+        if not found:
+            if strict:
+                raise KeyError("No marker matching {}".format(markerListFrom[x]))
+            log.warning("No marker matching {}, skipping".format(markerListFrom[x]))
+
+    # Two markers with the same label cannot be told apart anymore: a new label must not collide with another label
+    # (duplicates already in the file and not renamed are left as they are)
+    counts = Counter(newLabels)
+    duplicates = sorted(set([ newLabels[i] for i in range(len(labels)) if newLabels[i] != labels[i] and counts[newLabels[i]] > 1 ]))
+    if duplicates:
+        raise Exception("Renaming would create duplicate labels: {}".format(", ".join(duplicates)))
 
     # Rename from one list to another
-    for x in range(len(markerListFrom)): 
-        print("[{}] Renaming: From {} to {}".format(x,markerListFrom[x],markerListTo[x]))
-
-        try:
-            point = acq.GetPoint(markerListFrom[x])
-            point.SetLabel(markerListTo[x]) # set the new label
-        except:
-            print("Error getting or renaming the marker {}".format(markerListFrom[x]))
+    for i in range(len(labels)):
+        if newLabels[i] != labels[i]:
+            log.debug("[{}] Renaming: From {} to {}".format(i,labels[i],newLabels[i]))
+            acq.GetPoint(i).SetLabel(newLabels[i]) # set the new label
 
     return acq
 
@@ -46,15 +91,19 @@ if __name__ == '__main__':
 
     # If loaded as main, initialise the parser (to start the program with arguments)
     import argparse
+    from proc_log import add_arguments, setup_from_args, finish_from_args
 
     parser = argparse.ArgumentParser(description='Rename markers', formatter_class=argparse.RawTextHelpFormatter)
 
     parser.add_argument ('--inputFile',      '-i', metavar = 'inputFile',      type = str,  help = 'The input file to load (.c3d or .trc)',   required=True)
     parser.add_argument ('--markerListFrom', '-f', metavar = 'markerListFrom', type = str,  help = 'List of names of the markers to rename',  required=True)
     parser.add_argument ('--markerListTo',   '-t', metavar = 'markerListTo',   type = str,  help = 'List of the new names of the markers',    required=True)
+    parser.add_argument ('--ignoreMissing',  '-im',                                     help = 'Do not stop if a marker is not found',    required=False, action='store_true', default=False)
     parser.add_argument ('--outputFile',     '-o', metavar = 'outputFile',     type = str,  help = 'The output file to write (.c3d or .trc)', required=True)
 
+    add_arguments(parser)
     args = parser.parse_args()
+    setup_from_args(args)
 
     # If all the arguments have been provided, load the files with btk then start the function
 
@@ -65,11 +114,12 @@ if __name__ == '__main__':
     import sys
     import btk
     try:
-        print("Loading the file file {}".format(args.inputFile))
-        reader = btk.btkAcquisitionFileReader() # build a btk reader object
-        reader.SetFilename(args.inputFile) # set a filename to the reader
-        reader.Update()
-        acq = reader.GetOutput() # acq is the btk aquisition object
+        log.info("Loading the file {}".format(args.inputFile))
+        with profile_stage("read"):
+            reader = btk.btkAcquisitionFileReader() # build a btk reader object
+            reader.SetFilename(args.inputFile) # set a filename to the reader
+            reader.Update()
+            acq = reader.GetOutput() # acq is the btk aquisition object
     except:
         sys.exit("Error reading the input file, exiting")
 
@@ -81,16 +131,22 @@ if __name__ == '__main__':
     #print(point)
     #point.SetLabel(markerListTo[x]) # set the new label
 
-    acq_modified = rename_markers(acq,args)
+    try:
+        acq_modified = rename_markers(acq,args)
+    except Exception as e:
+        sys.exit("Error: {}, exiting".format(e))
     
     ######################################################
     # Save the file
     ######################################################
-    print("Saving the file as {}".format(args.outputFile))
+    log.info("Saving the file as {}".format(args.outputFile))
     try:
-        writer = btk.btkAcquisitionFileWriter()
-        writer.SetInput(acq_modified)
-        writer.SetFilename(args.outputFile)
-        writer.Update()
+        with profile_stage("write"):
+            writer = btk.btkAcquisitionFileWriter()
+            writer.SetInput(acq_modified)
+            writer.SetFilename(args.outputFile)
+            writer.Update()
     except:
-        print("Error saving the file")
+        log.error("Error saving the file")
+
+    finish_from_args(args)
@@ -10,54 +10,113 @@ Description:
 
 Usage:
     python setOrigin.py -i inputFile.c3d  -m "myOriginMarker" -o outputFile.trc
+    # can specify --axisMarkers "xMarker,planeMarker" to also rotate into the frame defined by the markers,
+    # and --staticFrame N to use the origin (and axes) of frame N for the whole file instead of following them at each frame
     or import as module
 
 Requirements:
     btk
+    numpy
 
 """
 
 text="setOrigin module"
 
-def setOrigin(acq,markerOrigin):
+from proc_log import get_logger, profile_stage
 
-    nombreDeFrames = acq.GetLastFrame() - acq.GetFirstFrame() +1
+log = get_logger("setOrigin")
+
+def get_rotation_matrices(origin, axis1, axis2):
+    """
+    Rotation matrices (frames, 3, 3) of the marker-defined frame, rows are the X, Y, Z axes expressed in the global frame
+    X goes from the origin to axis1, Z is perpendicular to the plane (origin, axis1, axis2), Y completes the right handed frame
+    """
 
-    # Loop through each frame
+    import numpy as np
 
-    for frameNumber in range(0, nombreDeFrames):
+    x = axis1 - origin
+    z = np.cross(x, axis2 - origin)
+    y = np.cross(z, x)
+    R = np.stack([x, y, z], axis=-2)
+    norms = np.linalg.norm(R, axis=-1, keepdims=True)
+    # degenerate frames (markers at the same place or aligned) get null axes instead of a division by zero
+    return np.divide(R, norms, out=np.zeros_like(R), where=norms > 0)
 
-        print ("Processing frame number {}".format(frameNumber))
+def get_reference_occlusion(acq, markers, nombreDeFrames):
+    """
+    Frames (frames,) where one of the reference markers (origin and axis markers) is missing (residual < 0)
+    """
 
-        # Getting coordinates of our originMarker at this frame
-        try:
-            originCoordinates = acq.GetPoint(args.markerOrigin).GetValues()[frameNumber,:]
-            xValueOrigin = originCoordinates[0]
-            yValueOrigin = originCoordinates[1]
-            zValueOrigin = originCoordinates[2]
-        except: print("Cannot find the markerOrigin {}".format(args.markerOrigin))
+    import numpy as np
 
-        # Loop through all the markers and substract the values of the origin marker
+    occluded = np.zeros(nombreDeFrames, dtype=bool)
+    for marker in markers:
+        occluded |= np.asarray(acq.GetPoint(marker).GetResiduals()[0:nombreDeFrames,0]) < 0
+    return occluded
 
-        for pointNumber in range(0, acq.GetPointNumber()):
-            x = pointNumber
+def setOrigin(acq,markerOrigin,axisMarkers=None,staticFrame=None):
 
-            print("Processing marker number {} ({}) frame {}: ".format(x , acq.GetPoint(pointNumber).GetLabel(),frameNumber))
-            
-            # Get value of current point at current frame : acq.GetPoint(pointNumber).GetValues()
-            point = acq.GetPoint(x).GetValues()[frameNumber,:]
-            xValueCurrent = point[0]
-            yValueCurrent = point[1]
-            zValueCurrent = point[2]
+    import numpy as np
 
-            # Update values by substracting values of originMarker
-            acq.GetPoint(x).SetValue(frameNumber,0,xValueCurrent-xValueOrigin)
-            acq.GetPoint(x).SetValue(frameNumber,1,yValueCurrent-yValueOrigin)
-            acq.GetPoint(x).SetValue(frameNumber,2,zValueCurrent-zValueOrigin)
+    nombreDeFrames = acq.GetLastFrame() - acq.GetFirstFrame() +1
+    nombreDePoints = acq.GetPointNumber()
 
-            # Making sure it's updated
-            #pointUpdated = acq.GetPoint(x).GetValues()[frameNumber,:]
-            #print(pointUpdated[:])
+    # Getting coordinates of our originMarker (and axis markers) at all the frames, or at the static frame only
+    try:
+        origin = np.asarray(acq.GetPoint(markerOrigin).GetValues()[0:nombreDeFrames,:], dtype=float)
+        if axisMarkers is not None:
+            axis1 = np.asarray(acq.GetPoint(axisMarkers[0]).GetValues()[0:nombreDeFrames,:], dtype=float)
+            axis2 = np.asarray(acq.GetPoint(axisMarkers[1]).GetValues()[0:nombreDeFrames,:], dtype=float)
+        referenceOccluded = get_reference_occlusion(acq, [markerOrigin] + list(axisMarkers or []), nombreDeFrames)
+    except:
+        raise Exception("Cannot find the markerOrigin {} or the axis markers {}".format(markerOrigin, axisMarkers))
+
+    if staticFrame is not None:
+        if referenceOccluded[staticFrame]:
+            raise Exception("The markerOrigin {} or the axis markers {} are missing at the static frame {}".format(markerOrigin, axisMarkers, staticFrame))
+        referenceOccluded[:] = False
+        origin = origin[staticFrame]
+        if axisMarkers is not None:
+            axis1 = axis1[staticFrame]
+            axis2 = axis2[staticFrame]
+
+    # Get all the points at once: (points, frames, 3)
+    with profile_stage("setOrigin.read", frames=nombreDeFrames) as stage:
+        values = np.stack([ acq.GetPoint(x).GetValues()[0:nombreDeFrames,:] for x in range(nombreDePoints) ]).astype(float)
+        residuals = np.stack([ acq.GetPoint(x).GetResiduals()[0:nombreDeFrames,0] for x in range(nombreDePoints) ])
+        stage["bytes"] = values.nbytes + residuals.nbytes
+    # btk stores the missing frames as 0 with a residual of -1: keep them as they are,
+    # and the frames without origin (or axes) cannot be expressed in the new frame: missing for all the points
+    occluded = (residuals < 0) | referenceOccluded
+
+    with profile_stage("setOrigin.compute", frames=nombreDeFrames) as stage:
+        # Substract the values of the origin marker (one broadcast for all the points and frames)
+        values -= origin
+
+        # Rotate into the frame defined by the origin and the axis markers
+        if axisMarkers is not None:
+            log.info("Rotating into the frame of {} (X towards {}, XY plane containing {})".format(markerOrigin, axisMarkers[0], axisMarkers[1]))
+            R = get_rotation_matrices(origin, axis1, axis2)
+            if staticFrame is None:
+                occluded |= ~R.any(axis=(-2, -1)) # degenerate frames
+            elif not R.any():
+                raise Exception("The axis markers {} do not define a frame at the static frame {}".format(axisMarkers, staticFrame))
+            if staticFrame is not None:
+                values = np.einsum('ij,pfj->pfi', R, values)
+            else:
+                values = np.einsum('fij,pfj->pfi', R, values)
+
+        values[occluded] = 0.0
+        stage["bytes"] = values.nbytes
+
+    # Write each point back with a single call
+    with profile_stage("setOrigin.append", frames=nombreDeFrames):
+        for x in range(nombreDePoints):
+            acq.GetPoint(x).SetValues(values[x])
+            if (occluded[x] & (residuals[x] >= 0)).any(): # newly missing frames
+                acq.GetPoint(x).SetResiduals(np.where(occluded[x], -1.0, residuals[x]).reshape(-1,1))
+
+    log.info("Processed {} markers, {} frames".format(nombreDePoints, nombreDeFrames))
 
     return acq
 
@@ -67,11 +126,16 @@ if __name__ == '__main__':
 
     # If loaded as main, initialise the parser (to start the program with arguments)
     import argparse
+    from proc_log import add_arguments, setup_from_args, finish_from_args
     parser = argparse.ArgumentParser(description='setOrigin', formatter_class=argparse.RawTextHelpFormatter)
     parser.add_argument ('--input',        '-i',  metavar = 'input',        type = str, help = 'The input file to load (.c3d or .trc)',             required=True)
     parser.add_argument ('--markerOrigin', '-m',  metavar = 'markerOrigin', type = str, help = 'The name of the marker that will be set as origin', required=True)
+    parser.add_argument ('--axisMarkers',  '-a',  metavar = 'axisMarkers',  type = str, help = 'Also rotate into the frame defined by 2 markers "xMarker,planeMarker":\nX from the origin to xMarker, Z perpendicular to the plane (origin, xMarker, planeMarker)', required=False, default=None)
+    parser.add_argument ('--staticFrame',  '-s',  metavar = 'staticFrame',  type = int, help = 'Use the origin (and axes) at this frame for all the frames instead of following them frame by frame', required=False, default=None)
     parser.add_argument ('--output',       '-o',  metavar = 'output',       type = str, help = 'The output file to write (.c3d or .trc)',           required=True)
+    add_arguments(parser)
     args = parser.parse_args()
+    setup_from_args(args)
     
     # If all the arguments have been provided, load the file with btk then start the function
 
@@ -80,29 +144,35 @@ if __name__ == '__main__':
     ######################################################
     import sys
     import btk
-    print("Loading the file {}".format(args.input))
+    log.info("Loading the file {}".format(args.input))
     try:
-        reader = btk.btkAcquisitionFileReader() # build a btk reader object
-        reader.SetFilename(args.input) # set a filename to the reader
-        reader.Update()
-        acq = reader.GetOutput() # acq is the btk aquisition object
+        with profile_stage("read"):
+            reader = btk.btkAcquisitionFileReader() # build a btk reader object
+            reader.SetFilename(args.input) # set a filename to the reader
+            reader.Update()
+            acq = reader.GetOutput() # acq is the btk aquisition object
     except:
         sys.exit("Error reading the file, exiting")
 
     ######################################################
     # Set the origin
     ######################################################
-    acq_modified = setOrigin(acq,args.markerOrigin)
+    axisMarkers = args.axisMarkers.split(",") if args.axisMarkers else None
+    if axisMarkers is not None and len(axisMarkers) != 2:
+        sys.exit("--axisMarkers needs 2 markers")
+    acq_modified = setOrigin(acq,args.markerOrigin,axisMarkers,args.staticFrame)
 
     ######################################################
     # Save the file
     ######################################################
-    print("Saving the file as {}".format(args.output))
+    log.info("Saving the file as {}".format(args.output))
     try:
-        writer = btk.btkAcquisitionFileWriter()
-        writer.SetInput(acq_modified)
-        writer.SetFilename(args.output)
-        writer.Update()
+        with profile_stage("write"):
+            writer = btk.btkAcquisitionFileWriter()
+            writer.SetInput(acq_modified)
+            writer.SetFilename(args.output)
+            writer.Update()
     except:
-        print("Error saving the file")
+        log.error("Error saving the file")
 
+    finish_from_args(args)
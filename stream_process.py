@@ -0,0 +1,235 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+
+@author: Martin
+
+Description:
+    Run a recipe (see pipeline.py) on a very long capture by chunks of frames, with a memory use bounded by the chunk size
+    instead of the length of the trial.
+
+    The markers are read chunk by chunk from a trc file, or from a memory mapped c3d file (the analog channels are never read)
+    or .columns directory (see read_write_columns.py),
+    each chunk goes through the operations of the recipe as a small btk acquisition, and is appended to the output trc file.
+    The operations work frame by frame, so the result is the same as processing the whole file at once.
+    The static frames of setOrigin (staticFrame) are read once and added at the end of every chunk, so they go through
+    the same operations as the other frames.
+
+    Not possible by chunks: residualFile of create_anatomical_marker (one file per run). The output is a trc file.
+    All the points of a c3d file are processed as markers.
+
+Usage:
+    python stream_process.py -i inputFile.c3d/trc -r recipe.json -o outputFile.trc --chunkFrames 10000
+    or import as module
+
+Requirements:
+    btk
+    numpy
+
+"""
+
+text="stream_process module"
+
+import time
+
+import numpy as np
+
+from proc_log import get_logger, profile_stage, quiet
+from read_write_columns import is_columns
+
+log = get_logger("stream_process")
+
+CHUNK_FRAMES = 10000 # default number of frames processed at once
+
+def source_info(inputFile):
+    """
+    labels, dataRate, firstFrame, numFrames and units of the markers of a .trc or .c3d file (without loading the data)
+    """
+
+    if inputFile.lower().endswith(".trc"):
+        from read_write_trc import read_trc_header, read_trc_first_frame
+        header = read_trc_header(inputFile)
+        # the frame number of the first row, as read_trc() (origDataStartFrame can differ in trimmed/exported files)
+        return { "labels": header["labels"], "dataRate": header["dataRate"], "firstFrame": read_trc_first_frame(inputFile, header),
+                 "numFrames": header["numFrames"], "units": header["units"] }
+
+    if inputFile.lower().endswith(".c3d") or is_columns(inputFile):
+        c3d = point_file(inputFile)
+        return { "labels": list(c3d.labels), "dataRate": c3d.rate, "firstFrame": c3d.first_frame,
+                 "numFrames": c3d.frame_number, "units": c3d.units }
+
+    raise IOError("Cannot stream {}: only .trc, .c3d and .columns files".format(inputFile))
+
+def point_file(inputFile):
+    """
+    Memory mapped points of a .c3d file or a .columns directory (same get_points interface)
+    """
+
+    if is_columns(inputFile):
+        from read_write_columns import ColumnsFile
+        return ColumnsFile(inputFile)
+    from read_c3d_memmap import C3DFile
+    return C3DFile(inputFile)
+
+def iter_chunks(inputFile, chunkFrames):
+    """
+    Yields (values (frames, markers, 3) with NaN where not visible, residuals (frames, markers)) by chunks of chunkFrames frames
+    """
+
+    if inputFile.lower().endswith(".trc"):
+        from read_write_trc import iter_trc
+        for data, frameNumbers, times in iter_trc(inputFile, chunkFrames):
+            yield data, np.where(np.isnan(data).any(axis=2), -1.0, 0.0)
+    else:
+        c3d = point_file(inputFile)
+        for first in range(0, c3d.frame_number, chunkFrames):
+            yield c3d.get_points(frames=slice(first, first + chunkFrames))
+
+def read_frames(inputFile, frames, chunkFrames):
+    """
+    (values, residuals) of some frames (indices from 0), read chunk by chunk
+    """
+
+    values = [None] * len(frames)
+    residuals = [None] * len(frames)
+    first = 0
+    for chunkValues, chunkResiduals in iter_chunks(inputFile, chunkFrames):
+        for i, frame in enumerate(frames):
+            if first <= frame < first + len(chunkValues):
+                values[i] = chunkValues[frame - first]
+                residuals[i] = chunkResiduals[frame - first]
+        first += len(chunkValues)
+        if all([ value is not None for value in values ]):
+            break
+
+    if any([ value is None for value in values ]):
+        raise Exception("Static frames {} not in {} ({} frames)".format(frames, inputFile, first))
+
+    return np.stack(values), np.stack(residuals)
+
+def static_frame_index(frame, numFrames):
+    frame = int(frame)
+    return frame + numFrames if frame < 0 else frame
+
+def static_frames(recipe, numFrames):
+    """
+    The frames (indices from 0) used as static frame by the steps of the recipe
+    """
+
+    frames = []
+    for step in recipe:
+        if step.get("staticFrame") is not None:
+            frame = static_frame_index(step["staticFrame"], numFrames)
+            if frame not in frames:
+                frames.append(frame)
+    return frames
+
+def chunk_recipe(recipe, frames, chunkLength, numFrames):
+    """
+    The recipe for one chunk: the static frames are added after the chunkLength frames of the chunk
+    """
+
+    steps = []
+    for step in recipe:
+        if step.get("staticFrame") is not None:
+            step = dict(step, staticFrame=chunkLength + frames.index(static_frame_index(step["staticFrame"], numFrames)))
+        steps.append(step)
+    return steps
+
+def stream_process(inputFile, recipe, outputFile, chunkFrames=CHUNK_FRAMES, calibrations=None):
+    """
+    Run the recipe on inputFile chunk by chunk and write the result in outputFile (.trc) as it goes
+    Returns the list of (step name, seconds) summed over the chunks, including the read and the write
+    """
+
+    from read_write_trc import array_to_acquisition, acquisition_to_array, trc_header_text, write_trc_rows
+    from pipeline import run_pipeline
+
+    if not outputFile.lower().endswith(".trc"):
+        raise IOError("The output of the chunked processing is a trc file ({})".format(outputFile))
+    for step in recipe:
+        if step.get("residualFile"):
+            raise Exception("residualFile cannot be used by chunks ({})".format(step["operation"]))
+
+    if calibrations is None:
+        calibrations = {}
+
+    info = source_info(inputFile)
+    numFrames = info["numFrames"]
+
+    # the static frames are read first, then added to every chunk
+    frames = static_frames(recipe, numFrames)
+    if frames:
+        staticValues, staticResiduals = read_frames(inputFile, frames, chunkFrames)
+
+    timings = {}
+    def add_timing(name, seconds):
+        timings[name] = timings.get(name, 0.0) + seconds
+
+    labels = None
+    first = 0
+    with open(outputFile, "w") as f:
+        chunks = iter_chunks(inputFile, chunkFrames)
+        while True:
+            start = time.perf_counter()
+            try:
+                values, residuals = next(chunks)
+            except StopIteration:
+                break
+            chunkLength = len(values)
+            if frames:
+                values = np.concatenate([values, staticValues])
+                residuals = np.concatenate([residuals, staticResiduals])
+            with profile_stage("read", frames=chunkLength, nbytes=values.nbytes):
+                acq = array_to_acquisition(values, info["labels"], info["dataRate"], info["firstFrame"] + first, info["units"], residuals)
+            add_timing("read", time.perf_counter() - start)
+
+            # the messages of the operations are only displayed for the first chunk
+            steps = chunk_recipe(recipe, frames, chunkLength, numFrames)
+            if first == 0:
+                acq, stepTimings = run_pipeline(acq, steps, calibrations)
+            else:
+                with quiet():
+                    acq, stepTimings = run_pipeline(acq, steps, calibrations)
+            for name, seconds in stepTimings:
+                add_timing(name, seconds)
+
+            start = time.perf_counter()
+            data, chunkLabels = acquisition_to_array(acq)
+            if labels is None:
+                labels = chunkLabels
+                f.write(trc_header_text(outputFile, labels, info["dataRate"], numFrames, info["firstFrame"], info["units"]))
+            elif chunkLabels != labels:
+                raise Exception("The markers of the frames {} to {} are not the same as the first frames".format(first, first + chunkLength - 1))
+            with profile_stage("write", frames=chunkLength, nbytes=data.nbytes):
+                write_trc_rows(f, data[0:chunkLength], info["dataRate"], info["firstFrame"] + first)
+            add_timing("write", time.perf_counter() - start)
+
+            first += chunkLength
+            log.info("Processed {}/{} frames".format(first, numFrames))
+
+    return list(timings.items())
+
+
+
+if __name__ == '__main__':
+
+    # If loaded as main, initialise the parser (to start the program with arguments)
+    import argparse
+    from proc_log import add_arguments, setup_from_args, finish_from_args
+
+    parser = argparse.ArgumentParser(description='Run a recipe by chunks of frames', formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument ('--input',       '-i', metavar = 'input',       type = str, help = 'The input file to load (.c3d, .trc or .columns)', required=True)
+    parser.add_argument ('--recipe',      '-r', metavar = 'recipe',      type = str, help = 'The recipe: list of operations (.json or .yaml)', required=True)
+    parser.add_argument ('--output',      '-o', metavar = 'output',      type = str, help = 'The output file to write (.trc)',              required=True)
+    parser.add_argument ('--chunkFrames', '-c', metavar = 'chunkFrames', type = int, help = 'Number of frames processed at once (default {})'.format(CHUNK_FRAMES), required=False, default=CHUNK_FRAMES)
+    add_arguments(parser)
+    args = parser.parse_args()
+    setup_from_args(args)
+
+    from pipeline import load_recipe, print_timings
+
+    recipe = load_recipe(args.recipe)
+    timings = stream_process(args.input, recipe, args.output, args.chunkFrames)
+    print_timings(timings)
+    finish_from_args(args)
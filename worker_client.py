@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+
+@author: Martin
+
+Description:
+    Run a script in the worker (see worker_daemon.py) with the same arguments as on the command line.
+    Only the standard library is imported, so the call costs the time of the operation in the worker.
+    The output of the script is displayed and its exit code returned as if it was run directly.
+
+    If no worker is running, the script is run in this process (same result, with the start time of the imports).
+    Once the worker has the request, an error (e.g. connection lost) is reported: the script is not run a second time.
+
+Usage:
+    python worker_client.py setOrigin.py -i inputFile.c3d -m "myOriginMarker" -o outputFile.trc
+    python worker_client.py --socket my.sock pipeline.py -i inputFile.c3d -r recipe.json -o outputFile.c3d
+    or import as module: run_in_worker("setOrigin.py", ["-i", "inputFile.c3d", ...])
+
+Requirements:
+    (none, the scripts need btk and numpy if no worker is running)
+
+"""
+
+text="worker_client module"
+
+import json
+import os
+import socket
+import sys
+import tempfile
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+
+def default_socket():
+    # same as worker_daemon.default_socket(), without importing it
+    return os.environ.get("PROC_TOOLS_SOCKET", os.path.join(tempfile.gettempdir(), "proc_tools-{}.sock".format(os.getuid())))
+
+class NoWorkerError(OSError):
+    """No worker is running on the socket (the request was not sent)"""
+
+def request_worker(request, socketFile=None):
+    """
+    Send a request to the worker and return its answer (dict)
+    Raises NoWorkerError if no worker is running on socketFile, OSError if the connection fails after the request was sent
+    """
+
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        try:
+            client.connect(socketFile or default_socket())
+        except (FileNotFoundError, ConnectionRefusedError) as e:
+            raise NoWorkerError("No worker on {}: {}".format(socketFile or default_socket(), e))
+        with client.makefile("rwb") as f:
+            f.write((json.dumps(request) + "\n").encode())
+            f.flush()
+            line = f.readline()
+    finally:
+        client.close()
+    if not line:
+        raise IOError("The worker closed the connection without an answer")
+    return json.loads(line.decode())
+
+def run_in_worker(script, argv, socketFile=None):
+    """
+    Run a script with its command line arguments in the worker, returns the answer: exitCode, stdout, stderr, seconds
+    """
+
+    return request_worker({ "script": script, "argv": list(argv), "cwd": os.getcwd() }, socketFile)
+
+def run_locally(script, argv):
+    """
+    Run the script in this process, when no worker is running. Returns the exit code
+    """
+
+    import runpy
+
+    path = os.path.join(REPO_DIR, os.path.basename(script))
+    sys.argv = [path] + list(argv)
+    sys.path.insert(0, REPO_DIR)
+    try:
+        runpy.run_path(path, run_name="__main__")
+    except SystemExit as e:
+        if e.code is None or isinstance(e.code, int):
+            return e.code or 0
+        sys.stderr.write("{}\n".format(e.code))
+        return 1
+    return 0
+
+
+
+if __name__ == '__main__':
+
+    # If loaded as main, initialise the parser (to start the program with arguments)
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Run a script in the worker', formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument ('--socket', '-s', metavar = 'socket', type = str, help = 'The Unix socket of the worker (default {})'.format(default_socket()), required=False, default=None)
+    parser.add_argument ('script',         metavar = 'script', type = str, help = 'The script to run (e.g. setOrigin.py)')
+    parser.add_argument ('arguments',      nargs = argparse.REMAINDER,    help = 'The arguments of the script')
+    args = parser.parse_args()
+
+    try:
+        answer = run_in_worker(args.script, args.arguments, args.socket)
+    except NoWorkerError:
+        sys.exit(run_locally(args.script, args.arguments))
+    except OSError as e:
+        # the worker may have run (part of) the script: do not run it again
+        sys.exit("Error in the worker running {}: {}".format(args.script, e))
+
+    sys.stdout.write(answer["stdout"])
+    sys.stderr.write(answer["stderr"])
+    sys.exit(answer["exitCode"])
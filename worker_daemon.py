@@ -0,0 +1,251 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+
+@author: Martin
+
+Description:
+    Long-lived worker that keeps btk, numpy and the modules imported, reached over a Unix domain socket,
+    so that each call of a script only costs the time of the operation (not the start of python and the imports)
+
+    Each request is run in a process forked from the worker (the imported modules are shared, a crash or a sys.exit
+    only ends this process), in the working directory of the caller. The requests are one json line:
+        {"script": "setOrigin.py", "argv": ["-i", "in.c3d", "-m", "M1", "-o", "out.c3d"], "cwd": "/data"}
+            run a script with the same arguments as on the command line (see worker_client.py)
+        {"operation": "create_midpoint_marker", "input": "in.c3d", "output": "out.c3d", "params": {...}, "cwd": "/data"}
+        {"recipe": [...], "input": "in.c3d", "output": "out.c3d", "cwd": "/data"}
+            run one operation or a recipe with pipeline.process_file()
+        {"command": "ping"}
+    The answer is one json line: {"exitCode", "stdout", "stderr", "seconds"} (and "timings" for the operations)
+
+    The socket is only accessible by the user who started the worker.
+
+Usage:
+    python worker_daemon.py                      # start the worker (default socket: $PROC_TOOLS_SOCKET or /tmp/proc_tools-<uid>.sock)
+    python worker_daemon.py --socket my.sock
+    python worker_daemon.py --stop               # stop the worker
+    then: python worker_client.py setOrigin.py -i inputFile.c3d -m "myOriginMarker" -o outputFile.trc
+    or import as module
+
+Requirements:
+    btk
+    numpy
+    Unix (fork, Unix domain sockets)
+
+"""
+
+text="worker_daemon module"
+
+import json
+import os
+import socketserver
+import sys
+import tempfile
+import time
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# Scripts that can be run by the worker
+SCRIPTS = ("batch.py", "benchmark.py", "catalog.py", "convert_c3d_trc.py", "copy_marker.py", "create_anatomical_marker.py",
+           "create_midpoint_marker.py", "create_projected_marker.py", "create_virtual_markers.py", "marker_cache.py", "pipeline.py",
+           "read_c3d_memmap.py", "read_write_trc.py", "realtime_anatomical.py", "remove_marker.py", "rename.py", "setOrigin.py",
+           "stream_process.py")
+
+# Modules imported once when the worker starts
+PRELOAD = ("numpy", "btk", "proc_log", "convert_c3d_trc", "read_write_trc", "read_c3d_memmap", "marker_labels", "marker_cache",
+           "create_virtual_markers", "create_anatomical_marker", "create_midpoint_marker", "create_projected_marker", "copy_marker",
+           "remove_marker", "rename", "setOrigin", "pipeline", "stream_process")
+
+def default_socket():
+    return os.environ.get("PROC_TOOLS_SOCKET", os.path.join(tempfile.gettempdir(), "proc_tools-{}.sock".format(os.getuid())))
+
+def send_message(f, message):
+    f.write((json.dumps(message) + "\n").encode())
+    f.flush()
+
+def receive_message(f):
+    line = f.readline()
+    if not line:
+        raise IOError("Connection closed without a message")
+    return json.loads(line.decode())
+
+######################################################
+# Jobs (run in the forked process)
+######################################################
+
+def exit_code(e):
+    """
+    Exit code of a SystemExit, the message of sys.exit("message") is written on stderr
+    """
+
+    if e.code is None:
+        return 0
+    if isinstance(e.code, int):
+        return e.code
+    sys.stderr.write("{}\n".format(e.code))
+    return 1
+
+def run_script(script, argv):
+    """
+    Run a script as on the command line (its __main__ part), returns the exit code
+    """
+
+    import runpy
+
+    if os.path.basename(script) not in SCRIPTS:
+        raise Exception("Unknown script {} (scripts: {})".format(script, ", ".join(SCRIPTS)))
+
+    path = os.path.join(REPO_DIR, os.path.basename(script))
+    sys.argv = [path] + list(argv)
+    try:
+        runpy.run_path(path, run_name="__main__")
+    except SystemExit as e:
+        return exit_code(e)
+    return 0
+
+def run_operation(request):
+    """
+    Run one operation or a recipe with pipeline.process_file(), returns the timings
+    """
+
+    from pipeline import process_file, load_recipe
+
+    if "recipe" in request:
+        recipe = request["recipe"]
+        if isinstance(recipe, str):
+            recipe = load_recipe(recipe)
+    else:
+        recipe = [ dict(request.get("params", {}), operation=request["operation"]) ]
+    return process_file(request["input"], recipe, request["output"])
+
+def run_job(request):
+    """
+    Run a request, returns the answer (exitCode, stdout, stderr, seconds)
+    """
+
+    import contextlib
+    import io
+    import traceback
+    import proc_log
+
+    start = time.perf_counter()
+    stdout, stderr = io.StringIO(), io.StringIO()
+    answer = {}
+    with contextlib.redirect_stdout(stdout), contextlib.redirect_stderr(stderr):
+        # start from the same state as a new process
+        proc_log._profiler = None
+        proc_log.setup_logging(0)
+        try:
+            if request.get("cwd"):
+                os.chdir(request["cwd"])
+            if "script" in request:
+                answer["exitCode"] = run_script(request["script"], request.get("argv", []))
+            else:
+                answer["timings"] = run_operation(request)
+                answer["exitCode"] = 0
+        except SystemExit as e:
+            answer["exitCode"] = exit_code(e)
+        except Exception:
+            traceback.print_exc()
+            answer["exitCode"] = 1
+
+    answer.update(stdout=stdout.getvalue(), stderr=stderr.getvalue(), seconds=time.perf_counter() - start)
+    return answer
+
+class JobHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        try:
+            request = receive_message(self.rfile)
+        except (IOError, ValueError) as e:
+            send_message(self.wfile, { "exitCode": 1, "stdout": "", "stderr": "Bad request: {}\n".format(e), "seconds": 0.0 })
+            return
+        if request.get("command") == "ping":
+            send_message(self.wfile, { "exitCode": 0, "stdout": "", "stderr": "", "seconds": 0.0, "pid": os.getppid() })
+            return
+        send_message(self.wfile, run_job(request))
+
+class WorkerServer(socketserver.ForkingMixIn, socketserver.UnixStreamServer):
+    """
+    One forked process per request
+    """
+
+    block_on_close = False
+
+######################################################
+# Start/stop
+######################################################
+
+def pid_file(socketFile):
+    return socketFile + ".pid"
+
+def preload():
+    import importlib
+
+    sys.path.insert(0, REPO_DIR)
+    for name in PRELOAD:
+        try:
+            importlib.import_module(name)
+        except ImportError as e:
+            print("Could not preload {}: {}".format(name, e))
+
+def serve(socketFile):
+    import signal
+
+    if os.path.exists(socketFile):
+        os.remove(socketFile)
+
+    preload()
+
+    oldMask = os.umask(0o077) # only the user can connect
+    try:
+        server = WorkerServer(socketFile, JobHandler)
+    finally:
+        os.umask(oldMask)
+    with open(pid_file(socketFile), "w") as f:
+        f.write(str(os.getpid()))
+
+    def stop(signum, frame):
+        raise KeyboardInterrupt
+    signal.signal(signal.SIGTERM, stop)
+
+    print("Worker {} listening on {}".format(os.getpid(), socketFile))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        for f in (socketFile, pid_file(socketFile)):
+            if os.path.exists(f):
+                os.remove(f)
+        print("Worker stopped")
+
+def stop_worker(socketFile):
+    import signal
+
+    try:
+        with open(pid_file(socketFile)) as f:
+            pid = int(f.read())
+    except (IOError, ValueError):
+        return False
+    os.kill(pid, signal.SIGTERM)
+    return True
+
+
+
+if __name__ == '__main__':
+
+    # If loaded as main, initialise the parser (to start the program with arguments)
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Worker running the scripts without starting python each time', formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument ('--socket', '-s', metavar = 'socket', type = str, help = 'The Unix socket of the worker (default {})'.format(default_socket()), required=False, default=None)
+    parser.add_argument ('--stop',                                         help = 'Stop the worker',                                                 required=False, action='store_true', default=False)
+    args = parser.parse_args()
+
+    socketFile = args.socket or default_socket()
+    if args.stop:
+        if not stop_worker(socketFile):
+            sys.exit("No worker running on {}".format(socketFile))
+    else:
+        serve(socketFile)